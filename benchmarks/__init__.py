@@ -0,0 +1,4 @@
+"""Benchmarks of hypoDDutils on synthetic catalogs and hypoDD outputs.
+
+See benchmarkSuite for running them and syntheticCatalog for the data.
+"""
@@ -0,0 +1,276 @@
+"""Timing of the input preparation and output parsing of hypoDDutils.
+
+Every benchmark runs on synthetic data (see syntheticCatalog) at several
+numbers of events and is measured as an instrumentation stage: wall clock
+and CPU time, peak memory and bytes written. Results can be saved as a
+baseline and later runs compared against it:
+
+    python -m benchmarks.benchmarkSuite --scales 1000 100000 --save
+    python -m benchmarks.benchmarkSuite --scales 1000 100000 --compare
+
+No network access or hypoDD executable is needed.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import numpy as np
+from hypoDDutils.catalogArrays import write_stations
+from hypoDDutils.connectedness import build_connectedness
+from hypoDDutils.hypoDDcontrol import HypoDDControl
+from hypoDDutils.hypoDDinput import HypoDDInput
+from hypoDDutils.hypoDDobject import HypoDDObject
+from hypoDDutils.hypoDDoutput import (read_reloc, read_res, write_reloc,
+                                      write_res, group_clusters)
+from hypoDDutils.instrumentation import Instrumentation
+from hypoDDutils.ph2dtControl import Ph2dtControl
+from hypoDDutils.ph2dtInput import Ph2dtInput
+from syntheticCatalog import (synthetic_catalog, synthetic_reloc,
+                              synthetic_res, synthetic_stations)
+
+# The default numbers of events of the benchmarks.
+DEFAULT_SCALES = (1000, 100000)
+
+# The default baseline file, next to this module.
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "baseline.json")
+
+# The measurements compared against the baseline.
+COMPARED_METRICS = ("wall_time", "cpu_time", "peak_rss")
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Discard the progress lines printed by the code being timed.
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+class BenchmarkSuite:
+    """Runs the benchmarks of hypoDDutils on synthetic data.
+
+    Attributes:
+    scales: The numbers of events the benchmarks are run at.
+    nstations: The number of synthetic stations.
+    nclusters: The number of synthetic clusters.
+    observations_per_event: The mean number of data residuals per event.
+    repeat: The number of runs of every benchmark. The fastest counts.
+    directory: The working directory. A temporary one, removed at the end,
+               if None.
+    seed: The seed of the synthetic data.
+    results: The measurements of every benchmark, keyed by
+             'name@scale', once run.
+    Methods:
+    __init__: Initialization method.
+    run: Run all benchmarks at all scales.
+    compare: Compare the results with a baseline.
+    save: Save the results as a baseline.
+    """
+
+    scales = DEFAULT_SCALES
+    nstations = 20
+    nclusters = 10
+    observations_per_event = 20
+    repeat = 3
+    directory = None
+    seed = 0
+    results = None
+
+    def __init__(self, scales=DEFAULT_SCALES, nstations=20, nclusters=10,
+                 observations_per_event=20, repeat=3, directory=None, seed=0
+                 ):
+        """Initialization method for the BenchmarkSuite class.
+        """
+        self.scales = list(scales)
+        self.nstations = nstations
+        self.nclusters = nclusters
+        self.observations_per_event = observations_per_event
+        self.repeat = repeat
+        self.directory = directory
+        self.seed = seed
+        self.results = {}
+
+    def _time(self, name, scale, function, files=()):
+        """Run function repeat times as a stage and keep the fastest run.
+        """
+        instrumentation = Instrumentation(sinks=[])
+        for run in range(self.repeat):
+            with _quiet():
+                with instrumentation.stage(name, files):
+                    function()
+        best = min(instrumentation.records,
+                   key=lambda record: record["wall_time"])
+        result = dict((metric, best[metric])
+                      for metric in COMPARED_METRICS + ("bytes_written",))
+        self.results["{}@{}".format(name, scale)] = result
+        print "{:<28} {:>9} events {:9.3f} s {:9.3f} s cpu {:7.0f} MB".format(
+            name, scale, result["wall_time"], result["cpu_time"],
+            result["peak_rss"] / 1048576.0)
+
+    def _run_scale(self, scale, directory):
+        """Generate the data of a scale and run all benchmarks on them.
+        """
+        stations = synthetic_stations(self.nstations, seed=self.seed)
+        with _quiet():
+            arrays = synthetic_catalog(scale, stations,
+                                       nclusters=self.nclusters,
+                                       table_directory=directory,
+                                       seed=self.seed)
+        reloc = synthetic_reloc(arrays, nclusters=self.nclusters,
+                                seed=self.seed)
+        res = synthetic_res(reloc, self.observations_per_event,
+                            stations=sorted(stations), seed=self.seed)
+        reloc_file = os.path.join(directory, "hypoDD.reloc")
+        res_file = os.path.join(directory, "hypoDD.res")
+        write_reloc(reloc_file, reloc)
+        write_res(res_file, res)
+        del res
+
+        ph2dt_control = Ph2dtControl(control_directory=directory)
+        hypoDD_control = HypoDDControl(control_directory=directory)
+        ph2dt_input = Ph2dtInput(arrays, input_directory=directory,
+                                 arrays=arrays)
+        filtered_input = Ph2dtInput(arrays, input_directory=directory,
+                                    arrays=arrays,
+                                    station_coordinates=stations,
+                                    control=ph2dt_control,
+                                    dist=hypoDD_control.dist)
+        hypoDD_input = HypoDDInput(arrays, None, input_directory=directory,
+                                   ph2dt_control=ph2dt_control,
+                                   hypoDD_control=hypoDD_control,
+                                   arrays=arrays)
+        hypoDD_object = HypoDDObject(arrays, directory=directory)
+        hypoDD_object.catalog_arrays = arrays
+        hypoDD_object.hypoDD_control = hypoDD_control
+
+        def write_controls():
+            for run in range(100):
+                ph2dt_control.write_control_file()
+                hypoDD_control.write_control_file()
+
+        def write_station_input():
+            with open(os.path.join(directory, "station.dat"), "w") as f:
+                write_stations(f, stations)
+
+        def connectedness():
+            build_connectedness(res_file, group_clusters(read_reloc(
+                                                             reloc_file)))
+
+        phase_file = os.path.join(directory, "phase.dat")
+        for name, function, files in (
+                ("write_control_files", write_controls, ()),
+                ("prepare_phase_input",
+                 ph2dt_input.prepare_catalog_abs_tt_input, (phase_file,)),
+                ("prepare_phase_input_filtered",
+                 filtered_input.prepare_catalog_abs_tt_input, (phase_file,)),
+                ("prepare_hypocenter_input",
+                 hypoDD_input.prepare_hypocenter_input, ()),
+                ("prepare_station_input", write_station_input, ()),
+                ("read_reloc", lambda: read_reloc(reloc_file), ()),
+                ("read_res", lambda: read_res(res_file), ()),
+                ("connectedness", connectedness, ()),
+                ("get_results", hypoDD_object.get_results, ())):
+            self._time(name, scale, function, files)
+
+    def run(self):
+        """Run all benchmarks at all scales. Returns the results.
+        """
+        directory = self.directory
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="hypoDDutils_benchmarks_")
+        try:
+            for scale in self.scales:
+                scale_directory = os.path.join(directory, str(scale))
+                if not os.path.isdir(scale_directory):
+                    os.makedirs(scale_directory)
+                self._run_scale(scale, scale_directory)
+        finally:
+            if self.directory is None:
+                shutil.rmtree(directory, ignore_errors=True)
+        return self.results
+
+    def save(self, filename=BASELINE_FILE):
+        """Save the results as a baseline, with a description of the
+        machine and of the versions used.
+        """
+        baseline = {"machine": {"platform": platform.platform(),
+                                "processor": platform.processor(),
+                                "python": platform.python_version(),
+                                "numpy": np.__version__},
+                    "seed": self.seed,
+                    "results": self.results}
+        with open(filename, "w") as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print "baseline saved to {}".format(filename)
+
+    def compare(self, filename=BASELINE_FILE, tolerance=0.2):
+        """Compare the results with a baseline.
+
+        A measurement more than tolerance (a fraction) above its baseline
+        value is a regression. Benchmarks missing from the baseline are
+        skipped. Returns the list of (benchmark, metric, baseline, current)
+        tuples of the regressions.
+        """
+        with open(filename, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = []
+        for key in sorted(self.results):
+            if key not in baseline:
+                continue
+            for metric in COMPARED_METRICS:
+                before = baseline[key][metric]
+                after = self.results[key][metric]
+                change = float(after - before) / before if before else 0.0
+                flag = ""
+                if change > tolerance:
+                    flag = "REGRESSION"
+                    regressions.append((key, metric, before, after))
+                elif change < -tolerance:
+                    flag = "improved"
+                print "{:<40} {:<10} {:+7.1%} {}".format(key, metric, change,
+                                                         flag)
+        return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+                 description="Benchmarks of hypoDDutils on synthetic data.")
+    parser.add_argument("--scales", type=int, nargs="+",
+                        default=list(DEFAULT_SCALES),
+                        help="numbers of events, e.g. 1000 100000 1000000")
+    parser.add_argument("--stations", type=int, default=20)
+    parser.add_argument("--clusters", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--directory", default=None,
+                        help="working directory, kept after the run")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save", action="store_true",
+                        help="save the results as the baseline")
+    parser.add_argument("--compare", action="store_true",
+                        help="compare the results with the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+    suite = BenchmarkSuite(args.scales, nstations=args.stations,
+                           nclusters=args.clusters, repeat=args.repeat,
+                           directory=args.directory)
+    suite.run()
+    regressions = []
+    if args.compare:
+        regressions = suite.compare(args.baseline, args.tolerance)
+    if args.save:
+        suite.save(args.baseline)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
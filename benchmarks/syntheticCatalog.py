@@ -0,0 +1,221 @@
+"""Generators of synthetic catalogs, picks and hypoDD outputs.
+
+Everything is drawn from seeded random number generators, so the same
+arguments always give the same data. Events are grouped in clusters around
+random centres, stations are spread over a disc around the clusters and the
+travel times of the picks come from a VelocityModel, so that the data look
+like those of a real network while no network access or executable is
+needed.
+"""
+import numpy as np
+from hypoDDutils.catalogArrays import CatalogArrays
+from hypoDDutils.geodesy import haversine
+from hypoDDutils.hypoDDoutput import RELOC_DTYPE, RES_DTYPE
+from hypoDDutils.travelTime import TravelTimeTable
+from hypoDDutils.velocityModel import VelocityModel
+
+# Length in km of one degree of latitude.
+KM_PER_DEGREE = 111.195
+
+# Start of the synthetic catalogs, as a POSIX timestamp (2015-01-01).
+START_TIME = 1420070400.0
+
+
+def synthetic_stations(nstations, latitude=53.0, longitude=6.7, radius=60.0,
+                       seed=0):
+    """Return a dict mapping station codes to (latitude, longitude) tuples.
+
+    The stations are spread uniformly over a disc of radius km around
+    (latitude, longitude).
+    """
+    rng = np.random.RandomState(seed)
+    distance = radius * np.sqrt(rng.rand(nstations))
+    azimuth = 2.0 * np.pi * rng.rand(nstations)
+    latitudes = latitude + distance * np.cos(azimuth) / KM_PER_DEGREE
+    longitudes = longitude + (distance * np.sin(azimuth) /
+                              (KM_PER_DEGREE * np.cos(np.radians(latitude))))
+    return dict(("S{:04d}".format(idx), (lat, lon))
+                for idx, (lat, lon) in enumerate(zip(latitudes, longitudes)))
+
+
+def synthetic_catalog(nevents, stations, nclusters=10, velocity_model=None,
+                      latitude=53.0, longitude=6.7, region=40.0,
+                      cluster_radius=2.0, max_pick_distance=150.0,
+                      pick_fraction=0.8, pick_error=0.02,
+                      location_error=0.5, table_directory=None, seed=0,
+                      return_truth=False):
+    """Generate a catalog of clustered events with P and S picks.
+
+    Arguments:
+    nevents: The number of events.
+    stations: A dict mapping station codes to (latitude, longitude) tuples,
+              e.g. from synthetic_stations.
+    nclusters: The number of clusters the events are drawn around.
+    velocity_model: The VelocityModel of the travel times. The default
+                    model if None.
+    latitude, longitude, region: The cluster centres are spread over a
+                                 square of side region km around (latitude,
+                                 longitude), at depths of 2 to 12 km.
+    cluster_radius: The standard deviation in km of the event locations
+                    around their cluster centre.
+    max_pick_distance: Stations farther than this (km) have no picks.
+    pick_fraction: The probability of a pick of each phase at each station
+                   within max_pick_distance.
+    pick_error: The standard deviation in s of the pick times.
+    location_error: The standard deviation in km of the catalog locations
+                    around the true ones.
+    table_directory: The cache directory of the travel time tables (see
+                     travelTime.TravelTimeTable), or None.
+    seed: The seed of the random number generator.
+    return_truth: If True, also return the true hypocenters.
+    Returns a CatalogArrays whose events are in origin time order, with IDs
+    from 1. With return_truth, a tuple of the CatalogArrays and of the true
+    latitudes, longitudes and depths of the events.
+    """
+    if velocity_model is None:
+        velocity_model = VelocityModel()
+    rng = np.random.RandomState(seed)
+    codes = sorted(stations)
+    station_coordinates = np.array([stations[code] for code in codes],
+                                   dtype=np.float64).reshape(-1, 2)
+    degrees = KM_PER_DEGREE * np.array(
+                  [1.0, np.cos(np.radians(latitude))])
+    centres = (np.array([latitude, longitude]) +
+               region * (rng.rand(nclusters, 2) - 0.5) / degrees)
+    centre_depths = 2.0 + 10.0 * rng.rand(nclusters)
+    cluster = rng.randint(0, nclusters, nevents)
+    true_latitudes = (centres[cluster, 0] +
+                      cluster_radius * rng.randn(nevents) / degrees[0])
+    true_longitudes = (centres[cluster, 1] +
+                       cluster_radius * rng.randn(nevents) / degrees[1])
+    true_depths = np.clip(centre_depths[cluster] +
+                          cluster_radius * rng.randn(nevents), 0.5, 30.0)
+
+    # All event-station combinations within max_pick_distance, per phase.
+    nstations = len(codes)
+    events = np.repeat(np.arange(nevents), nstations)
+    sta = np.tile(np.arange(nstations, dtype=np.int32), nevents)
+    distance = haversine(true_latitudes[events], true_longitudes[events],
+                         station_coordinates[sta, 0],
+                         station_coordinates[sta, 1])
+    keep = distance <= max_pick_distance
+    events = events[keep]
+    sta = sta[keep]
+    distance = distance[keep]
+    table = TravelTimeTable(velocity_model,
+                            max_distance=max(max_pick_distance, 1.0),
+                            max_depth=40.0, cache_directory=table_directory)
+    pick_events = []
+    pick_stations = []
+    pick_phases = []
+    pick_times = []
+    for phase in ("P", "S"):
+        picked = rng.rand(len(events)) < pick_fraction
+        times, _ = table.travel_times(distance[picked],
+                                      true_depths[events[picked]], phase)
+        pick_events.append(events[picked])
+        pick_stations.append(sta[picked])
+        pick_phases.append(np.repeat(np.array([phase], dtype="S1"),
+                                     picked.sum()))
+        pick_times.append(times + pick_error * rng.randn(picked.sum()))
+    pick_events = np.concatenate(pick_events)
+    order = np.lexsort((np.concatenate(pick_stations), pick_events))
+    pick_events = pick_events[order]
+    counts = np.bincount(pick_events, minlength=nevents)
+
+    arrays = CatalogArrays(np.arange(1, nevents + 1),
+                           START_TIME + np.cumsum(
+                               rng.exponential(600.0, nevents)),
+                           true_latitudes + location_error *
+                           rng.randn(nevents) / degrees[0],
+                           true_longitudes + location_error *
+                           rng.randn(nevents) / degrees[1],
+                           np.clip(true_depths + location_error *
+                                   rng.randn(nevents), 0.0, None),
+                           np.round(0.5 + rng.exponential(0.5, nevents), 1),
+                           np.full(nevents, location_error),
+                           np.full(nevents, location_error),
+                           np.full(nevents, pick_error),
+                           np.concatenate(([0], np.cumsum(counts))),
+                           np.concatenate(pick_stations)[order],
+                           np.concatenate(pick_phases)[order],
+                           np.concatenate(pick_times)[order],
+                           np.round(rng.uniform(0.25, 1.0, len(order)), 2),
+                           codes,
+                           [("NL", code, "", "HHZ") for code in codes])
+    if return_truth:
+        return arrays, (true_latitudes, true_longitudes, true_depths)
+    return arrays
+
+
+def synthetic_reloc(arrays, nclusters=10, seed=0):
+    """Generate relocated hypocenter records of the events of arrays.
+
+    The events are spread over nclusters hypoDD clusters. Returns a
+    structured array with the fields of hypoDDoutput.RELOC_DTYPE.
+    """
+    rng = np.random.RandomState(seed)
+    nevents = len(arrays)
+    records = np.zeros(nevents, dtype=RELOC_DTYPE)
+    records["evid"] = arrays.event_ids
+    records["lat"] = arrays.latitudes + 0.001 * rng.randn(nevents)
+    records["lon"] = arrays.longitudes + 0.001 * rng.randn(nevents)
+    records["depth"] = np.maximum(arrays.depths +
+                                  0.1 * rng.randn(nevents), 0.0)
+    records["x"] = 1000.0 * rng.randn(nevents)
+    records["y"] = 1000.0 * rng.randn(nevents)
+    records["z"] = 1000.0 * rng.randn(nevents)
+    for name in ("ex", "ey", "ez"):
+        records[name] = rng.uniform(10.0, 200.0, nevents)
+    year, month, day, hour, minute, microsecond = arrays.time_fields()
+    records["year"] = year
+    records["month"] = month
+    records["day"] = day
+    records["hour"] = hour
+    records["minute"] = minute
+    records["second"] = np.round(microsecond / 1.0e6, 3)
+    records["mag"] = arrays.magnitudes
+    for name in ("nccp", "nccs", "nctp", "ncts"):
+        records[name] = rng.randint(0, 200, nevents)
+    records["rcc"] = rng.uniform(1.0, 50.0, nevents)
+    records["rct"] = rng.uniform(1.0, 50.0, nevents)
+    records["cid"] = 1 + rng.randint(0, nclusters, nevents)
+    return records
+
+
+def synthetic_res(reloc, observations_per_event=20, stations=None, seed=0):
+    """Generate data residual records of relocated events.
+
+    Observations link random pairs of events of the same cluster of reloc.
+    Returns a structured array with the fields of hypoDDoutput.RES_DTYPE.
+
+    Arguments:
+    reloc: Relocated hypocenter records, e.g. from synthetic_reloc.
+    observations_per_event: The mean number of observations per event.
+    stations: The station codes of the observations. 20 synthetic codes
+              if None.
+    seed: The seed of the random number generator.
+    """
+    rng = np.random.RandomState(seed)
+    if stations is None:
+        stations = ["S{:04d}".format(idx) for idx in range(20)]
+    nobservations = observations_per_event * len(reloc)
+    order = np.argsort(reloc["cid"], kind="mergesort")
+    cids = reloc["cid"][order]
+    starts = np.searchsorted(cids, cids, side="left")
+    counts = np.searchsorted(cids, cids, side="right") - starts
+    first = rng.randint(0, len(reloc), nobservations)
+    second = starts[first] + (rng.randint(0, 1 << 30, nobservations) %
+                              counts[first])
+    records = np.zeros(nobservations, dtype=RES_DTYPE)
+    records["sta"] = np.array(stations, dtype="S7")[
+                         rng.randint(0, len(stations), nobservations)]
+    records["dt"] = np.round(rng.randn(nobservations), 7)
+    records["c1"] = reloc["evid"][order][first]
+    records["c2"] = reloc["evid"][order][second]
+    records["idx"] = rng.randint(1, 5, nobservations)
+    records["qual"] = np.round(rng.rand(nobservations), 4)
+    records["res"] = np.round(20.0 * rng.randn(nobservations), 6)
+    records["wt"] = np.round(rng.rand(nobservations), 6)
+    records["offs"] = np.round(rng.uniform(0.0, 5000.0, nobservations), 1)
+    return records
@@ -0,0 +1,415 @@
+import copy
+import os
+import shutil
+import numpy as np
+from obspy.core.event import ConfidenceEllipsoid, OriginUncertainty
+from catalogArrays import WRITE_BUFFER_SIZE
+from ddSolver import run_workspace
+from dtFile import DifferentialTimes
+from executor import Executor
+from geodesy import EARTH_RADIUS
+from hypoDDoutput import read_reloc, read_res
+from sweep import link_or_copy
+
+# Metres per degree of latitude.
+M_PER_DEGREE = 1000.0 * np.pi * EARTH_RADIUS / 180.0
+
+# The resampling modes.
+MODES = ("residuals", "stations", "events")
+
+
+class OnlineCovariance:
+    """Streaming mean and covariance of the positions of many events.
+
+    Uses Welford's algorithm, so the samples never need to be kept.
+    Positions are given in m, east, north and down.
+
+    Attributes:
+    count: The number of samples of every event.
+    mean: (n, 3) array with the mean position of every event.
+    m2: (n, 3, 3) array with the sums of the outer products of the
+        deviations of every event.
+    Methods:
+    __init__: Initialization method.
+    update: Add one sample for some of the events.
+    covariance: Return the sample covariance of every event.
+    """
+
+    count = None
+    mean = None
+    m2 = None
+
+    def __init__(self, n):
+        """Initialization method for the OnlineCovariance class.
+        """
+        self.count = np.zeros(n, dtype=np.int64)
+        self.mean = np.zeros((n, 3))
+        self.m2 = np.zeros((n, 3, 3))
+
+    def update(self, index, positions):
+        """Add one sample for the events at index.
+
+        Arguments:
+        index: Indices of the events, without repetitions.
+        positions: (len(index), 3) array with their positions.
+        """
+        self.count[index] += 1
+        delta = positions - self.mean[index]
+        self.mean[index] += delta / self.count[index][:, np.newaxis]
+        self.m2[index] += np.einsum("ni,nj->nij", delta,
+                                    positions - self.mean[index])
+
+    def covariance(self):
+        """Return the (n, 3, 3) sample covariances. Events with fewer than
+        two samples get NaN.
+        """
+        dof = (self.count - 1).astype(np.float64)
+        dof[dof < 1] = np.nan
+        return self.m2 / dof[:, np.newaxis, np.newaxis]
+
+
+def origin_uncertainty(covariance, confidence_level=68.3):
+    """Build an obspy OriginUncertainty from a covariance matrix.
+
+    Arguments:
+    covariance: 3 x 3 covariance in m^2 of the east, north and down
+                coordinates of a hypocenter.
+    confidence_level: The confidence level of the uncertainties, in %. The
+                      semi-axes are the standard deviations scaled for it.
+    """
+    from scipy.stats import chi2
+    scale_1 = np.sqrt(chi2.ppf(confidence_level / 100.0, 1))
+    scale_2 = np.sqrt(chi2.ppf(confidence_level / 100.0, 2))
+    scale_3 = np.sqrt(chi2.ppf(confidence_level / 100.0, 3))
+    uncertainty = OriginUncertainty()
+    uncertainty.confidence_level = confidence_level
+
+    values, vectors = np.linalg.eigh(covariance[:2, :2])
+    values = np.maximum(values, 0.0)
+    major = vectors[:, 1]
+    uncertainty.min_horizontal_uncertainty = scale_2 * np.sqrt(values[0])
+    uncertainty.max_horizontal_uncertainty = scale_2 * np.sqrt(values[1])
+    uncertainty.azimuth_max_horizontal_uncertainty = \
+        np.degrees(np.arctan2(major[0], major[1])) % 180.0
+    uncertainty.horizontal_uncertainty = scale_1 * np.sqrt(
+                                             0.5 * (values[0] + values[1]))
+
+    values, vectors = np.linalg.eigh(covariance)
+    values = np.maximum(values, 0.0)
+    major = vectors[:, 2]
+    if major[2] < 0:
+        major = -major
+    intermediate = vectors[:, 1]
+    ellipsoid = ConfidenceEllipsoid()
+    ellipsoid.semi_minor_axis_length = scale_3 * np.sqrt(values[0])
+    ellipsoid.semi_intermediate_axis_length = scale_3 * np.sqrt(values[1])
+    ellipsoid.semi_major_axis_length = scale_3 * np.sqrt(values[2])
+    ellipsoid.major_axis_plunge = np.degrees(np.arcsin(min(major[2], 1.0)))
+    ellipsoid.major_axis_azimuth = \
+        np.degrees(np.arctan2(major[0], major[1])) % 360.0
+    # The rotation of the intermediate axis about the major axis, from the
+    # horizontal direction normal to the major axis.
+    horizontal = np.cross([0.0, 0.0, 1.0], major)
+    if np.linalg.norm(horizontal) < 1e-12:
+        horizontal = np.array([1.0, 0.0, 0.0])
+    horizontal /= np.linalg.norm(horizontal)
+    ellipsoid.major_axis_rotation = np.degrees(np.arctan2(
+                            np.dot(np.cross(horizontal, intermediate), major),
+                            np.dot(horizontal, intermediate))) % 180.0
+    uncertainty.confidence_ellipsoid = ellipsoid
+    uncertainty.preferred_description = "confidence ellipsoid"
+    return uncertainty
+
+
+class Bootstrap:
+    """Relocation uncertainties from resampled hypoDD realisations.
+
+    The differential time inputs are parsed once. Every realisation
+    perturbs them in memory and writes them to its own workspace:
+
+    'residuals': every observation is replaced by its prediction (the
+                 observation minus its own final residual in 'hypoDD.res')
+                 plus a residual drawn, with replacement, from the final
+                 residuals of its data type. Observations that are not in
+                 'hypoDD.res' are kept as they are.
+    'stations': the observations of a random drop_fraction of the stations
+                are removed.
+    'events': the pairs of a random drop_fraction of the events are
+              removed.
+
+    The realisations run concurrently on the executor of hypoDD_object, or
+    one after the other with DDSolver if hypoDD_object uses the native
+    solver.
+    The relocated positions of every event are accumulated with streaming
+    statistics, so a realisation's output is discarded as soon as it is
+    read.
+
+    Attributes:
+    hypoDD_object: The HypoDDObject that has been run once, with a data
+                   residual output for the 'residuals' mode.
+    mode: One of MODES.
+    realisations: The number of realisations.
+    drop_fraction: The fraction of stations or events dropped.
+    seed: The seed of the random number generator.
+    directory: The directory of the workspaces. 'bootstrap' in the
+               directory of hypoDD_object if None.
+    processes: Number of concurrent runs. None to use the limit of the
+               executor of hypoDD_object.
+    statistics: The OnlineCovariance of the relocated positions.
+    event_ids: The IDs of the events, in the order of statistics.
+    Methods:
+    __init__: Initialization method.
+    run: Run all realisations.
+    uncertainties: Return the OriginUncertainty of every event.
+    """
+
+    hypoDD_object = None
+    mode = "residuals"
+    realisations = 200
+    drop_fraction = 0.1
+    seed = None
+    directory = None
+    processes = None
+    statistics = None
+    event_ids = None
+
+    def __init__(self, hypoDD_object, mode="residuals", realisations=200,
+                 drop_fraction=0.1, seed=None, directory=None,
+                 processes=None
+                 ):
+        """Initialization method for the Bootstrap class.
+        """
+        if mode not in MODES:
+            raise ValueError("unknown resampling mode: {}".format(mode))
+        self.hypoDD_object = hypoDD_object
+        self.mode = mode
+        self.realisations = realisations
+        self.drop_fraction = drop_fraction
+        self.seed = seed
+        if directory is None:
+            directory = "{}/bootstrap".format(hypoDD_object.directory)
+        self.directory = directory
+        self.processes = processes
+        self.statistics = None
+        self.event_ids = None
+        self._dropped_stations = None
+        self._dropped_events = None
+
+    def _path(self, filename):
+        return "{}/{}".format(self.hypoDD_object.directory, filename)
+
+    def _inputs(self):
+        """Parse the differential time inputs once.
+        """
+        control = self.hypoDD_object.hypoDD_control
+        inputs = []
+        for filename in (control.ct_dt_input, control.cc_dt_input):
+            if filename and os.path.isfile(self._path(filename)):
+                inputs.append((filename,
+                               DifferentialTimes.read(self._path(filename))))
+        return inputs
+
+    def _residuals(self, inputs):
+        """Return the final residuals in s of every data type, keyed by
+        (cross correlation, phase), and for every input the final residual
+        in s of each of its observations, 0 for the observations that are
+        not in the data residual output.
+        """
+        control = self.hypoDD_object.hypoDD_control
+        records = read_res(self._path(control.data_residual_output))
+        types = {1: (True, "P"), 2: (True, "S"), 3: (False, "P"),
+                 4: (False, "S")}
+        pools = dict((types[idx],
+                      records["res"][records["idx"] == idx] / 1000.0)
+                     for idx in types)
+        return pools, [self._own_residuals(times, records)
+                       for _, times in inputs]
+
+    @staticmethod
+    def _own_residuals(times, records):
+        """Match the observations of a DifferentialTimes with their records
+        in the data residual output, by pair, station and data type.
+        """
+        own = np.zeros(len(times.stations))
+        if not len(records) or not len(own):
+            return own
+        events = np.unique(np.concatenate((times.pairs.ravel(),
+                                           records["c1"], records["c2"])))
+        stations = np.unique(np.concatenate((times.stations,
+                                             records["sta"])))
+
+        def keys(first, second, station, idx):
+            key = np.searchsorted(events, first).astype(np.int64)
+            key = key * len(events) + np.searchsorted(events, second)
+            key = key * len(stations) + np.searchsorted(stations, station)
+            return key * 4 + idx - 1
+
+        pair = np.repeat(np.arange(len(times.pairs)), np.diff(times.offsets))
+        idx = np.where(times.phases == b"S", 2, 1) + \
+              (0 if times.cross_correlation else 2)
+        observed = keys(times.pairs[pair, 0], times.pairs[pair, 1],
+                        times.stations, idx)
+        known = keys(records["c1"], records["c2"], records["sta"],
+                     records["idx"])
+        order = np.argsort(known, kind="mergesort")
+        position = np.minimum(np.searchsorted(known[order], observed),
+                              len(order) - 1)
+        found = known[order][position] == observed
+        own[found] = records["res"][order[position[found]]] / 1000.0
+        return own
+
+    def _perturb(self, rng, times, residuals, own):
+        """Return a resampled copy of a DifferentialTimes.
+
+        In the 'residuals' mode, own holds the final residual of every
+        observation of times (see _residuals).
+        """
+        if self.mode == "residuals":
+            values = times.values.copy()
+            for phase in ("P", "S"):
+                pool = residuals.get((times.cross_correlation, phase))
+                selected = times.phases == phase.encode()
+                if pool is None or not len(pool) or not selected.any():
+                    continue
+                # The first value holds the differential time (dt.cc) or
+                # the travel time of the first event (dt.ct).
+                values[selected, 0] += pool[rng.randint(0, len(pool),
+                                                        selected.sum())] - \
+                                       own[selected]
+            return DifferentialTimes(times.pairs, times.origin_corrections,
+                                     times.offsets, times.stations, values,
+                                     times.phases)
+        if self.mode == "stations":
+            dropped = self._dropped_stations
+            return times.subset(observation_selection=~np.in1d(times.stations,
+                                                               dropped))
+        dropped = self._dropped_events
+        return times.subset(pair_selection=~np.in1d(times.pairs,
+                                                    dropped).reshape(-1, 2)
+                                                    .any(axis=1))
+
+    def _prepare(self, number, rng, inputs, residuals):
+        """Write the inputs of a realisation to its workspace.
+
+        Returns the keyword arguments of the run and the control of the
+        realisation.
+        """
+        hypoDD_object = self.hypoDD_object
+        workspace = "{}/realisation_{:04d}".format(self.directory, number)
+        if not os.path.isdir(workspace):
+            os.makedirs(workspace)
+        control = copy.copy(hypoDD_object.hypoDD_control)
+        control.control_directory = workspace
+        # Every realisation relocates all the events as one cluster.
+        control.cid = 0
+        control.evid = []
+        for filename in (control.initial_hypocenters, control.station_input):
+            link_or_copy(self._path(filename),
+                         "{}/{}".format(workspace, filename))
+        if self.mode == "stations":
+            stations = np.unique(np.concatenate([times.stations
+                                                 for _, times in inputs]))
+            self._dropped_stations = rng.choice(
+                stations, int(round(self.drop_fraction * len(stations))),
+                replace=False)
+        elif self.mode == "events":
+            self._dropped_events = rng.choice(
+                self.event_ids, int(round(self.drop_fraction *
+                                          len(self.event_ids))),
+                replace=False)
+        pools, own = residuals
+        for (filename, times), own_residuals in zip(inputs, own):
+            with open("{}/{}".format(workspace, filename), "w",
+                      WRITE_BUFFER_SIZE) as f:
+                self._perturb(rng, times, pools, own_residuals).write(f)
+        control.write_control_file()
+        return dict(command=[os.path.abspath(self._path(
+                                 hypoDD_object.hypoDD_executable)),
+                             control.control_file],
+                    cwd=workspace,
+                    log_file="{}/hypoDD.log.out".format(workspace)), control
+
+    def _accumulate(self, run):
+        """Add the relocations of a finished realisation to the statistics
+        and remove its workspace.
+        """
+        control = self.hypoDD_object.hypoDD_control
+        results_file = "{}/{}".format(run["cwd"],
+                                      control.relocated_hypocenters_output)
+        if os.path.isfile(results_file) and os.path.getsize(results_file):
+            records = read_reloc(results_file)
+            index = np.searchsorted(self.event_ids, records["evid"])
+            valid = (index < len(self.event_ids))
+            valid[valid] = self.event_ids[index[valid]] == \
+                           records["evid"][valid]
+            index = index[valid]
+            records = records[valid]
+            positions = np.column_stack((
+                (records["lon"] - self._reference[index, 1]) *
+                    np.cos(np.radians(self._reference[index, 0])) *
+                    M_PER_DEGREE,
+                (records["lat"] - self._reference[index, 0]) * M_PER_DEGREE,
+                1000.0 * records["depth"]))
+            self.statistics.update(index, positions)
+        shutil.rmtree(run["cwd"], ignore_errors=True)
+
+    def run(self):
+        """Run all realisations and accumulate their relocations.
+
+        Returns the OriginUncertainty of every event, keyed by event ID.
+        """
+        hypoDD_object = self.hypoDD_object
+        control = hypoDD_object.hypoDD_control
+        reference = read_reloc(self._path(
+                                   control.relocated_hypocenters_output))
+        order = np.argsort(reference["evid"])
+        self.event_ids = reference["evid"][order]
+        self._reference = np.column_stack((reference["lat"][order],
+                                           reference["lon"][order]))
+        self.statistics = OnlineCovariance(len(self.event_ids))
+        inputs = self._inputs()
+        residuals = ({}, [None] * len(inputs))
+        if self.mode == "residuals":
+            residuals = self._residuals(inputs)
+        rng = np.random.RandomState(self.seed)
+        print "running {} {} realisations".format(self.realisations,
+                                                  self.mode)
+        if hypoDD_object.native_hypoDD:
+            for number in range(1, self.realisations + 1):
+                run, control = self._prepare(number, rng, inputs, residuals)
+                run_workspace(control, run["cwd"])
+                self._accumulate(run)
+            return self.uncertainties()
+        executor = hypoDD_object.get_executor()
+        if self.processes is not None:
+            executor = Executor(max_concurrent=self.processes,
+                                timeout=executor.timeout,
+                                memory_limit=executor.memory_limit)
+        pending = []
+        for number in range(1, self.realisations + 1):
+            run, _ = self._prepare(number, rng, inputs, residuals)
+            pending.append((run, executor.submit(**run)))
+            # Keep at most twice as many realisations on disk as can run.
+            while len(pending) >= 2 * executor.max_concurrent:
+                run, result = pending.pop(0)
+                result.get()
+                self._accumulate(run)
+        for run, result in pending:
+            result.get()
+            self._accumulate(run)
+        if executor is not hypoDD_object.get_executor():
+            executor.close()
+        return self.uncertainties()
+
+    def uncertainties(self, confidence_level=68.3):
+        """Return the OriginUncertainty of every event with at least two
+        relocations, keyed by event ID.
+        """
+        covariances = self.statistics.covariance()
+        uncertainties = {}
+        for idx, evid in enumerate(self.event_ids.tolist()):
+            if self.statistics.count[idx] < 2:
+                continue
+            uncertainties[evid] = origin_uncertainty(covariances[idx],
+                                                     confidence_level)
+        return uncertainties
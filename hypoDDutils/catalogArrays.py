@@ -0,0 +1,509 @@
+from array import array
+import numpy as np
+from obspy.core.event import (Arrival, Catalog, Event, Magnitude, Origin,
+                              OriginQuality, Pick, WaveformStreamID)
+from obspy.core.utcdatetime import UTCDateTime
+from pickWeight import default_weight
+
+# Line formats of the hypoDD and ph2dt input files, in %-style, so that many
+# lines can be formatted with a single operation.
+HYPOCENTER_FORMAT = ("%8d  %8d %9.4f %10.4f %10.4f %4.1f %7.2f %7.2f %6.2f "
+                     "%10d\n")
+PHASE_HEADER_FORMAT = ("# %4d %2d %2d %2d %2d %5.2f %9.4f %10.4f %10.4f %4.1f "
+                       "%7.2f %7.2f %6.2f %10d\n")
+PHASE_FORMAT = "%-7s %12.6f %7.4f %-1s\n"
+STATION_FORMAT = "%-7s %12.6f %12.6f\n"
+
+# Number of lines formatted per operation.
+FORMAT_CHUNK_SIZE = 50000
+
+# Buffer size of the files written.
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def as_catalog_arrays(catalog, pick_weight=default_weight):
+    """Return catalog as a CatalogArrays, extracting it if needed.
+    """
+    if isinstance(catalog, CatalogArrays):
+        return catalog
+    return CatalogArrays.from_catalog(catalog, pick_weight=pick_weight)
+
+
+def ragged_range(starts, counts):
+    """Concatenate the ranges starts[i]:starts[i]+counts[i].
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    return (np.arange(counts.sum()) -
+            np.repeat(np.cumsum(counts) - counts, counts) +
+            np.repeat(starts, counts))
+
+
+def format_lines(line_format, columns):
+    """Format parallel columns into a list of lines.
+
+    The lines are formatted in chunks, each with a single %-operation on a
+    repeated line format.
+    """
+    nrows = len(columns[0]) if columns else 0
+    lines = []
+    for start in range(0, nrows, FORMAT_CHUNK_SIZE):
+        stop = min(start + FORMAT_CHUNK_SIZE, nrows)
+        block = np.empty((stop - start, len(columns)), dtype=object)
+        for col, column in enumerate(columns):
+            block[:, col] = column[start:stop].tolist()
+        text = (line_format * (stop - start)) % tuple(block.ravel().tolist())
+        lines.extend(text.splitlines(True))
+    return lines
+
+
+def write_blocks(f, headers, lines, offsets):
+    """Write blocks of lines, each preceded by a header line.
+
+    The lines of block i are lines[offsets[i]:offsets[i+1]].
+    """
+    nblocks = len(headers)
+    merged = np.empty(nblocks + len(lines), dtype=object)
+    is_header = np.zeros(len(merged), dtype=bool)
+    is_header[np.asarray(offsets[:nblocks]) + np.arange(nblocks)] = True
+    merged[is_header] = headers
+    merged[~is_header] = lines
+    for start in range(0, len(merged), FORMAT_CHUNK_SIZE):
+        f.write("".join(merged[start:start + FORMAT_CHUNK_SIZE].tolist()))
+
+
+def write_stations(f, coordinates):
+    """Write a station input file ('station.dat').
+
+    Arguments:
+    f: An open file object.
+    coordinates: A dict mapping station codes to (latitude, longitude)
+                 tuples. Stations are written in order of their code.
+    """
+    codes = sorted(coordinates)
+    values = np.array([coordinates[sta][:2] for sta in codes],
+                      dtype=np.float64).reshape(-1, 2)
+    f.write("".join(format_lines(STATION_FORMAT,
+                                 (np.array(codes, dtype=object),
+                                  values[:, 0], values[:, 1]))))
+
+
+class CatalogArrays:
+    """Columnar form of the parts of a Catalog used by ph2dt and hypoDD.
+
+    Events are stored in parallel arrays. The picks of event i are the
+    entries pick_offsets[i]:pick_offsets[i+1] of the pick arrays.
+
+    Attributes:
+    event_ids: The hypoDD IDs of the events.
+    origin_times: Origin times as POSIX timestamps.
+    latitudes, longitudes: Epicenter coordinates in degrees.
+    depths: Hypocenter depths in km.
+    magnitudes: Magnitudes. -9.9 denotes a missing magnitude.
+    horizontal_errors, vertical_errors: Location errors in km.
+    rms: RMS travel time residuals in s.
+    pick_offsets: Offsets of the picks of every event.
+    pick_stations: Index of the station of every pick in stations.
+    pick_phases: Phase of every pick ('P' or 'S').
+    pick_travel_times: Travel time of every pick in s.
+    pick_weights: Weight of every pick [0 - 1 (best)].
+    stations: The station codes referred to by pick_stations.
+    waveform_ids: The distinct (network, station, location, channel) codes
+                  of the picks. Missing codes are given as '*'.
+    Methods:
+    __init__: Initialization method.
+    from_catalog: Extract the arrays from an obspy Catalog.
+    from_reloc: Build the arrays from relocated hypocenters.
+    to_catalog: Convert the arrays back into an obspy Catalog.
+    subset: Select events and their picks.
+    subset_picks: Select picks, keeping all events.
+    concatenate: Join several CatalogArrays.
+    hypoDD_dates, hypoDD_times: Origin times in the hypoDD date/time format.
+    write_hypocenters: Write events in the hypoDD hypocenter format.
+    """
+
+    event_ids = None
+    origin_times = None
+    latitudes = None
+    longitudes = None
+    depths = None
+    magnitudes = None
+    horizontal_errors = None
+    vertical_errors = None
+    rms = None
+    pick_offsets = None
+    pick_stations = None
+    pick_phases = None
+    pick_travel_times = None
+    pick_weights = None
+    stations = []
+    waveform_ids = []
+
+    def __init__(self, event_ids, origin_times, latitudes, longitudes, depths,
+                 magnitudes, horizontal_errors, vertical_errors, rms,
+                 pick_offsets, pick_stations, pick_phases, pick_travel_times,
+                 pick_weights, stations, waveform_ids=()
+                 ):
+        """Initialization method for the CatalogArrays class.
+        """
+        self.event_ids = np.asarray(event_ids, dtype=np.int64)
+        self.origin_times = np.asarray(origin_times, dtype=np.float64)
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+        self.depths = np.asarray(depths, dtype=np.float64)
+        self.magnitudes = np.asarray(magnitudes, dtype=np.float64)
+        self.horizontal_errors = np.asarray(horizontal_errors,
+                                            dtype=np.float64)
+        self.vertical_errors = np.asarray(vertical_errors, dtype=np.float64)
+        self.rms = np.asarray(rms, dtype=np.float64)
+        self.pick_offsets = np.asarray(pick_offsets, dtype=np.int64)
+        self.pick_stations = np.asarray(pick_stations, dtype=np.int32)
+        self.pick_phases = np.asarray(pick_phases, dtype="S1")
+        self.pick_travel_times = np.asarray(pick_travel_times,
+                                            dtype=np.float64)
+        self.pick_weights = np.asarray(pick_weights, dtype=np.float64)
+        self.stations = list(stations)
+        self.waveform_ids = list(waveform_ids)
+
+    def __len__(self):
+        return len(self.event_ids)
+
+    @property
+    def pick_events(self):
+        """Index of the event of every pick.
+        """
+        return np.repeat(np.arange(len(self.event_ids)),
+                         np.diff(self.pick_offsets))
+
+    def subset(self, selection):
+        """Return a CatalogArrays with the selected events and their picks.
+
+        Arguments:
+        selection: Event indices or a boolean mask over the events.
+        """
+        selection = np.asarray(selection)
+        if selection.dtype == bool:
+            selection = np.nonzero(selection)[0]
+        counts = np.diff(self.pick_offsets)[selection]
+        picks = ragged_range(self.pick_offsets[selection], counts)
+        return CatalogArrays(self.event_ids[selection],
+                             self.origin_times[selection],
+                             self.latitudes[selection],
+                             self.longitudes[selection],
+                             self.depths[selection],
+                             self.magnitudes[selection],
+                             self.horizontal_errors[selection],
+                             self.vertical_errors[selection],
+                             self.rms[selection],
+                             np.concatenate(([0], np.cumsum(counts))),
+                             self.pick_stations[picks],
+                             self.pick_phases[picks],
+                             self.pick_travel_times[picks],
+                             self.pick_weights[picks],
+                             self.stations,
+                             self.waveform_ids)
+
+    def subset_picks(self, selection):
+        """Return a CatalogArrays with all events and the selected picks.
+
+        Arguments:
+        selection: A boolean mask over the picks.
+        """
+        selection = np.asarray(selection, dtype=bool)
+        counts = np.bincount(self.pick_events[selection],
+                             minlength=len(self.event_ids))
+        return CatalogArrays(self.event_ids, self.origin_times,
+                             self.latitudes, self.longitudes, self.depths,
+                             self.magnitudes, self.horizontal_errors,
+                             self.vertical_errors, self.rms,
+                             np.concatenate(([0], np.cumsum(counts))),
+                             self.pick_stations[selection],
+                             self.pick_phases[selection],
+                             self.pick_travel_times[selection],
+                             self.pick_weights[selection],
+                             self.stations,
+                             self.waveform_ids)
+
+    def time_fields(self):
+        """Split the origin times into calendar fields.
+
+        Returns the year, month, day, hour, minute and microsecond of the
+        minute, as integer arrays.
+        """
+        microseconds = np.round(self.origin_times * 1.0e6).astype(np.int64)
+        days = (microseconds // 86400000000).astype("M8[D]")
+        years = days.astype("M8[Y]")
+        months = days.astype("M8[M]")
+        minutes = (microseconds % 86400000000) // 60000000
+        return (years.astype(np.int64) + 1970,
+                (months - years).astype(np.int64) + 1,
+                (days - months).astype(np.int64) + 1,
+                minutes // 60,
+                minutes % 60,
+                microseconds % 60000000)
+
+    def hypoDD_dates(self):
+        """Origin dates as YYYYMMDD integers (see time2hypoDDdate).
+        """
+        year, month, day = self.time_fields()[:3]
+        return 10000 * year + 100 * month + day
+
+    def hypoDD_times(self):
+        """Origin times as HHMMSSss integers (see time2hypoDDtime).
+        """
+        hour, minute, microsecond = self.time_fields()[3:]
+        return 1000000 * hour + 10000 * minute + microsecond // 10000
+
+    def write_hypocenters(self, f, selection=None):
+        """Write events in the format of the hypocenter input ('event.dat').
+
+        Arguments:
+        f: An open file object.
+        selection: Indices of the events to write. All events if None.
+        """
+        if selection is None:
+            selection = np.arange(len(self.event_ids))
+        columns = (self.hypoDD_dates()[selection],
+                   self.hypoDD_times()[selection],
+                   self.latitudes[selection],
+                   self.longitudes[selection],
+                   self.depths[selection],
+                   self.magnitudes[selection],
+                   self.horizontal_errors[selection],
+                   self.vertical_errors[selection],
+                   self.rms[selection],
+                   self.event_ids[selection]
+                   )
+        f.write("".join(format_lines(HYPOCENTER_FORMAT, columns)))
+
+    def write_phase_data(self, f):
+        """Write events and picks in the format of the ph2dt input
+        ('phase.dat').
+
+        Every event line is followed by the lines of its picks.
+        """
+        year, month, day, hour, minute, microsecond = self.time_fields()
+        headers = format_lines(PHASE_HEADER_FORMAT,
+                               (year, month, day, hour, minute,
+                                microsecond / 1.0e6,
+                                self.latitudes,
+                                self.longitudes,
+                                self.depths,
+                                self.magnitudes,
+                                self.horizontal_errors,
+                                self.vertical_errors,
+                                self.rms,
+                                self.event_ids
+                                ))
+        stations = np.array(self.stations + [""], dtype=object)
+        picks = format_lines(PHASE_FORMAT,
+                             (stations[self.pick_stations],
+                              self.pick_travel_times,
+                              self.pick_weights,
+                              self.pick_phases.astype(str)
+                              ))
+        write_blocks(f, headers, picks, self.pick_offsets)
+
+    def to_catalog(self):
+        """Convert the arrays back into an obspy Catalog.
+
+        Every pick gets an arrival in the origin, with the pick weight as its
+        time weight. Picks get the first full waveform ID known for their
+        station.
+        """
+        waveform_ids = {}
+        for nslc in self.waveform_ids:
+            codes = [None if code == "*" else code for code in nslc]
+            waveform_ids.setdefault(nslc[1], codes)
+        catalog = Catalog()
+        offsets = self.pick_offsets.tolist()
+        stations = self.pick_stations.tolist()
+        phases = self.pick_phases.astype(str).tolist()
+        travel_times = self.pick_travel_times.tolist()
+        weights = self.pick_weights.tolist()
+        for idx in range(len(self.event_ids)):
+            origin = Origin()
+            origin.time = UTCDateTime(float(self.origin_times[idx]))
+            origin.latitude = float(self.latitudes[idx])
+            origin.longitude = float(self.longitudes[idx])
+            origin.depth = 1000.0 * float(self.depths[idx])  # km to m
+            origin.quality = OriginQuality(
+                                 standard_error=float(self.rms[idx]))
+            event = Event()
+            event.origins = [origin]
+            event.preferred_origin_id = origin.resource_id
+            if self.magnitudes[idx] != -9.9:
+                magnitude = Magnitude(mag=float(self.magnitudes[idx]))
+                event.magnitudes = [magnitude]
+                event.preferred_magnitude_id = magnitude.resource_id
+            for pick_idx in range(offsets[idx], offsets[idx + 1]):
+                sta = self.stations[stations[pick_idx]]
+                network, station, location, channel = waveform_ids.get(
+                                                   sta, (None, sta, None, None))
+                pick = Pick()
+                pick.time = origin.time + travel_times[pick_idx]
+                pick.phase_hint = phases[pick_idx]
+                pick.waveform_id = WaveformStreamID(network, station,
+                                                    location, channel)
+                event.picks.append(pick)
+                origin.arrivals.append(Arrival(pick_id=pick.resource_id,
+                                               phase=phases[pick_idx],
+                                               time_weight=weights[pick_idx]))
+            catalog.events.append(event)
+        return catalog
+
+    @classmethod
+    def concatenate(cls, parts):
+        """Join several CatalogArrays into one.
+
+        The events keep their IDs. The station lists are merged and the
+        station indices of the picks remapped.
+        """
+        stations = []
+        station_index = {}
+        pick_stations = []
+        for part in parts:
+            remap = []
+            for sta in part.stations:
+                idx = station_index.get(sta)
+                if idx is None:
+                    idx = station_index[sta] = len(stations)
+                    stations.append(sta)
+                remap.append(idx)
+            pick_stations.append(np.array(remap + [0],
+                                          dtype=np.int32)[part.pick_stations])
+        counts = np.concatenate([np.diff(part.pick_offsets)
+                                 for part in parts])
+        column = lambda name: np.concatenate([getattr(part, name)
+                                              for part in parts])
+        waveform_ids = set()
+        for part in parts:
+            waveform_ids.update(tuple(nslc) for nslc in part.waveform_ids)
+        return cls(column("event_ids"), column("origin_times"),
+                   column("latitudes"), column("longitudes"),
+                   column("depths"), column("magnitudes"),
+                   column("horizontal_errors"), column("vertical_errors"),
+                   column("rms"), np.concatenate(([0], np.cumsum(counts))),
+                   np.concatenate(pick_stations), column("pick_phases"),
+                   column("pick_travel_times"), column("pick_weights"),
+                   stations, sorted(waveform_ids))
+
+    @classmethod
+    def from_reloc(cls, records, source=None):
+        """Build the arrays from relocated hypocenters.
+
+        Arguments:
+        records: Relocated event records, as returned by
+                 hypoDDoutput.read_reloc.
+        source: The CatalogArrays the relocated events come from. If given,
+                the picks of every event are taken from it, with the travel
+                times referred to the relocated origin time. Raises
+                ValueError if an event is not in source.
+        """
+        from hypoDDoutput import reloc_times
+        origin_times = reloc_times(records)
+        columns = (records["evid"], origin_times, records["lat"],
+                   records["lon"], records["depth"], records["mag"],
+                   np.hypot(records["ex"], records["ey"]) / 1000.0,
+                   records["ez"] / 1000.0, records["rct"] / 1000.0)
+        if source is None:
+            return cls(*(columns + (np.zeros(len(records) + 1), [], [], [],
+                                    [], [], [])))
+        order = np.argsort(source.event_ids)
+        position = np.minimum(np.searchsorted(source.event_ids[order],
+                                              records["evid"]),
+                              max(len(order) - 1, 0))
+        index = order[position] if len(order) else position
+        missing = np.ones(len(records), dtype=bool)
+        if len(order):
+            missing = source.event_ids[index] != records["evid"]
+        if missing.any():
+            raise ValueError("relocated events not in the catalog arrays: "
+                             "{}".format(", ".join(str(evid) for evid in
+                                                   records["evid"][missing]
+                                                   [:10].tolist())))
+        picks = source.subset(index)
+        shift = np.repeat(picks.origin_times - origin_times,
+                          np.diff(picks.pick_offsets))
+        return cls(*(columns + (picks.pick_offsets, picks.pick_stations,
+                                picks.pick_phases,
+                                picks.pick_travel_times + shift,
+                                picks.pick_weights, picks.stations,
+                                picks.waveform_ids)))
+
+    @classmethod
+    def from_catalog(cls, catalog, pick_weight=default_weight):
+        """Extract the arrays from an obspy Catalog.
+
+        The catalog is walked once. Events are numbered from 1, in catalog
+        order, which is the numbering used for the hypoDD input files.
+
+        Arguments:
+        catalog: An obspy Catalog object, or any iterable of events.
+        pick_weight: A function mapping a pick and its arrival in the
+                     preferred origin to a weight (see pickWeight).
+        """
+        origin_times = array("d")
+        latitudes = array("d")
+        longitudes = array("d")
+        depths = array("d")
+        magnitudes = array("d")
+        rms = array("d")
+        pick_offsets = array("l", [0])
+        pick_stations = array("i")
+        pick_phases = []
+        pick_travel_times = array("d")
+        pick_weights = array("d")
+        stations = []
+        station_index = {}
+        waveform_ids = set()
+        for evt in catalog:
+            orig = evt.preferred_origin()
+            origin_time = orig.time
+            origin_times.append(origin_time.timestamp)
+            latitudes.append(orig.latitude)
+            longitudes.append(orig.longitude)
+            depths.append(orig.depth / 1000.0)  # Converting m to km.
+            rms_value = None
+            if orig.quality is not None:
+                rms_value = orig.quality.standard_error
+            rms.append(0.0 if rms_value is None else rms_value)
+            mag = evt.preferred_magnitude()
+            # hypoDD uses 0.0 to denote no magnitude. However, given that
+            # a) hypoDD does not use magnitudes for anything and
+            # b) it is possible to have a magnitude of 0.0 in the catalog
+            # we use the smallest number that fits in the 4.1f format.
+            if mag is None or mag.mag is None:
+                magnitudes.append(-9.9)
+            else:
+                magnitudes.append(mag.mag)
+            # Only kept while the picks of this event are extracted.
+            arrivals = dict((str(arr.pick_id), arr) for arr in orig.arrivals)
+            for pick in evt.picks:
+                wid = pick.waveform_id
+                sta = wid.station_code
+                waveform_ids.add((wid.network_code or "*", sta,
+                                  wid.location_code or "*",
+                                  wid.channel_code or "*"))
+                idx = station_index.get(sta)
+                if idx is None:
+                    idx = station_index[sta] = len(stations)
+                    stations.append(sta)
+                pick_stations.append(idx)
+                pick_phases.append((pick.phase_hint or " ")[0].upper())
+                pick_travel_times.append(pick.time - origin_time)
+                pick_weights.append(pick_weight(
+                                        pick,
+                                        arrivals.get(str(pick.resource_id))))
+            pick_offsets.append(len(pick_stations))
+        nevents = len(origin_times)
+        # TODO (@ogalanis) Currently it assumes that there is no
+        # horizontal and vertical uncertainty information in the catalog
+        # which is true for the KNMI catalog, but not for other
+        # catalogs.
+        # It should be fixed to use this information when available.
+        return cls(np.arange(1, nevents + 1), origin_times, latitudes,
+                   longitudes, depths, magnitudes, np.zeros(nevents),
+                   np.zeros(nevents), rms, pick_offsets, pick_stations,
+                   pick_phases, pick_travel_times, pick_weights, stations,
+                   sorted(waveform_ids))
@@ -1,22 +1,37 @@
 from obspy import Catalog
 
-class Cluster:
+class Cluster(object):
     """ Describe a cluster of events. Like a Catalog with metadata.
 
     Attributes:
         hypoDD_id (int): The ID assigned to the cluster by hypoDD
+        event_ids (array): The hypoDD IDs of the events in this cluster.
         successful_relocation (bool): True if the cluster was successfuly
             relocated by hypoDD. False otherwise.
+        relocations (array): The records of this cluster in the relocated
+            hypocenter output, as returned by hypoDDoutput.read_reloc.
         catalog (Catalog): An obspy Catalog object, containing the events of
-            this cluster.
+            this cluster. When not set explicitly, it is built from the
+            relocations the first time it is accessed.
+        arrays (CatalogArrays): The relocated events of this cluster with
+            their picks, in columnar form.
+        uncertainties (dict): OriginUncertainty objects of the events of
+            this cluster, keyed by hypoDD ID, added to the origins of the
+            catalog. None if the uncertainties have not been estimated.
+        convergence (dict): The convergence curve of this cluster in the
+            iteration log of hypoDD, mapping the fields of its iterations
+            to lists of values (see progressMonitor). None if hypoDD did not
+            report the iterations of this cluster.
     """
 
     hypoDD_id = None
     event_ids = []
     successful_relocation = False
-    catalog = None
+    relocations = None
+    arrays = None
     connectedness = None
-    # TODO (@ogalanis) Add connectedness information
+    uncertainties = None
+    convergence = None
 
     def __init__(self):
         """ Initialization method for Cluster.
@@ -24,8 +39,21 @@ class Cluster:
         self.hypoDD_id = None
         self.event_ids = None
         self.successful_relocation = False
+        self.relocations = None
+        self.arrays = None
         self.catalog = None
         self.connectedness = None
+        self.uncertainties = None
+        self.convergence = None
 
+    @property
+    def catalog(self):
+        if self._catalog is None and self.relocations is not None:
+            from hypoDDoutput import reloc_to_catalog
+            self._catalog = reloc_to_catalog(self.relocations,
+                                             self.uncertainties)
+        return self._catalog
 
-
+    @catalog.setter
+    def catalog(self, catalog):
+        self._catalog = catalog
@@ -0,0 +1,357 @@
+import copy
+import os
+import shutil
+from collections import OrderedDict
+import numpy as np
+from dtFile import read_pair_counts
+from executor import Executor, default_executor
+
+# Maximum number of per-cluster files kept open while splitting the input.
+MAX_OPEN_FILES = 256
+
+
+class UnionFind:
+    """Disjoint sets of the integers 0 to n-1.
+
+    Uses union by size and path halving.
+    """
+
+    parent = None
+    size = None
+
+    def __init__(self, n):
+        """Initialization method for the UnionFind class.
+        """
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, x):
+        """Return the representative of the set of x.
+        """
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        """Merge the sets of a and b.
+        """
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+    def roots(self):
+        """Return the representative of every element as an array.
+        """
+        return np.array([self.find(x) for x in range(len(self.parent))],
+                        dtype=np.int64)
+
+
+class _FileRouter:
+    """Appends lines to many files, keeping a bounded number of them open.
+    """
+
+    def __init__(self, max_open=MAX_OPEN_FILES):
+        self.max_open = max_open
+        self.files = OrderedDict()
+        self.seen = set()
+
+    def write(self, filename, text):
+        f = self.files.pop(filename, None)
+        if f is None:
+            if len(self.files) >= self.max_open:
+                self.files.popitem(last=False)[1].close()
+            f = open(filename, "a" if filename in self.seen else "w")
+            self.seen.add(filename)
+        self.files[filename] = f
+        f.write(text)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+
+class ClusterPartition:
+    """Splits a hypoDD run into independent runs, one per cluster.
+
+    The event pairs linked by at least OBSCC cross correlation or OBSCT
+    catalog observations (their sum when IDAT = 3) form a graph whose
+    connected components, found with union-find, are the hypoDD clusters.
+    Every cluster gets its own workspace with its events, stations and
+    differential times. The hypoDD instances run concurrently and their
+    outputs are merged back into the output files of the main directory.
+    With native_hypoDD, DDSolver relocates the clusters instead, one after
+    the other.
+
+    Attributes:
+    control: A HypoDDControl object describing the hypoDD parameters.
+    directory: The directory holding the hypoDD input files.
+    executable: The name of the hypoDD executable, in directory.
+    processes: Number of concurrent hypoDD runs. None to use the limit of
+               executor.
+    executor: The Executor that runs hypoDD. The process-wide
+              default_executor if None.
+    workspace_prefix: Prefix of the name of the cluster workspaces.
+    native_hypoDD: If True, relocate the clusters with ddSolver.DDSolver
+                   instead of the hypoDD executable.
+    Methods:
+    __init__: Initialization method.
+    partition: Find the clusters.
+    prepare_workspaces: Write the input of every cluster.
+    run_workspaces: Run hypoDD in every workspace.
+    merge: Merge the outputs of the workspaces.
+    run: All of the above.
+    """
+
+    control = None
+    directory = "."
+    executable = "hypoDD"
+    processes = None
+    executor = None
+    workspace_prefix = "cluster_"
+    native_hypoDD = False
+
+    def __init__(self, control, directory=".", executable="hypoDD",
+                 processes=None, workspace_prefix="cluster_", executor=None,
+                 native_hypoDD=False
+                 ):
+        """Initialization method for the ClusterPartition class.
+        """
+        self.control = control
+        self.directory = directory
+        self.executable = executable
+        self.processes = processes
+        self.executor = executor
+        self.workspace_prefix = workspace_prefix
+        self.native_hypoDD = native_hypoDD
+
+    def _path(self, filename):
+        return "{}/{}".format(self.directory, filename)
+
+    def link_pairs(self):
+        """Find the event pairs that link events into clusters.
+
+        Returns an (n, 2) array with the event IDs of the linked pairs.
+        """
+        control = self.control
+        phases = {1: "P", 2: "S"}.get(control.ipha, "PS")
+        counts = []
+        if control.idat in (1, 3) and control.cc_dt_input:
+            counts.append(("cc",) + read_pair_counts(
+                                        self._path(control.cc_dt_input),
+                                        phases))
+        if control.idat in (2, 3) and control.ct_dt_input:
+            counts.append(("ct",) + read_pair_counts(
+                                        self._path(control.ct_dt_input),
+                                        phases))
+        if not counts:
+            return np.zeros((0, 2), dtype=np.int64)
+        pairs = np.sort(np.concatenate([c[1] for c in counts]), axis=1)
+        if len(pairs) == 0:
+            return np.zeros((0, 2), dtype=np.int64)
+        keys, inverse = np.unique(pairs[:, 0] * (pairs.max() + 1) +
+                                  pairs[:, 1], return_inverse=True)
+        unique_pairs = np.zeros((len(keys), 2), dtype=np.int64)
+        unique_pairs[inverse] = pairs
+        totals = {"cc": np.zeros(len(keys)), "ct": np.zeros(len(keys))}
+        start = 0
+        for data_type, type_pairs, type_counts in counts:
+            stop = start + len(type_pairs)
+            totals[data_type] += np.bincount(inverse[start:stop],
+                                             weights=type_counts,
+                                             minlength=len(keys))
+            start = stop
+        if control.idat == 1:
+            linked = totals["cc"] >= max(control.obscc, 1)
+        elif control.idat == 2:
+            linked = totals["ct"] >= max(control.obsct, 1)
+        else:
+            linked = (totals["cc"] + totals["ct"] >=
+                      max(control.obscc + control.obsct, 1))
+        return unique_pairs[linked]
+
+    def partition(self):
+        """Find the clusters of linked events.
+
+        Returns a list of arrays of event IDs, one per cluster of at least
+        two events, largest cluster first.
+        """
+        pairs = self.link_pairs()
+        events, dense = np.unique(pairs, return_inverse=True)
+        dense = dense.reshape(-1, 2)
+        sets = UnionFind(len(events))
+        for first, second in dense.tolist():
+            sets.union(first, second)
+        roots = sets.roots()
+        order = np.argsort(roots, kind="mergesort")
+        bounds = np.nonzero(np.diff(roots[order]))[0] + 1
+        clusters = np.split(events[order], bounds) if len(events) else []
+        clusters.sort(key=lambda ids: (-len(ids), ids[0]))
+        return clusters
+
+    def prepare_workspaces(self, clusters):
+        """Write the input and control files of every cluster.
+
+        Returns the list of workspace directories, in cluster order.
+        """
+        control = self.control
+        cluster_of = {}
+        workspaces = []
+        for idx, ids in enumerate(clusters):
+            workspace = self._path("{}{:04d}".format(self.workspace_prefix,
+                                                     idx + 1))
+            if not os.path.isdir(workspace):
+                os.makedirs(workspace)
+            workspaces.append(workspace)
+            for evid in ids.tolist():
+                cluster_of[evid] = idx
+        print "preparing {} cluster workspaces".format(len(workspaces))
+
+        router = _FileRouter()
+        try:
+            with open(self._path(control.initial_hypocenters), "r") as f:
+                for line in f:
+                    num = line.split()
+                    if not num:
+                        continue
+                    idx = cluster_of.get(int(num[-1]))
+                    if idx is not None:
+                        router.write("{}/{}".format(workspaces[idx],
+                                                    control.initial_hypocenters),
+                                     line)
+            for dt_input in (control.cc_dt_input, control.ct_dt_input):
+                if not dt_input or not os.path.isfile(self._path(dt_input)):
+                    continue
+                target = None
+                with open(self._path(dt_input), "r") as f:
+                    for line in f:
+                        if line.startswith("#"):
+                            num = line[1:].split()
+                            idx = cluster_of.get(int(num[0]))
+                            if idx is None or \
+                               idx != cluster_of.get(int(num[1])):
+                                target = None
+                            else:
+                                target = "{}/{}".format(workspaces[idx],
+                                                        dt_input)
+                        if target is not None:
+                            router.write(target, line)
+        finally:
+            router.close()
+
+        for workspace in workspaces:
+            station_file = "{}/{}".format(workspace, control.station_input)
+            if os.path.exists(station_file):
+                os.remove(station_file)
+            try:
+                os.link(self._path(control.station_input), station_file)
+            except OSError:
+                shutil.copyfile(self._path(control.station_input),
+                                station_file)
+            for dt_input in (control.cc_dt_input, control.ct_dt_input):
+                dt_file = "{}/{}".format(workspace, dt_input)
+                if dt_input and not os.path.exists(dt_file):
+                    open(dt_file, "w").close()
+            workspace_control = copy.copy(control)
+            workspace_control.control_directory = workspace
+            workspace_control.cid = 0
+            workspace_control.evid = []
+            workspace_control.write_control_file()
+        return workspaces
+
+    def run_workspaces(self, workspaces):
+        """Run hypoDD in every workspace, concurrently, or DDSolver one
+        workspace after the other with native_hypoDD.
+
+        Returns the RunResult of every run.
+        """
+        if self.native_hypoDD:
+            # ddSolver imports this module.
+            from ddSolver import run_workspace
+            print "relocating {} clusters with DDSolver".format(
+                                                           len(workspaces))
+            results = []
+            for workspace in workspaces:
+                control = copy.copy(self.control)
+                control.control_directory = workspace
+                control.cid = 0
+                control.evid = []
+                results.append(run_workspace(control, workspace))
+            return results
+        executor = self.executor or default_executor
+        if self.processes is not None:
+            executor = Executor(max_concurrent=self.processes,
+                                timeout=executor.timeout,
+                                memory_limit=executor.memory_limit)
+        print "running hypoDD on {} clusters, {} at a time".format(
+                                                       len(workspaces),
+                                                       executor.max_concurrent
+                                                       )
+        runs = [dict(command=[os.path.abspath(self._path(self.executable)),
+                              self.control.control_file],
+                     cwd=workspace,
+                     log_file="{}/hypoDD.log.out".format(workspace))
+                for workspace in workspaces]
+        try:
+            return executor.run_all(runs)
+        finally:
+            if executor is not self.executor and \
+               executor is not default_executor:
+                executor.close()
+
+    def merge(self, workspaces):
+        """Merge the hypoDD outputs of the workspaces.
+
+        The cluster ID of the relocated (and initial) hypocenters and of the
+        station residuals is set to the index of the workspace, starting
+        from 1. The data residual outputs are concatenated.
+        """
+        control = self.control
+        outputs = [(control.initial_hypocenters_output, True),
+                   (control.relocated_hypocenters_output, True),
+                   (control.station_residual_output, True),
+                   (control.data_residual_output, False)]
+        for output, has_cid in outputs:
+            if not output:
+                continue
+            filenames = [(idx, "{}/{}".format(workspace, output))
+                         for idx, workspace in enumerate(workspaces)]
+            filenames = [(idx, filename) for idx, filename in filenames
+                         if os.path.isfile(filename)]
+            if not filenames:
+                continue
+            print "merging cluster outputs into: {}".format(
+                                                   self._path(output))
+            with open(self._path(output), "w") as merged:
+                for idx, filename in filenames:
+                    with open(filename, "r") as f:
+                        for line_number, line in enumerate(f):
+                            if has_cid:
+                                num = line.rsplit(None, 1)
+                                if len(num) < 2:
+                                    continue
+                                line = "{} {:>4d}\n".format(num[0], idx + 1)
+                            elif line_number == 0 and \
+                                 merged.tell() > 0 and \
+                                 line.lstrip().startswith("STA"):
+                                continue  # Repeated header line.
+                            merged.write(line)
+
+    def run(self):
+        """Partition, run every cluster and merge the outputs.
+
+        Returns the RunResult of every cluster run.
+        """
+        clusters = self.partition()
+        print "found {} clusters".format(len(clusters))
+        workspaces = self.prepare_workspaces(clusters)
+        status = self.run_workspaces(workspaces)
+        self.merge(workspaces)
+        return status
@@ -0,0 +1,211 @@
+"""Export of the hypoDD outputs as typed columns.
+
+Tables are numpy structured arrays, as read by hypoDDoutput, or iterables
+of such arrays for outputs streamed in blocks. They are written to
+compressed npz, Parquet (needs pyarrow) or HDF5 (needs h5py) files.
+
+Event, cluster and station IDs are dictionary encoded: every column of
+DICTIONARY_FIELDS is stored as integer codes into a dictionary shared by
+all the tables, e.g. the 'evid' column of 'reloc' and the 'c1' and 'c2'
+columns of 'res' all index the 'event' dictionary.
+"""
+import os
+import numpy as np
+from hypoDDoutput import iter_outputs
+
+# The dictionary encoded columns and the dictionaries they index.
+DICTIONARY_FIELDS = {"evid": "event",
+                     "c1": "event",
+                     "c2": "event",
+                     "cid": "cluster",
+                     "sta": "station"}
+
+
+class DictionaryEncoder:
+    """Dictionary encoding of the ID columns of many tables and blocks.
+
+    The dictionaries grow as new values are encoded, so that blocks can be
+    encoded as they are streamed and the codes of earlier blocks stay
+    valid.
+
+    Attributes:
+    dictionaries: The values of every dictionary, in code order.
+    Methods:
+    __init__: Initialization method.
+    encode: Return the codes of an array of values.
+    dictionary: Return the values of a dictionary as an array.
+    """
+
+    dictionaries = None
+
+    def __init__(self):
+        """Initialization method for the DictionaryEncoder class.
+        """
+        self.dictionaries = {}
+        self._codes = {}
+
+    def encode(self, kind, values):
+        """Return the int32 codes of values in the dictionary kind.
+        """
+        dictionary = self.dictionaries.setdefault(kind, [])
+        codes = self._codes.setdefault(kind, {})
+        unique, inverse = np.unique(values, return_inverse=True)
+        unique_codes = []
+        for value in unique.tolist():
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(dictionary)
+                dictionary.append(value)
+            unique_codes.append(code)
+        return np.array(unique_codes, dtype=np.int32)[inverse] \
+               if len(unique) else np.zeros(0, dtype=np.int32)
+
+    def dictionary(self, kind):
+        """Return the values of the dictionary kind, in code order.
+        """
+        return np.array(self.dictionaries.get(kind, []))
+
+
+def _chunks(table):
+    if isinstance(table, np.ndarray):
+        return [table]
+    return table
+
+
+def _columns(encoder, chunk):
+    """Return the columns of a block, with the ID columns encoded.
+    """
+    columns = []
+    for name in chunk.dtype.names:
+        values = chunk[name]
+        if name in DICTIONARY_FIELDS:
+            values = encoder.encode(DICTIONARY_FIELDS[name], values)
+        columns.append((name, values))
+    return columns
+
+
+def export_npz(filename, tables):
+    """Write tables to a compressed npz file.
+
+    Arguments:
+    filename: The name of the npz file.
+    tables: A dictionary of tables, keyed by name.
+    The column field of table name is stored as 'name.field', the
+    dictionaries as 'dictionary.kind'.
+    """
+    encoder = DictionaryEncoder()
+    arrays = {}
+    for table_name, table in tables.items():
+        parts = {}
+        for chunk in _chunks(table):
+            for name, values in _columns(encoder, chunk):
+                parts.setdefault(name, []).append(values)
+        for name, values in parts.items():
+            arrays["{}.{}".format(table_name, name)] = np.concatenate(values)
+    for kind in encoder.dictionaries:
+        arrays["dictionary." + kind] = encoder.dictionary(kind)
+    with open(filename, "wb") as f:
+        np.savez_compressed(f, **arrays)
+
+
+def export_parquet(directory, tables, compression="snappy"):
+    """Write tables to Parquet files, one per table, named after it.
+
+    Blocks are written as they are read. ID columns are stored as Arrow
+    dictionary columns.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet export requires pyarrow")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    encoder = DictionaryEncoder()
+    for table_name, table in tables.items():
+        writer = None
+        for chunk in _chunks(table):
+            arrays = []
+            names = []
+            for name, values in _columns(encoder, chunk):
+                if name in DICTIONARY_FIELDS:
+                    dictionary = encoder.dictionary(DICTIONARY_FIELDS[name])
+                    if dictionary.dtype.kind == "S":
+                        dictionary = dictionary.astype(str)
+                    values = pyarrow.DictionaryArray.from_arrays(
+                                 pyarrow.array(values),
+                                 pyarrow.array(dictionary))
+                elif values.dtype.kind == "S":
+                    values = pyarrow.array(values.astype(str))
+                else:
+                    values = pyarrow.array(values)
+                arrays.append(values)
+                names.append(name)
+            batch = pyarrow.Table.from_arrays(arrays, names)
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(
+                             "{}/{}.parquet".format(directory, table_name),
+                             batch.schema, compression=compression)
+            writer.write_table(batch)
+        if writer is not None:
+            writer.close()
+
+
+def export_hdf5(filename, tables, compression="gzip"):
+    """Write tables to an HDF5 file, one group per table.
+
+    Blocks are appended to resizable datasets as they are read. ID columns
+    hold codes and name their dictionary in the 'dictionary' attribute.
+    The dictionaries are written to the 'dictionaries' group.
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("HDF5 export requires h5py")
+    encoder = DictionaryEncoder()
+    with h5py.File(filename, "w") as f:
+        for table_name, table in tables.items():
+            group = f.create_group(table_name)
+            for chunk in _chunks(table):
+                for name, values in _columns(encoder, chunk):
+                    if name not in group:
+                        dataset = group.create_dataset(
+                                      name, shape=(0,), dtype=values.dtype,
+                                      maxshape=(None,), chunks=True,
+                                      compression=compression)
+                        if name in DICTIONARY_FIELDS:
+                            dataset.attrs["dictionary"] = \
+                                DICTIONARY_FIELDS[name]
+                    dataset = group[name]
+                    start = dataset.shape[0]
+                    dataset.resize((start + len(values),))
+                    dataset[start:] = values
+        dictionaries = f.create_group("dictionaries")
+        for kind in encoder.dictionaries:
+            dictionaries.create_dataset(kind, data=encoder.dictionary(kind))
+
+
+# The exporters of every file format.
+EXPORTERS = {"npz": export_npz,
+             "parquet": export_parquet,
+             "hdf5": export_hdf5}
+
+
+def export_outputs(control, filename, file_format="npz", directory=None):
+    """Export all the output files of a hypoDD run.
+
+    The outputs are streamed, so that the data residual output is never
+    held in memory as a whole, except for the npz format.
+
+    Arguments:
+    control: The HypoDDControl object of the run.
+    filename: The output file, or directory for Parquet.
+    file_format: One of 'npz', 'parquet' and 'hdf5'.
+    directory: The directory of the outputs. The control directory of
+               control if None.
+    """
+    if file_format not in EXPORTERS:
+        raise ValueError("unknown export format: {}".format(file_format))
+    tables = dict(iter_outputs(control, directory))
+    print "exporting {} to {}".format(", ".join(sorted(tables)), filename)
+    EXPORTERS[file_format](filename, tables)
@@ -1,5 +1,12 @@
+from collections import defaultdict
+
+
 class Connectedness:
     """ Describe the connectedness of a cluster of events.
+
+    Every list holds [evid_1, evid_2, count] entries, one per linked event
+    pair, with evid_1 < evid_2 and count the number of observations of that
+    type that link the pair.
     """
 
     catalog_P = []
@@ -14,3 +21,58 @@ class Connectedness:
         self.catalog_S = []
         self.cross_corr_P = []
         self.cross_corr_S = []
+
+
+# Data type codes (IDX column) of the hypoDD data residual output.
+RESIDUAL_TYPES = {"1": "cross_corr_P",
+                  "2": "cross_corr_S",
+                  "3": "catalog_P",
+                  "4": "catalog_S"
+                  }
+
+
+def count_residual_pairs(residuals_file):
+    """Count the observations per event pair in a data residual output file.
+
+    The file ('hypoDD.res') is streamed once. Returns a dict mapping every
+    data type code to a dict of {(evid_1, evid_2): count}, with the pair
+    stored in ascending order so that both orders hash to the same entry.
+    """
+    counts = dict((obs_type, defaultdict(int)) for obs_type in RESIDUAL_TYPES)
+    with open(residuals_file, "r") as f:
+        for line in f:
+            num = line.split()
+            if len(num) < 5:
+                continue
+            table = counts.get(num[4])
+            if table is None:
+                continue  # Header line or unknown data type.
+            evid_1 = int(num[2])
+            evid_2 = int(num[3])
+            if evid_1 > evid_2:
+                evid_1, evid_2 = evid_2, evid_1
+            table[(evid_1, evid_2)] += 1
+    return counts
+
+
+def build_connectedness(residuals_file, clusters):
+    """Attach a Connectedness object to every cluster.
+
+    Pairs are assigned to the cluster of their first event. Pairs whose
+    events do not belong to any of the clusters are ignored.
+    """
+    cluster_of = {}
+    for cluster in clusters:
+        cluster.connectedness = Connectedness()
+        for evid in cluster.event_ids:
+            cluster_of[int(evid)] = cluster.connectedness
+    counts = count_residual_pairs(residuals_file)
+    for obs_type, table in counts.items():
+        attribute = RESIDUAL_TYPES[obs_type]
+        for (evid_1, evid_2), count in sorted(table.items()):
+            connectedness = cluster_of.get(evid_1)
+            if connectedness is None:
+                connectedness = cluster_of.get(evid_2)
+            if connectedness is None:
+                continue
+            getattr(connectedness, attribute).append([evid_1, evid_2, count])
@@ -0,0 +1,412 @@
+import multiprocessing
+import numpy as np
+from obspy import Trace, UTCDateTime
+from obspy.core.event import Pick, WaveformStreamID
+from hypoDDcontrol import HypoDDControl
+from ph2dtControl import Ph2dtControl
+from ph2dt import Ph2dt
+from catalogArrays import CatalogArrays
+from dtFile import read_pairs, DT_CC_HEADER_FORMAT, DT_CC_FORMAT
+
+# Number of correlations computed per work unit.
+BATCH_SIZE = 4096
+
+# State shared with the worker processes, which inherit it when forked.
+_cc_state = {}
+
+
+def _next_power_of_two(n):
+    return 1 << int(np.ceil(np.log2(max(n, 1))))
+
+
+def _correlate_batch(task):
+    """Cross-correlate a batch of window pairs of the same window group.
+
+    The correlation of every pair is the inverse FFT of the product of the
+    precomputed window spectra. The peak is refined by fitting a parabola
+    through it and its two neighbours. Returns the correlation coefficients
+    and the lags in samples, positive when the second window is delayed.
+    """
+    group, first, second = task
+    spectra = _cc_state["spectra"][group]
+    nfft = _cc_state["nfft"][group]
+    max_lag = _cc_state["max_lag"][group]
+    cc = np.fft.irfft(np.conj(spectra[first]) * spectra[second], n=nfft,
+                      axis=1)
+    cc = np.hstack((cc[:, nfft - max_lag:], cc[:, :max_lag + 1]))
+    rows = np.arange(len(cc))
+    peak = np.argmax(cc, axis=1)
+    inner = (peak > 0) & (peak < cc.shape[1] - 1)
+    shift = np.zeros(len(cc))
+    y0 = cc[rows[inner], peak[inner] - 1]
+    y1 = cc[rows[inner], peak[inner]]
+    y2 = cc[rows[inner], peak[inner] + 1]
+    curvature = y0 - 2.0 * y1 + y2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        shift[inner] = np.where(curvature < 0.0,
+                                0.5 * (y0 - y2) / curvature, 0.0)
+    coefficient = np.clip(cc[rows, peak], -1.0, 1.0)
+    return coefficient, peak - max_lag + shift
+
+
+class CrossCorrelator:
+    """Computes the cross correlation differential time input ('dt.cc').
+
+    P and S windows are cut around the picks of every event, so that each
+    waveform is fetched and transformed only once, however many pairs it
+    appears in. The correlations of all pairs are computed in batches of
+    FFTs of a common length on a pool of worker processes.
+
+    Attributes:
+    catalog: An obspy Catalog object with the events and their picks, or a
+             CatalogArrays object, whose picks get the first full waveform
+             ID known for their station.
+    client: An object with a get_waveforms method (e.g. an obspy Client),
+            providing the waveforms.
+    waveform_cache: A WaveformCache object. If set, waveforms are read from
+                    it, after it has been filled in bulk from its client.
+    control: A HypoDDControl object. Pairs with fewer than obscc
+             observations are not written.
+    output_directory: The directory where the output file is written.
+    catalog_cc_output: The name of the output file ('dt.cc').
+    p_window, s_window: Seconds before and after the pick of the P and S
+                        windows.
+    max_lag: Maximum lag in seconds searched for the correlation peak.
+    min_cc: Minimum correlation coefficient of an observation.
+    freqmin, freqmax: Corners of the bandpass filter applied before the
+                      windows are cut. None for no filtering.
+    processes: Number of worker processes. None to use all cores.
+    Methods:
+    __init__: Initialization method.
+    load_windows: Fetch the windows needed for a set of event pairs.
+    correlate: Cross-correlate the windows of a set of event pairs.
+    run: Compute and write the differential times.
+    """
+
+    catalog = None
+    client = None
+    waveform_cache = None
+    control = None
+    output_directory = "."
+    catalog_cc_output = "dt.cc"
+    p_window = (0.1, 0.5)
+    s_window = (0.2, 1.0)
+    max_lag = 0.3
+    min_cc = 0.7
+    freqmin = None
+    freqmax = None
+    processes = None
+
+    def __init__(self, catalog, client, control=None, output_directory=".",
+                 catalog_cc_output="dt.cc", p_window=(0.1, 0.5),
+                 s_window=(0.2, 1.0), max_lag=0.3, min_cc=0.7, freqmin=None,
+                 freqmax=None, processes=None, waveform_cache=None
+                 ):
+        """Initialization method for the CrossCorrelator class.
+        """
+        self.catalog = catalog
+        self.client = client
+        self.waveform_cache = waveform_cache
+        if control is None:
+            control = HypoDDControl()
+        self.control = control
+        self.output_directory = output_directory
+        self.catalog_cc_output = catalog_cc_output
+        self.p_window = p_window
+        self.s_window = s_window
+        self.max_lag = max_lag
+        self.min_cc = min_cc
+        self.freqmin = freqmin
+        self.freqmax = freqmax
+        self.processes = processes
+
+    def _picks(self):
+        """Map (event index, station, phase) to the pick, the origin time
+        and the resource ID of the event.
+        """
+        if isinstance(self.catalog, CatalogArrays):
+            return self._array_picks()
+        picks = {}
+        for idx, evt in enumerate(self.catalog):
+            orig = evt.preferred_origin()
+            for pick in evt.picks:
+                phase = (pick.phase_hint or " ")[0].upper()
+                if phase not in ("P", "S"):
+                    continue
+                key = (idx, pick.waveform_id.station_code, phase)
+                if key not in picks:
+                    picks[key] = (pick, orig.time, str(evt.resource_id))
+        return picks
+
+    def _array_picks(self):
+        """The picks of _picks, built from CatalogArrays.
+
+        Events are identified by their hypoDD ID.
+        """
+        arrays = self.catalog
+        waveform_ids = {}
+        for nslc in arrays.waveform_ids:
+            codes = [None if code == "*" else code for code in nslc]
+            waveform_ids.setdefault(nslc[1], codes)
+        offsets = arrays.pick_offsets.tolist()
+        stations = arrays.pick_stations.tolist()
+        phases = arrays.pick_phases.astype(str).tolist()
+        travel_times = arrays.pick_travel_times.tolist()
+        picks = {}
+        for idx, evid in enumerate(arrays.event_ids.tolist()):
+            origin_time = UTCDateTime(float(arrays.origin_times[idx]))
+            for pick_idx in range(offsets[idx], offsets[idx + 1]):
+                phase = (phases[pick_idx] or " ")[0].upper()
+                if phase not in ("P", "S"):
+                    continue
+                sta = arrays.stations[stations[pick_idx]]
+                key = (idx, sta, phase)
+                if key in picks:
+                    continue
+                network, station, location, channel = waveform_ids.get(
+                                               sta, (None, sta, None, None))
+                pick = Pick(time=origin_time + travel_times[pick_idx],
+                            phase_hint=phase,
+                            waveform_id=WaveformStreamID(network, station,
+                                                         location, channel))
+                picks[key] = (pick, origin_time, str(evid))
+        return picks
+
+    def _request(self, pick, phase):
+        """The waveform segment needed for the window of a pick.
+
+        The segment is padded on both sides, so that filtering does not
+        affect the window. Returns (network, station, location, channel,
+        starttime, endtime).
+        """
+        before, after = self.p_window if phase == "P" else self.s_window
+        pad = 1.0 / self.freqmin if self.freqmin else 1.0
+        wid = pick.waveform_id
+        return (wid.network_code or "*", wid.station_code,
+                wid.location_code or "", wid.channel_code or "*",
+                pick.time - before - pad, pick.time + after + pad)
+
+    def _cut(self, tr, pick, phase):
+        """Cut the window of a pick from a segment as a float64 array.
+
+        Returns the samples and the sampling rate, or None if the segment
+        does not cover the window.
+        """
+        before, after = self.p_window if phase == "P" else self.s_window
+        if self.freqmin and self.freqmax:
+            tr = Trace(data=np.array(tr.data, dtype=np.float64),
+                       header=tr.stats)
+            tr.detrend("demean")
+            tr.filter("bandpass", freqmin=self.freqmin, freqmax=self.freqmax,
+                      zerophase=True)
+        sampling_rate = tr.stats.sampling_rate
+        npts = int(round((before + after) * sampling_rate)) + 1
+        first = int(round((pick.time - before - tr.stats.starttime) *
+                          sampling_rate))
+        if first < 0 or first + npts > tr.stats.npts:
+            return None
+        return (np.array(tr.data[first:first + npts], dtype=np.float64),
+                sampling_rate)
+
+    def load_windows(self, pairs):
+        """Fetch the windows of the observations common to event pairs.
+
+        With a waveform cache, the missing segments are first added to the
+        cache in bulk and all windows are then read from it. Otherwise every
+        segment is requested from the client.
+
+        Arguments:
+        pairs: An (n, 2) array of event indices into the catalog.
+        Returns a dict mapping (event index, station, phase) to (samples,
+        sampling rate) and a dict mapping the same keys to travel times.
+        """
+        picks = self._picks()
+        by_event = {}
+        for key in picks:
+            by_event.setdefault(key[0], set()).add(key[1:])
+        needed = set()
+        for first, second in pairs.tolist():
+            common = by_event.get(first, set()) & by_event.get(second, set())
+            for obs in common:
+                needed.add((first,) + obs)
+                needed.add((second,) + obs)
+        needed = sorted(needed)
+        print "fetching {} waveform windows".format(len(needed))
+        cache = self.waveform_cache
+        if cache is not None:
+            requests = []
+            for key in needed:
+                pick, origin_time, event = picks[key]
+                request = self._request(pick, key[2])
+                requests.append(request[:4] + (event,) + request[4:])
+            cache.fill(requests)
+        windows = {}
+        travel_times = {}
+        for key in needed:
+            pick, origin_time, event = picks[key]
+            request = self._request(pick, key[2])
+            if cache is not None:
+                tr = cache.get_trace(*(request[:4] + (event,)))
+            else:
+                try:
+                    st = self.client.get_waveforms(*request)
+                except Exception:
+                    st = []
+                tr = st[0] if len(st) else None
+            if tr is None:
+                continue
+            window = self._cut(tr, pick, key[2])
+            if window is not None:
+                windows[key] = window
+                travel_times[key] = pick.time - origin_time
+        return windows, travel_times
+
+    def correlate(self, pairs, windows):
+        """Cross-correlate the windows of the observations of event pairs.
+
+        Windows are grouped by phase, length and sampling rate. The spectrum
+        of every window is computed once per group.
+        Returns a list of (pair index, station, phase, coefficient, lag in
+        seconds) tuples.
+        """
+        groups = {}
+        for key, (data, sampling_rate) in windows.items():
+            group = groups.setdefault((key[2], len(data), sampling_rate), [])
+            group.append(key)
+        groups = sorted(groups.items())
+        index = {}
+        spectra = []
+        nffts = []
+        max_lags = []
+        for gid, ((phase, npts, sampling_rate), keys) in enumerate(groups):
+            max_lag = min(int(round(self.max_lag * sampling_rate)), npts - 1)
+            nfft = _next_power_of_two(npts + max_lag)
+            data = np.array([windows[key][0] for key in keys])
+            data -= data.mean(axis=1)[:, np.newaxis]
+            norm = np.sqrt((data ** 2).sum(axis=1))
+            norm[norm == 0.0] = 1.0
+            spectra.append(np.fft.rfft(data / norm[:, np.newaxis], n=nfft,
+                                       axis=1))
+            nffts.append(nfft)
+            max_lags.append(max_lag)
+            for row, key in enumerate(keys):
+                index[key] = (gid, row)
+
+        tasks = dict((gid, ([], [], [])) for gid in range(len(spectra)))
+        observations = {}
+        for key in windows:
+            observations.setdefault(key[0], []).append(key[1:])
+        for pid, (first, second) in enumerate(pairs.tolist()):
+            for station, phase in observations.get(first, []):
+                other = index.get((second, station, phase))
+                if other is None:
+                    continue
+                gid, row = index[(first, station, phase)]
+                if other[0] != gid:
+                    continue  # Different sampling rates or window lengths.
+                tasks[gid][0].append(pid)
+                tasks[gid][1].append((row, other[1]))
+                tasks[gid][2].append((station, phase))
+
+        batches = []
+        for gid, (pids, rows, obs) in tasks.items():
+            rows = np.array(rows, dtype=np.int64).reshape(-1, 2)
+            for start in range(0, len(pids), BATCH_SIZE):
+                batches.append((gid, start, rows[start:start + BATCH_SIZE]))
+        _cc_state.clear()
+        _cc_state.update(spectra=spectra, nfft=nffts, max_lag=max_lags)
+        work = [(gid, rows[:, 0], rows[:, 1]) for gid, start, rows in batches]
+        try:
+            if len(work) > 1 and self.processes != 1:
+                pool = multiprocessing.Pool(self.processes)
+                try:
+                    results = pool.map(_correlate_batch, work)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [_correlate_batch(task) for task in work]
+        finally:
+            _cc_state.clear()
+
+        correlations = []
+        for (gid, start, rows), (coefficient, lag) in zip(batches, results):
+            pids, _, obs = tasks[gid]
+            sampling_rate = groups[gid][0][2]
+            for k in range(len(rows)):
+                station, phase = obs[start + k]
+                correlations.append((pids[start + k], station, phase,
+                                     float(coefficient[k]),
+                                     float(lag[k]) / sampling_rate))
+        return correlations
+
+    def run(self, pairs_input=None, pairs=None, maxsep=None):
+        """Compute the cross correlation differential times and write them.
+
+        Arguments:
+        pairs_input: A differential time file ('dt.ct') to take the event
+                     pairs from.
+        pairs: An (n, 2) array of hypoDD event IDs, used if pairs_input is
+               None.
+        maxsep: If both of the above are None, all pairs of catalog events
+                closer than maxsep km are correlated. Defaults to the
+                Ph2dtControl default.
+        The hypoDD IDs are those of the CatalogArrays, or the positions of
+        the events in an obspy Catalog, from 1. Pairs of unknown events are
+        skipped.
+        """
+        print "running waveform cross correlation"
+        if isinstance(self.catalog, CatalogArrays):
+            event_ids = self.catalog.event_ids
+        else:
+            event_ids = np.arange(1, len(self.catalog) + 1, dtype=np.int64)
+        if pairs_input is not None:
+            pairs = read_pairs(pairs_input)
+        if pairs is None:
+            control = Ph2dtControl()
+            if maxsep is not None:
+                control.maxsep = maxsep
+            arrays = self.catalog
+            if not isinstance(arrays, CatalogArrays):
+                arrays = CatalogArrays.from_catalog(arrays)
+            ph2dt = Ph2dt(arrays, {}, control)
+            pairs = event_ids[ph2dt.candidate_pairs()[0]]
+        # Map the IDs to the positions of the events.
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        order = np.argsort(event_ids, kind="mergesort")
+        position = np.minimum(np.searchsorted(event_ids[order], pairs),
+                              max(len(order) - 1, 0))
+        if len(order):
+            known = (event_ids[order][position] == pairs).all(axis=1)
+            pairs = order[position[known]].reshape(-1, 2)
+        else:
+            pairs = np.zeros((0, 2), dtype=np.int64)
+        windows, travel_times = self.load_windows(pairs)
+        correlations = self.correlate(pairs, windows)
+
+        links = {}
+        for pid, station, phase, coefficient, lag in correlations:
+            if coefficient < self.min_cc:
+                continue
+            first, second = pairs[pid]
+            dt = (travel_times[(first, station, phase)] -
+                  travel_times[(second, station, phase)] - lag)
+            links.setdefault(pid, []).append((station, dt, coefficient,
+                                              phase))
+        min_links = max(self.control.obscc, 1)
+        full_filename = "{}/{}".format(self.output_directory,
+                                       self.catalog_cc_output
+                                       )
+        print "writing cross correlation differential time file: {}".format(
+                                                                full_filename
+                                                                )
+        with open(full_filename, "w") as f:
+            for pid in sorted(links):
+                if len(links[pid]) < min_links:
+                    continue
+                first, second = pairs[pid]
+                lines = [DT_CC_HEADER_FORMAT % (event_ids[first],
+                                                event_ids[second], 0.0)]
+                for obs in sorted(links[pid]):
+                    lines.append(DT_CC_FORMAT % obs)
+                f.write("".join(lines))
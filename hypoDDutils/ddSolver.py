@@ -0,0 +1,616 @@
+"""Double-difference relocation in Python, without the hypoDD binary.
+
+The same inputs and control parameters as hypoDD are used: the initial
+hypocenters, the stations and the catalog and cross correlation
+differential times, clustered with OBSCC/OBSCT. Every cluster is relocated
+by iterating over the weighting schedule of the control: the travel times
+and their derivatives are computed by ray tracing through the layered
+velocity model, the weighted double-difference system is built as a sparse
+matrix with four unknowns per event (the three coordinates and the origin
+time), and it is solved with damped LSQR (ISOLV = 2) or SVD (ISOLV = 1).
+There is no limit on the number of events, data or stations.
+
+The weighting follows hypoDD: the a priori weight of every observation is
+its quality in the input (the weight of 'dt.ct', the coefficient of
+'dt.cc') times the weight of its data type and phase. WDCC/WDCT taper the
+weights of event pairs with the inter-event distance and cut them off at
+that distance. WRCC/WRCT cut off the residuals above a threshold in s
+(below 1) or above a multiple of their spread (1 and above), with a
+bi-weight taper. As in hypoDD, the mean shift of every cluster is
+constrained to zero and events that move above the surface (air quakes)
+are removed.
+"""
+import time
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.linalg import lsqr
+from clusterPartition import ClusterPartition
+from dtFile import DifferentialTimes
+from executor import RunResult
+from hypoDDlog import CLUSTER_FORMAT, ITERATION_HEADER, format_iteration
+from hypoDDoutput import RELOC_DTYPE, RES_DTYPE, write_reloc, write_res
+from ph2dt import read_station_input
+from tiling import KM_PER_DEGREE
+from travelTime import first_arrivals, layer_velocities
+
+# Column layout of the initial hypocenter input ('event.dat').
+HYPOCENTER_DTYPE = np.dtype([("date", np.int64),
+                             ("time", np.int64),
+                             ("lat", np.float64),
+                             ("lon", np.float64),
+                             ("depth", np.float64),
+                             ("mag", np.float64),
+                             ("eh", np.float64),
+                             ("ez", np.float64),
+                             ("rms", np.float64),
+                             ("id", np.int64)
+                             ])
+
+# Unknowns per event: the shifts east, north and down and of the origin time.
+UNKNOWNS = 4
+
+# Origin time correction of 'dt.cc' marking an unknown correction.
+UNKNOWN_OTC = -999.0
+
+# Ratio of the median absolute deviation to the standard deviation of a
+# normal distribution.
+MAD_TO_STD = 0.67449
+
+
+def read_hypocenter_input(filename):
+    """Read an initial hypocenter input file ('event.dat').
+
+    Returns a numpy structured array with the fields of HYPOCENTER_DTYPE.
+    """
+    return np.atleast_1d(np.loadtxt(filename, dtype=HYPOCENTER_DTYPE,
+                                    ndmin=1))
+
+
+def hypocenter_times(records):
+    """Return the origin times of initial hypocenters as POSIX timestamps.
+    """
+    months = (12 * (records["date"] // 10000 - 1970) +
+              (records["date"] // 100) % 100 - 1)
+    days = (months.astype("M8[M]").astype("M8[D]") +
+            (records["date"] % 100 - 1).astype("m8[D]"))
+    return (days.astype(np.int64) * 86400 +
+            3600 * (records["time"] // 1000000) +
+            60 * ((records["time"] // 10000) % 100) +
+            (records["time"] % 10000) / 100.0)
+
+
+def _time_fields(timestamps):
+    """Split POSIX timestamps into the date and time fields of
+    'hypoDD.reloc'.
+    """
+    days = np.floor(timestamps / 86400.0).astype(np.int64)
+    dates = days.astype("M8[D]")
+    months = dates.astype("M8[M]")
+    seconds = timestamps - 86400.0 * days
+    hours = (seconds // 3600).astype(np.int64)
+    minutes = ((seconds - 3600 * hours) // 60).astype(np.int64)
+    return (dates.astype("M8[Y]").astype(np.int64) + 1970,
+            months.astype(np.int64) % 12 + 1,
+            (dates - months.astype("M8[D]")).astype(np.int64) + 1,
+            hours, minutes, seconds - 3600 * hours - 60 * minutes)
+
+
+class DDSolver:
+    """In-process double-difference relocation of the hypoDD inputs.
+
+    Attributes:
+    control: A HypoDDControl object describing the hypoDD parameters.
+    directory: The directory holding the hypoDD input files.
+    travel_time_table: A TravelTimeTable of the velocity model of control,
+                       to interpolate the travel times from. None to trace
+                       every ray.
+    iterations: The iterations of every cluster, as dictionaries with the
+                fields of hypoDDlog.ITERATION_FIELDS and the cluster.
+    relocations: The relocated events, with the fields of
+                 hypoDDoutput.RELOC_DTYPE.
+    residuals: The observations of the relocated clusters and their final
+               residuals and weights, with the fields of
+               hypoDDoutput.RES_DTYPE.
+    monitor: A callable called with the cluster and iteration lines of the
+             log as they are produced, e.g. a progressMonitor.ProgressMonitor.
+             If it returns True, the iterations stop: the current cluster is
+             finished at its last position and the remaining clusters are
+             skipped. None to not follow the run.
+    stopped: True if the last run was stopped by monitor.
+    Methods:
+    __init__: Initialization method.
+    read_inputs: Read the hypocenters, stations and differential times.
+    relocate_cluster: Relocate the events of a cluster.
+    run: Relocate all clusters and write the outputs.
+    write_outputs: Write the outputs in the formats of hypoDD.
+    """
+
+    control = None
+    directory = "."
+    travel_time_table = None
+    iterations = None
+    relocations = None
+    residuals = None
+    monitor = None
+    stopped = False
+
+    def __init__(self, control, directory=".", travel_time_table=None,
+                 monitor=None):
+        """Initialization method for the DDSolver class.
+        """
+        self.control = control
+        self.directory = directory
+        self.travel_time_table = travel_time_table
+        self.iterations = []
+        self.relocations = None
+        self.residuals = None
+        self.monitor = monitor
+        self.stopped = False
+        self._log = []
+
+    def _path(self, filename):
+        return "{}/{}".format(self.directory, filename)
+
+    def read_inputs(self):
+        """Read the hypocenters, stations and differential times.
+
+        Observations of unknown events or stations, of phases excluded by
+        IPHA and of data types excluded by IDAT are dropped.
+        """
+        control = self.control
+        self.events = read_hypocenter_input(self._path(
+                                                control.initial_hypocenters))
+        order = np.argsort(self.events["id"], kind="mergesort")
+        self.events = self.events[order]
+        coordinates = read_station_input(self._path(control.station_input))
+        self.station_names = np.array(sorted(coordinates), dtype="S7")
+        self.station_coordinates = np.array(
+            [coordinates[name] for name in sorted(coordinates)],
+            dtype=np.float64).reshape(-1, 2)
+
+        parts = []
+        for cross_correlation, filename, types in (
+                (True, control.cc_dt_input, (1, 3)),
+                (False, control.ct_dt_input, (2, 3))):
+            if not filename or control.idat not in types:
+                continue
+            times = DifferentialTimes.read(self._path(filename))
+            counts = np.diff(times.offsets)
+            pairs = np.repeat(times.pairs, counts, axis=0)
+            if cross_correlation:
+                otc = np.repeat(times.origin_corrections, counts)
+                dt = times.values[:, 0] - np.where(otc == UNKNOWN_OTC, 0.0,
+                                                   otc)
+                quality = times.values[:, 1]
+            else:
+                dt = times.values[:, 0] - times.values[:, 1]
+                quality = times.values[:, 2]
+            parts.append((pairs, times.stations, times.phases, dt, quality,
+                          np.repeat(cross_correlation, len(dt))))
+        if parts:
+            pairs, stations, phases, dt, quality, cc = [
+                np.concatenate(columns) for columns in zip(*parts)]
+        else:
+            pairs = np.zeros((0, 2), dtype=np.int64)
+            stations = np.zeros(0, dtype="S7")
+            phases = np.zeros(0, dtype="S1")
+            dt = quality = np.zeros(0)
+            cc = np.zeros(0, dtype=bool)
+
+        first = np.clip(np.searchsorted(self.events["id"], pairs[:, 0]),
+                        0, len(self.events) - 1)
+        second = np.clip(np.searchsorted(self.events["id"], pairs[:, 1]),
+                         0, len(self.events) - 1)
+        station = np.clip(np.searchsorted(self.station_names, stations),
+                          0, max(len(self.station_names) - 1, 0))
+        keep = ((self.events["id"][first] == pairs[:, 0]) &
+                (self.events["id"][second] == pairs[:, 1]) &
+                (self.station_names[station] == stations))
+        phases = np.where(phases == b"P", 0, np.where(phases == b"S", 1, -1))
+        if control.ipha == 1:
+            keep &= phases == 0
+        elif control.ipha == 2:
+            keep &= phases == 1
+        else:
+            keep &= phases >= 0
+        self.first = first[keep]
+        self.second = second[keep]
+        self.station = station[keep]
+        self.phase = phases[keep]
+        self.dt = dt[keep]
+        self.quality = quality[keep]
+        self.cross_correlation = cc[keep]
+
+    def _rays(self, event_x, event_y, event_z, station_x, station_y, phase):
+        """Travel times and their derivatives with respect to the event
+        coordinates (km), for every observation.
+        """
+        dx = event_x - station_x
+        dy = event_y - station_y
+        distance = np.hypot(dx, dy)
+        times = np.zeros(len(distance))
+        angles = np.zeros(len(distance))
+        horizontal = np.zeros(len(distance))
+        vertical = np.zeros(len(distance))
+        for code, name in ((0, "P"), (1, "S")):
+            rows = phase == code
+            if not rows.any():
+                continue
+            if self.travel_time_table is not None:
+                arrivals = self.travel_time_table.lookup(distance[rows],
+                                                         event_z[rows], name)
+            else:
+                tops, velocities = layer_velocities(
+                                       self.control.velocity_model, name)
+                arrivals = first_arrivals(tops, velocities, distance[rows],
+                                          event_z[rows])
+            (times[rows], angles[rows], horizontal[rows],
+             vertical[rows]) = arrivals
+        along = horizontal / np.where(distance > 0, distance, 1.0)
+        return times, along * dx, along * dy, -vertical
+
+    def _weights(self, weight, cc, residuals, separations, apriori):
+        """Apply the distance and residual weighting of a Weight to the a
+        priori weights of the observations.
+        """
+        weights = apriori.copy()
+        for selection, wd, wr in ((cc, weight.wdcc, weight.wrcc),
+                                  (~cc, weight.wdct, weight.wrct)):
+            if wd > 0:
+                taper = np.clip(1.0 - (separations[selection] / wd) ** 3,
+                                0.0, None) ** 3
+                weights[selection] *= taper
+            used = selection & (weights > 0)
+            if wr > 0 and used.any():
+                if wr < 1:
+                    cutoff = wr
+                else:
+                    median = np.median(residuals[used])
+                    cutoff = wr * np.median(np.abs(residuals[used] -
+                                                   median)) / MAD_TO_STD
+                cutoff = max(cutoff, 1e-6)
+                taper = np.clip(1.0 - (residuals[selection] / cutoff) ** 2,
+                                0.0, None) ** 2
+                weights[selection] *= taper
+        return weights
+
+    def _solve(self, rows, columns, values, residuals, nunknowns, damp):
+        """Solve the weighted system.
+
+        Returns the model, the variances of the unknowns and the condition
+        number.
+        """
+        nrows = rows.max() + 1 if len(rows) else 0
+        # As in hypoDD, every column is scaled to unit RMS over the data, so
+        # that the damping is relative to the size of the system.
+        norms = np.sqrt(np.bincount(columns, weights=values ** 2,
+                                    minlength=nunknowns) / max(nrows, 1))
+        has_data = norms.reshape(-1, UNKNOWNS)[:, 0] > 0
+        norms[norms == 0] = 1.0
+        values = values / norms[columns]
+        # Constrain the mean shift of the events with data to zero. Every
+        # constraint row weighs as much as all the data rows together, so
+        # that the centroid of the cluster stays where it is.
+        events = np.nonzero(has_data)[0]
+        constraint_rows = []
+        constraint_columns = []
+        for unknown in range(UNKNOWNS):
+            constraint_rows.append(np.repeat(nrows + unknown, len(events)))
+            constraint_columns.append(UNKNOWNS * events + unknown)
+        constraint_rows = np.concatenate(constraint_rows)
+        constraint_columns = np.concatenate(constraint_columns)
+        constraint_values = (np.sqrt(nrows) *
+                             np.mean(norms.reshape(-1, UNKNOWNS)[events],
+                                     axis=0)[constraint_columns % UNKNOWNS] /
+                             norms[constraint_columns])
+        matrix = coo_matrix((np.concatenate((values, constraint_values)),
+                             (np.concatenate((rows, constraint_rows)),
+                              np.concatenate((columns, constraint_columns)))),
+                            shape=(nrows + UNKNOWNS, nunknowns)).tocsr()
+        data = np.concatenate((residuals, np.zeros(UNKNOWNS)))
+        if self.control.isolv == 1:
+            u, s, vt = np.linalg.svd(matrix.toarray(), full_matrices=False)
+            keep = s > s.max() * 1e-10
+            model = vt[keep].T.dot(u[:, keep].T.dot(data) / s[keep])
+            variances = (vt[keep].T ** 2 / s[keep] ** 2).sum(axis=1)
+            condition = s.max() / s[keep].min()
+        else:
+            result = lsqr(matrix, data, damp=damp, atol=1e-6, btol=1e-6,
+                          calc_var=True)
+            model = result[0]
+            condition = result[6]
+            variances = result[9]
+        return model / norms, variances / norms ** 2, condition
+
+    def relocate_cluster(self, number, events):
+        """Relocate the events of a cluster.
+
+        Arguments:
+        number: The number of the cluster, written in the outputs.
+        events: Indices of the events of the cluster in events.
+        Returns the relocated events and the observations with their final
+        residuals, as records of RELOC_DTYPE and RES_DTYPE.
+        """
+        control = self.control
+        n = len(events)
+        local = -np.ones(len(self.events), dtype=np.int64)
+        local[events] = np.arange(n)
+        hypocenters = self.events[events]
+        lat0 = hypocenters["lat"].mean()
+        lon0 = hypocenters["lon"].mean()
+        scale = KM_PER_DEGREE * np.cos(np.radians(lat0))
+        x = (hypocenters["lon"] - lon0) * scale
+        y = (hypocenters["lat"] - lat0) * KM_PER_DEGREE
+        z = hypocenters["depth"].copy()
+        x0, y0, z0 = x.mean(), y.mean(), z.mean()
+        shifts = np.zeros(n)
+        station_x = (self.station_coordinates[:, 1] - lon0) * scale
+        station_y = (self.station_coordinates[:, 0] - lat0) * KM_PER_DEGREE
+
+        rows = np.nonzero((local[self.first] >= 0) &
+                          (local[self.second] >= 0))[0]
+        rows = rows[np.hypot(station_x[self.station[rows]],
+                             station_y[self.station[rows]]) <= control.dist]
+        first = local[self.first[rows]]
+        second = local[self.second[rows]]
+        station = self.station[rows]
+        phase = self.phase[rows]
+        cc = self.cross_correlation[rows]
+        active = np.ones(n, dtype=bool)
+        print "relocating cluster {}: {} events, {} observations".format(
+                                                          number, n, len(rows))
+        for line in (CLUSTER_FORMAT.format(number), ITERATION_HEADER):
+            self._log.append(line)
+            if self.monitor is not None:
+                self.monitor(line)
+
+        iteration = 0
+        previous = {}
+        weights = np.zeros(len(rows))
+        variances = np.zeros(UNKNOWNS * n)
+        for weight in control.weights:
+            apriori = self.quality[rows] * np.where(
+                cc, np.where(phase == 0, weight.wtccp, weight.wtccs),
+                np.where(phase == 0, weight.wtctp, weight.wtcts))
+            apriori = np.clip(apriori, 0.0, None)
+            for step in range(weight.niter):
+                iteration += 1
+                times_1, dx_1, dy_1, dz_1 = self._rays(
+                    x[first], y[first], z[first], station_x[station],
+                    station_y[station], phase)
+                times_2, dx_2, dy_2, dz_2 = self._rays(
+                    x[second], y[second], z[second], station_x[station],
+                    station_y[station], phase)
+                residuals = self.dt[rows] - (times_1 + shifts[first] -
+                                             times_2 - shifts[second])
+                separations = np.sqrt((x[first] - x[second]) ** 2 +
+                                      (y[first] - y[second]) ** 2 +
+                                      (z[first] - z[second]) ** 2)
+                weights = self._weights(weight, cc, residuals, separations,
+                                        apriori)
+                weights[~(active[first] & active[second])] = 0.0
+                used = np.nonzero(weights > 0)[0]
+                if not len(used):
+                    break
+                root = np.sqrt(weights[used])
+                system_rows = np.repeat(np.arange(len(used)), 2 * UNKNOWNS)
+                system_columns = np.column_stack(
+                    [UNKNOWNS * first[used] + k for k in range(UNKNOWNS)] +
+                    [UNKNOWNS * second[used] + k for k in range(UNKNOWNS)]
+                    ).ravel()
+                system_values = (root[:, np.newaxis] * np.column_stack(
+                    (dx_1[used], dy_1[used], dz_1[used], np.ones(len(used)),
+                     -dx_2[used], -dy_2[used], -dz_2[used],
+                     -np.ones(len(used))))).ravel()
+                model, variances, condition = self._solve(
+                    system_rows, system_columns, system_values,
+                    root * residuals[used], UNKNOWNS * n, weight.damp)
+                model = model.reshape(n, UNKNOWNS)
+                has_data = np.zeros(n, dtype=bool)
+                has_data[first[used]] = True
+                has_data[second[used]] = True
+                model[~(active & has_data)] = 0.0
+                air_quakes = active & (z + model[:, 2] < 0)
+                model[air_quakes] = 0.0
+                active &= ~air_quakes
+                x += model[:, 0]
+                y += model[:, 1]
+                z += model[:, 2]
+                shifts += model[:, 3]
+
+                moved = active & has_data
+                summary = {"it": iteration, "cnd": condition,
+                           "aq": air_quakes.sum(),
+                           "ev": 100.0 * moved.sum() / n}
+                for name, selection in (("ct", ~cc), ("cc", cc)):
+                    total = max(selection.sum(), 1)
+                    data = selection[used]
+                    summary[name] = 100.0 * data.sum() / total
+                    rms = 0.0
+                    if data.any():
+                        rms = 1000.0 * np.sqrt(
+                            np.sum(weights[used][data] *
+                                   residuals[used][data] ** 2) /
+                            np.sum(weights[used][data]))
+                    change = 0.0
+                    if previous.get(name):
+                        change = 100.0 * (rms - previous[name]) / \
+                                 previous[name]
+                    previous[name] = rms
+                    summary["rms" + name] = rms
+                    summary["rms" + name + "_change"] = change
+                station_rms = np.sqrt(
+                    np.bincount(station[used], weights=residuals[used] ** 2,
+                                minlength=len(self.station_names)) /
+                    np.maximum(np.bincount(station[used],
+                                           minlength=len(self.station_names)),
+                               1))
+                summary["rmsst"] = 1000.0 * station_rms.max()
+                for name, column in (("dx", 0), ("dy", 1), ("dz", 2)):
+                    summary[name] = 1000.0 * np.abs(model[moved, column]).mean() \
+                                    if moved.any() else 0.0
+                summary["dt"] = 1000.0 * np.abs(model[moved, 3]).mean() \
+                                if moved.any() else 0.0
+                summary["os"] = 1000.0 * np.sqrt(
+                    (x[active].mean() - x0) ** 2 +
+                    (y[active].mean() - y0) ** 2 +
+                    (z[active].mean() - z0) ** 2) if active.any() else 0.0
+                line = format_iteration(summary)
+                print line.rstrip()
+                self._log.append(line)
+                summary["cluster"] = number
+                self.iterations.append(summary)
+                if self.monitor is not None and self.monitor(line):
+                    self.stopped = True
+                    break
+            if self.stopped:
+                break
+
+        # Final residuals and error estimates at the relocated positions.
+        times_1 = self._rays(x[first], y[first], z[first],
+                             station_x[station], station_y[station],
+                             phase)[0]
+        times_2 = self._rays(x[second], y[second], z[second],
+                             station_x[station], station_y[station],
+                             phase)[0]
+        residuals = self.dt[rows] - (times_1 + shifts[first] -
+                                     times_2 - shifts[second])
+        used = weights > 0
+        has_data = np.zeros(n, dtype=bool)
+        has_data[first[used]] = True
+        has_data[second[used]] = True
+        relocated = active & has_data
+        errors = np.zeros((n, 3))
+        if used.any():
+            variance = (np.sum(weights[used] * residuals[used] ** 2) /
+                        max(used.sum() - UNKNOWNS * relocated.sum(), 1))
+            errors = 1000.0 * np.sqrt(np.clip(variances.reshape(
+                         n, UNKNOWNS)[:, :3] * variance, 0.0, None))
+
+        records = np.zeros(relocated.sum(), dtype=RELOC_DTYPE)
+        selected = np.nonzero(relocated)[0]
+        records["evid"] = hypocenters["id"][selected]
+        records["lat"] = lat0 + y[selected] / KM_PER_DEGREE
+        records["lon"] = lon0 + x[selected] / scale
+        records["depth"] = z[selected]
+        records["x"] = 1000.0 * (x[selected] - x0)
+        records["y"] = 1000.0 * (y[selected] - y0)
+        records["z"] = 1000.0 * (z[selected] - z0)
+        records["ex"] = errors[selected, 0]
+        records["ey"] = errors[selected, 1]
+        records["ez"] = errors[selected, 2]
+        (records["year"], records["month"], records["day"], records["hour"],
+         records["minute"], records["second"]) = _time_fields(
+            hypocenter_times(hypocenters[selected]) + shifts[selected])
+        records["mag"] = hypocenters["mag"][selected]
+        for name, selection in (("nccp", cc & (phase == 0)),
+                                ("nccs", cc & (phase == 1)),
+                                ("nctp", ~cc & (phase == 0)),
+                                ("ncts", ~cc & (phase == 1))):
+            counted = used & selection
+            records[name] = (np.bincount(first[counted], minlength=n) +
+                             np.bincount(second[counted], minlength=n)
+                             )[selected]
+        for name, selection in (("rcc", cc), ("rct", ~cc)):
+            counted = used & selection
+            squares = (np.bincount(first[counted],
+                                   weights=residuals[counted] ** 2,
+                                   minlength=n) +
+                       np.bincount(second[counted],
+                                   weights=residuals[counted] ** 2,
+                                   minlength=n))
+            counts = (np.bincount(first[counted], minlength=n) +
+                      np.bincount(second[counted], minlength=n))
+            records[name] = (1000.0 * np.sqrt(squares /
+                                              np.maximum(counts, 1))
+                             )[selected]
+        records["cid"] = number
+
+        observations = np.zeros(len(rows), dtype=RES_DTYPE)
+        observations["sta"] = self.station_names[station]
+        observations["dt"] = self.dt[rows]
+        observations["c1"] = hypocenters["id"][first]
+        observations["c2"] = hypocenters["id"][second]
+        observations["idx"] = np.where(cc, 1, 3) + phase
+        observations["qual"] = self.quality[rows]
+        observations["res"] = 1000.0 * residuals
+        observations["wt"] = weights
+        observations["offs"] = 1000.0 * np.sqrt((x[first] - x[second]) ** 2 +
+                                                (y[first] - y[second]) ** 2 +
+                                                (z[first] - z[second]) ** 2)
+        return records, observations
+
+    def run(self):
+        """Relocate all clusters and write the outputs.
+
+        The clusters are found as by hypoDD (see ClusterPartition). CID and
+        EVID of the control select the clusters and events relocated.
+        Returns the relocated events, as records of RELOC_DTYPE.
+        """
+        control = self.control
+        self.read_inputs()
+        self.iterations = []
+        self._log = []
+        self.stopped = False
+        clusters = ClusterPartition(control,
+                                    directory=self.directory).partition()
+        relocations = []
+        residuals = []
+        for number, ids in enumerate(clusters, 1):
+            if self.stopped:
+                break
+            if control.cid and number != control.cid:
+                continue
+            if control.evid:
+                ids = ids[np.in1d(ids, control.evid)]
+            ids = ids[np.in1d(ids, self.events["id"])]
+            events = np.searchsorted(self.events["id"], ids)
+            if len(events) < 2:
+                continue
+            records, observations = self.relocate_cluster(number, events)
+            relocations.append(records)
+            residuals.append(observations)
+        self.relocations = np.concatenate(relocations) if relocations else \
+                           np.zeros(0, dtype=RELOC_DTYPE)
+        self.residuals = np.concatenate(residuals) if residuals else \
+                         np.zeros(0, dtype=RES_DTYPE)
+        self.write_outputs()
+        return self.relocations
+
+    def write_outputs(self):
+        """Write the relocated hypocenter and data residual outputs and the
+        iteration log ('hypoDD.log.out') in the formats of hypoDD.
+        """
+        control = self.control
+        write_reloc(self._path(control.relocated_hypocenters_output),
+                    self.relocations)
+        if control.data_residual_output:
+            write_res(self._path(control.data_residual_output),
+                      self.residuals)
+        with open(self._path("hypoDD.log.out"), "w") as f:
+            f.writelines(self._log)
+
+
+def run_workspace(control, directory):
+    """Relocate the events of a workspace with DDSolver, in place of a run
+    of the hypoDD executable.
+
+    The outputs are written to directory, as hypoDD would write them. Runs
+    that fail on their inputs (e.g. a missing or malformed file) are
+    reported with an exit status of 1, as failed runs of the executable.
+
+    Arguments:
+    control: A HypoDDControl object describing the hypoDD parameters.
+    directory: The directory holding the hypoDD input files.
+    Returns a RunResult.
+    """
+    start = time.time()
+    returncode = 0
+    try:
+        DDSolver(control, directory=directory).run()
+    except (IOError, ValueError, np.linalg.LinAlgError) as error:
+        print "DDSolver failed in {}: {}".format(directory, error)
+        returncode = 1
+    return RunResult(["DDSolver", control.control_file], directory,
+                     returncode, time.time() - start, 0,
+                     log_file="{}/hypoDD.log.out".format(directory))
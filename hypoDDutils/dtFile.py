@@ -0,0 +1,554 @@
+import json
+import os
+import re
+import numpy as np
+from catalogArrays import format_lines, write_blocks
+from ph2dt import DT_CT_HEADER_FORMAT, DT_CT_FORMAT
+from geodesy import cartesian, haversine
+from columnarExport import DictionaryEncoder
+
+# Line formats of the cross correlation differential time file ('dt.cc').
+DT_CC_HEADER_FORMAT = "# %9d %9d %6.3f\n"
+DT_CC_FORMAT = "%-7s %9.4f %6.4f %s\n"
+
+# Size in bytes of the blocks in which differential time files are read.
+DT_CHUNK_SIZE = 1 << 24
+
+# A pair header line of a differential time file.
+PAIR_HEADER = re.compile(b"^#([^\\n]*)\\n", re.M)
+
+
+def read_pairs(filename):
+    """Read the event pairs of a differential time file ('dt.ct', 'dt.cc').
+
+    Only the '#' pair header lines are parsed. Returns an (n, 2) array with
+    the IDs of the two events of every pair, in file order.
+    """
+    return index_pairs(filename)[0]
+
+
+def read_pair_counts(filename, phases=("P", "S")):
+    """Count the observations of every event pair in a differential time
+    file.
+
+    The file is streamed once. Returns an (n, 2) array with the IDs of the
+    two events of every pair and an array with the number of observations
+    of the given phases of every pair, in file order.
+    """
+    pairs = []
+    counts = []
+    for block in iter_chunks(filename):
+        selected = np.in1d(block.phases, [phase[:1] for phase in phases])
+        pair_index = np.repeat(np.arange(len(block)), np.diff(block.offsets))
+        pairs.append(block.pairs)
+        counts.append(np.bincount(pair_index[selected],
+                                  minlength=len(block)))
+    if not pairs:
+        return (np.zeros((0, 2), dtype=np.int64),
+                np.zeros(0, dtype=np.int64))
+    return np.concatenate(pairs), np.concatenate(counts).astype(np.int64)
+
+
+def index_pairs(filename, start=0, chunk_size=1 << 24):
+    """Locate the blocks of the event pairs of a differential time file.
+
+    The file is read in chunks of chunk_size bytes, starting at byte start.
+    Returns an (n, 2) array with the IDs of the two events of every pair,
+    the byte offset of every pair header line and the length in bytes of
+    every block, header included.
+    """
+    pairs = []
+    offsets = []
+    with open(filename, "rb") as f:
+        f.seek(start)
+        position = start
+        carry = b""
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            text = carry + chunk
+            base = position - len(carry)
+            position += len(chunk)
+            end = text.rfind(b"\n") + 1
+            carry = text[end:]
+            for match in PAIR_HEADER.finditer(text, 0, end):
+                num = match.group(1).split()
+                pairs.append((int(num[0]), int(num[1])))
+                offsets.append(base + match.start())
+    offsets = np.array(offsets, dtype=np.int64)
+    lengths = np.diff(np.append(offsets, position))
+    return (np.array(pairs, dtype=np.int64).reshape(-1, 2), offsets,
+            lengths)
+
+
+class DifferentialTimes:
+    """The contents of a differential time file in columnar form.
+
+    The observations of pair i are the entries offsets[i]:offsets[i+1] of
+    the observation arrays. Catalog files ('dt.ct') have the two travel
+    times and the weight of every observation as values, cross correlation
+    files ('dt.cc') the differential time and the coefficient.
+
+    Attributes:
+    pairs: (n, 2) array with the IDs of the two events of every pair.
+    origin_corrections: The origin time correction of every pair (OTC of
+                        'dt.cc', 0 for 'dt.ct').
+    offsets: Offsets of the observations of every pair.
+    stations: The station code of every observation.
+    values: (m, 3) or (m, 2) array with the values of every observation.
+    phases: The phase of every observation.
+    Methods:
+    __init__: Initialization method.
+    read: Parse a differential time file.
+    concatenate: Join several DifferentialTimes.
+    subset: Select pairs and observations.
+    write: Write the differential times in their file format.
+    """
+
+    pairs = None
+    origin_corrections = None
+    offsets = None
+    stations = None
+    values = None
+    phases = None
+
+    def __init__(self, pairs, origin_corrections, offsets, stations, values,
+                 phases
+                 ):
+        """Initialization method for the DifferentialTimes class.
+        """
+        self.pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        self.origin_corrections = np.asarray(origin_corrections,
+                                             dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.stations = np.asarray(stations, dtype="S7")
+        self.values = np.asarray(values, dtype=np.float64)
+        self.phases = np.asarray(phases, dtype="S1")
+
+    def __len__(self):
+        return len(self.pairs)
+
+    @property
+    def cross_correlation(self):
+        """True for cross correlation differential times.
+        """
+        return self.values.shape[1] == 2
+
+    @classmethod
+    def read(cls, filename, chunk_size=DT_CHUNK_SIZE):
+        """Parse a differential time file ('dt.ct' or 'dt.cc').
+
+        The file is parsed in blocks of about chunk_size bytes (see
+        iter_chunks).
+        """
+        return cls.concatenate(list(iter_chunks(filename, chunk_size)))
+
+    @classmethod
+    def concatenate(cls, blocks):
+        """Join several DifferentialTimes, in order.
+        """
+        if not blocks:
+            return cls(np.zeros((0, 2)), [], [0], [], np.zeros((0, 3)), [])
+        counts = np.concatenate([np.diff(block.offsets) for block in blocks])
+        return cls(np.concatenate([block.pairs for block in blocks]),
+                   np.concatenate([block.origin_corrections
+                                   for block in blocks]),
+                   np.concatenate(([0], np.cumsum(counts))),
+                   np.concatenate([block.stations for block in blocks]),
+                   np.concatenate([block.values for block in blocks]),
+                   np.concatenate([block.phases for block in blocks]))
+
+    def subset(self, pair_selection=None, observation_selection=None):
+        """Select pairs and observations.
+
+        Pairs left without observations are dropped.
+
+        Arguments:
+        pair_selection: A boolean mask over the pairs, or None for all.
+        observation_selection: A boolean mask over the observations, or
+                               None for all.
+        """
+        counts = np.diff(self.offsets)
+        keep = np.ones(len(self.stations), dtype=bool)
+        if pair_selection is not None:
+            keep &= np.repeat(np.asarray(pair_selection, dtype=bool), counts)
+        if observation_selection is not None:
+            keep &= np.asarray(observation_selection, dtype=bool)
+        pair_index = np.repeat(np.arange(len(self.pairs)), counts)[keep]
+        counts = np.bincount(pair_index, minlength=len(self.pairs))
+        kept_pairs = counts > 0
+        counts = counts[kept_pairs]
+        return DifferentialTimes(self.pairs[kept_pairs],
+                                 self.origin_corrections[kept_pairs],
+                                 np.concatenate(([0], np.cumsum(counts))),
+                                 self.stations[keep], self.values[keep],
+                                 self.phases[keep])
+
+    def write(self, f):
+        """Write the differential times in the format of their file.
+
+        Arguments:
+        f: An open file object.
+        """
+        stations = self.stations.astype(str).astype(object)
+        phases = self.phases.astype(str)
+        if self.cross_correlation:
+            headers = format_lines(DT_CC_HEADER_FORMAT,
+                                   (self.pairs[:, 0], self.pairs[:, 1],
+                                    self.origin_corrections))
+            lines = format_lines(DT_CC_FORMAT,
+                                 (stations, self.values[:, 0],
+                                  self.values[:, 1], phases))
+        else:
+            headers = format_lines(DT_CT_HEADER_FORMAT,
+                                   (self.pairs[:, 0], self.pairs[:, 1]))
+            lines = format_lines(DT_CT_FORMAT,
+                                 (stations, self.values[:, 0],
+                                  self.values[:, 1], self.values[:, 2],
+                                  phases))
+        write_blocks(f, headers, lines, self.offsets)
+
+
+def _parse_pairs(text):
+    """Parse complete pair blocks of a differential time file.
+
+    Pair headers are located with PAIR_HEADER, the observation lines
+    between them are split in a single pass and their columns parsed by
+    numpy. Returns a DifferentialTimes.
+    """
+    headers = list(PAIR_HEADER.finditer(text))
+    if text.strip() and (not headers or text[:headers[0].start()].strip()):
+        raise ValueError("observation lines before the first pair header")
+    ends = [match.start() for match in headers[1:]] + [len(text)]
+    blocks = [text[match.end():end] for match, end in zip(headers, ends)]
+    counts = [block.count("\n") + (1 if block and block[-1] != "\n" else 0)
+              for block in blocks]
+    observations = "".join(block if not block or block[-1] == "\n"
+                           else block + "\n" for block in blocks)
+    tokens = observations.split()
+    nlines = sum(counts)
+    ncols = len(tokens) // nlines if nlines else 5
+    if ncols * nlines != len(tokens) or ncols not in (4, 5):
+        # Blank or malformed lines: count the observation lines one by one.
+        lines = [block.split("\n") for block in blocks]
+        counts = [len([line for line in block if line.strip()])
+                  for block in lines]
+        nlines = sum(counts)
+        ncols = len(tokens) // nlines if nlines else 5
+        if ncols * nlines != len(tokens):
+            raise ValueError("observation lines with differing numbers of "
+                             "columns")
+    numbers = [match.group(1).split() for match in headers]
+    pairs = [(int(num[0]), int(num[1])) for num in numbers]
+    origin_corrections = [float(num[2]) if len(num) > 2 else 0.0
+                          for num in numbers]
+    offsets = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+    values = np.empty((nlines, ncols - 2), dtype=np.float64)
+    for col in range(ncols - 2):
+        values[:, col] = np.fromstring(" ".join(tokens[col + 1::ncols]),
+                                       sep=" ")
+    return DifferentialTimes(pairs, origin_corrections, offsets,
+                             tokens[0::ncols], values, tokens[ncols - 1::ncols])
+
+
+def iter_chunks(filename, chunk_size=DT_CHUNK_SIZE):
+    """Stream a differential time file ('dt.ct' or 'dt.cc') in blocks.
+
+    Yields DifferentialTimes holding the complete pairs of about chunk_size
+    bytes of the file each, so that files of any size can be processed in
+    bounded memory.
+    """
+    with open(filename, "r") as f:
+        rest = ""
+        while True:
+            block = f.read(chunk_size)
+            if not block:
+                break
+            block = rest + block
+            end = block.rfind("\n#") + 1
+            rest = block[end:]
+            if end:
+                yield _parse_pairs(block[:end])
+        if rest.strip():
+            yield _parse_pairs(rest)
+
+
+class PairStore:
+    """Binary store of a differential time file, read through memory maps.
+
+    Every column of the file is kept in its own binary data file, and an
+    index file records the sizes of the columns and the station codes.
+    Station codes are stored as indices into the station list. The
+    observations of pair i are the entries offsets[i]:offsets[i+1] of the
+    observation columns, so that pairs and observations can be filtered
+    with numpy on the memory mapped columns and only the selected entries
+    are read. The selection can be written back in the text format of the
+    file.
+
+    Attributes:
+    directory: The directory holding the data and index files.
+    cross_correlation: True for a store of cross correlation differential
+                       times ('dt.cc').
+    stations: The station codes referred to by station_codes.
+    pairs: (n, 2) array with the IDs of the two events of every pair.
+    origin_corrections: The origin time correction of every pair.
+    offsets: Offsets of the observations of every pair.
+    station_codes: Index of the station of every observation in stations.
+    values: (m, 3) or (m, 2) array with the values of every observation.
+    phases: The phase of every observation.
+    Methods:
+    __init__: Initialization method.
+    convert: Build a store from a differential time file.
+    pair_mask: Select pairs by event and inter-event distance.
+    observation_mask: Select observations by station, phase and distance.
+    iter_blocks: Stream selected pairs and observations.
+    select: Read selected pairs and observations.
+    write: Write selected pairs and observations in their file format.
+    """
+
+    directory = "."
+    cross_correlation = False
+    stations = []
+    pairs = None
+    origin_corrections = None
+    offsets = None
+    station_codes = None
+    values = None
+    phases = None
+
+    index_file = "index.json"
+
+    def __init__(self, directory):
+        """Initialization method for the PairStore class.
+
+        Opens the store in directory, built with convert.
+        """
+        self.directory = directory
+        with open(self._path(self.index_file), "r") as f:
+            index = json.load(f)
+        self.cross_correlation = index["cross_correlation"]
+        self.stations = [str(sta) for sta in index["stations"]]
+        npairs = index["pairs"]
+        nobservations = index["observations"]
+        nvalues = 2 if self.cross_correlation else 3
+        self.pairs = self._map("pairs", np.int64, (npairs, 2))
+        self.origin_corrections = self._map("origin_corrections",
+                                            np.float64, (npairs,))
+        self.offsets = self._map("offsets", np.int64, (npairs + 1,))
+        self.station_codes = self._map("station_codes", np.int32,
+                                       (nobservations,))
+        self.values = self._map("values", np.float64,
+                                (nobservations, nvalues))
+        self.phases = self._map("phases", "S1", (nobservations,))
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def _path(self, filename):
+        return "{}/{}".format(self.directory, filename)
+
+    def _map(self, name, dtype, shape):
+        if not np.prod(shape):
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self._path(name + ".bin"), dtype=dtype, mode="r",
+                         shape=shape)
+
+    @classmethod
+    def convert(cls, filename, directory, chunk_size=DT_CHUNK_SIZE):
+        """Build a store from a differential time file.
+
+        The file is parsed in blocks (see iter_chunks) that are appended to
+        the data files, so that files of any size can be converted in
+        bounded memory. Returns the PairStore.
+
+        Arguments:
+        filename: The differential time file ('dt.ct' or 'dt.cc').
+        directory: The directory of the store. Existing data files in it
+                   are overwritten.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        encoder = DictionaryEncoder()
+        names = ("pairs", "origin_corrections", "offsets", "station_codes",
+                 "values", "phases")
+        files = dict((name, open("{}/{}.bin".format(directory, name), "wb"))
+                     for name in names)
+        npairs = 0
+        nobservations = 0
+        cross_correlation = False
+        try:
+            for block in iter_chunks(filename, chunk_size):
+                cross_correlation = block.cross_correlation
+                block.pairs.tofile(files["pairs"])
+                block.origin_corrections.tofile(files["origin_corrections"])
+                (block.offsets[:-1] + nobservations).tofile(files["offsets"])
+                encoder.encode("station", block.stations).tofile(
+                    files["station_codes"])
+                block.values.tofile(files["values"])
+                block.phases.tofile(files["phases"])
+                npairs += len(block)
+                nobservations += len(block.stations)
+            np.array([nobservations], dtype=np.int64).tofile(files["offsets"])
+        finally:
+            for f in files.values():
+                f.close()
+        index = {"cross_correlation": cross_correlation,
+                 "pairs": npairs,
+                 "observations": nobservations,
+                 "stations": encoder.dictionaries.get("station", [])}
+        temporary = "{}/{}.tmp".format(directory, cls.index_file)
+        with open(temporary, "w") as f:
+            json.dump(index, f)
+        os.rename(temporary, "{}/{}".format(directory, cls.index_file))
+        print "stored {} pairs with {} observations of {} in {}".format(
+            npairs, nobservations, filename, directory)
+        return cls(directory)
+
+    def pair_mask(self, events=None, arrays=None, max_separation=None):
+        """Select pairs by event and inter-event distance.
+
+        Arguments:
+        events: Keep the pairs of two of these event IDs. None for all.
+        arrays: A CatalogArrays with the hypocenters of the events, needed
+                for max_separation.
+        max_separation: Keep the pairs of events at most this far apart,
+                        in km. Pairs with events missing from arrays are
+                        dropped. None for all.
+        Returns a boolean mask over the pairs.
+        """
+        mask = np.ones(len(self.pairs), dtype=bool)
+        if events is not None:
+            events = np.asarray(list(events), dtype=np.int64)
+            mask &= (np.in1d(self.pairs[:, 0], events) &
+                     np.in1d(self.pairs[:, 1], events))
+        if max_separation is not None:
+            found, index = _event_index(arrays.event_ids, self.pairs)
+            xyz = cartesian(arrays.latitudes, arrays.longitudes,
+                            arrays.depths)
+            separation = np.sqrt(np.sum((xyz[index[:, 0]] -
+                                         xyz[index[:, 1]]) ** 2, axis=1))
+            mask &= found & (separation <= max_separation)
+        return mask
+
+    def observation_mask(self, stations=None, phases=None, arrays=None,
+                         coordinates=None, max_distance=None):
+        """Select observations by station, phase and distance.
+
+        Arguments:
+        stations: Keep the observations of these station codes. None for
+                  all.
+        phases: Keep the observations of these phases, e.g. ('P',). None
+                for all.
+        arrays: A CatalogArrays with the hypocenters of the events, needed
+                for max_distance.
+        coordinates: A dict mapping station codes to (latitude, longitude)
+                     tuples, needed for max_distance.
+        max_distance: Keep the observations at stations at most this far,
+                      in km, from the midpoint of the epicenters of their
+                      pair. Observations of events or stations without
+                      coordinates are dropped. None for all.
+        Returns a boolean mask over the observations.
+        """
+        mask = np.ones(len(self.station_codes), dtype=bool)
+        if stations is not None:
+            codes = [code for code, sta in enumerate(self.stations)
+                     if sta in set(stations)]
+            mask &= np.in1d(self.station_codes, codes)
+        if phases is not None:
+            mask &= np.in1d(self.phases, [phase[:1] for phase in phases])
+        if max_distance is not None:
+            found, index = _event_index(arrays.event_ids, self.pairs)
+            latitude = 0.5 * (arrays.latitudes[index[:, 0]] +
+                              arrays.latitudes[index[:, 1]])
+            longitude = 0.5 * (arrays.longitudes[index[:, 0]] +
+                               arrays.longitudes[index[:, 1]])
+            station_coordinates = np.array(
+                [coordinates.get(sta, (np.nan, np.nan))[:2]
+                 for sta in self.stations], dtype=np.float64).reshape(-1, 2)
+            pair_index = np.repeat(np.arange(len(self.pairs)),
+                                   np.diff(self.offsets))
+            distance = haversine(latitude[pair_index],
+                                 longitude[pair_index],
+                                 station_coordinates[self.station_codes, 0],
+                                 station_coordinates[self.station_codes, 1])
+            with np.errstate(invalid="ignore"):
+                mask &= found[pair_index] & (distance <= max_distance)
+        return mask
+
+    def iter_blocks(self, pair_selection=None, observation_selection=None,
+                    block_size=100000):
+        """Stream selected pairs and observations.
+
+        Yields DifferentialTimes of at most block_size pairs each. Pairs
+        left without observations are dropped.
+
+        Arguments:
+        pair_selection: A boolean mask over the pairs, or None for all.
+        observation_selection: A boolean mask over the observations, or
+                               None for all.
+        """
+        stations = np.array(self.stations, dtype="S7")
+        for start in range(0, len(self.pairs), block_size):
+            stop = min(start + block_size, len(self.pairs))
+            first, last = self.offsets[start], self.offsets[stop]
+            pairs = slice(start, stop)
+            observations = slice(first, last)
+            if pair_selection is not None:
+                if not np.any(pair_selection[pairs]):
+                    continue
+            block = DifferentialTimes(
+                        self.pairs[pairs], self.origin_corrections[pairs],
+                        self.offsets[start:stop + 1] - first,
+                        stations[self.station_codes[observations]],
+                        self.values[observations], self.phases[observations])
+            block = block.subset(
+                None if pair_selection is None
+                else pair_selection[pairs],
+                None if observation_selection is None
+                else observation_selection[observations])
+            if len(block):
+                yield block
+
+    def select(self, pair_selection=None, observation_selection=None):
+        """Read selected pairs and observations into a DifferentialTimes.
+
+        Arguments are as for iter_blocks.
+        """
+        blocks = list(self.iter_blocks(pair_selection, observation_selection))
+        if not blocks:
+            nvalues = 2 if self.cross_correlation else 3
+            return DifferentialTimes(np.zeros((0, 2)), [], [0], [],
+                                     np.zeros((0, nvalues)), [])
+        return DifferentialTimes.concatenate(blocks)
+
+    def write(self, f, pair_selection=None, observation_selection=None):
+        """Write selected pairs and observations in the format of their
+        file.
+
+        The selection is written block by block. The whole store written
+        reproduces the file it was converted from, when that was written by
+        ph2dt or this package.
+
+        Arguments:
+        f: An open file object.
+        pair_selection, observation_selection: As for iter_blocks.
+        """
+        for block in self.iter_blocks(pair_selection, observation_selection):
+            block.write(f)
+
+
+def _event_index(event_ids, pairs):
+    """Locate the events of pairs in event_ids.
+
+    Returns a boolean array, True for the pairs with both events found, and
+    an (n, 2) array with the positions of the events, 0 when not found.
+    """
+    event_ids = np.asarray(event_ids, dtype=np.int64)
+    order = np.argsort(event_ids, kind="mergesort")
+    position = np.searchsorted(event_ids[order], pairs)
+    position = np.minimum(position, max(len(event_ids) - 1, 0))
+    index = order[position] if len(event_ids) else np.zeros_like(pairs)
+    found = np.all(event_ids[index] == pairs, axis=1) if len(event_ids) \
+            else np.zeros(len(pairs), dtype=bool)
+    return found, index
@@ -0,0 +1,70 @@
+"""Incremental event sources.
+
+The functions in this module yield obspy Event objects one at a time, so
+that a catalog can be passed to CatalogArrays.from_catalog (or as the
+catalog of a HypoDDObject) without ever being held in memory as a whole.
+"""
+from io import BytesIO
+from lxml import etree
+from obspy import read_events
+from obspy.clients.fdsn.header import FDSNNoDataException
+from obspy.core.utcdatetime import UTCDateTime
+
+QUAKEML_BED_NAMESPACE = "http://quakeml.org/xmlns/bed/1.2"
+QUAKEML_NAMESPACE = "http://quakeml.org/xmlns/quakeml/1.2"
+
+
+def iter_quakeml(source):
+    """Yield the events of a QuakeML file one at a time.
+
+    The document is parsed incrementally. Every event element is read into
+    an obspy Event on its own and then discarded, so memory use does not
+    grow with the number of events in the file.
+
+    Arguments:
+    source: A filename or an open binary file object.
+    """
+    tag = "{{{}}}event".format(QUAKEML_BED_NAMESPACE)
+    for _, element in etree.iterparse(source, events=("end",), tag=tag,
+                                      huge_tree=True):
+        document = (b'<q:quakeml xmlns:q="' + QUAKEML_NAMESPACE.encode() +
+                    b'" xmlns="' + QUAKEML_BED_NAMESPACE.encode() +
+                    b'"><eventParameters publicID="smi:local/eventStream">' +
+                    etree.tostring(element) +
+                    b'</eventParameters></q:quakeml>')
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        for event in read_events(BytesIO(document), format="QUAKEML"):
+            yield event
+
+
+def iter_fdsn_events(client, starttime, endtime, chunk_length=30 * 86400,
+                     **kwargs):
+    """Yield the events of an FDSN event service, one time chunk at a time.
+
+    Only the events of one chunk are held in memory at any time.
+
+    Arguments:
+    client: An obspy FDSN Client.
+    starttime, endtime: The time span of the events.
+    chunk_length: Length in seconds of the time chunk of every request.
+    kwargs: Passed on to client.get_events (e.g. includearrivals=True and
+            geographic constraints).
+    """
+    chunk_start = UTCDateTime(starttime)
+    endtime = UTCDateTime(endtime)
+    while chunk_start < endtime:
+        chunk_end = min(chunk_start + chunk_length, endtime)
+        try:
+            catalog = client.get_events(starttime=chunk_start,
+                                        endtime=chunk_end, **kwargs)
+        except FDSNNoDataException:
+            catalog = []
+        for event in catalog:
+            # Events on the boundary are returned by both chunks.
+            orig = event.preferred_origin() or event.origins[0]
+            if orig.time < chunk_end or chunk_end == endtime:
+                yield event
+        del catalog
+        chunk_start = chunk_end
@@ -0,0 +1,297 @@
+"""Running the hypoDD binaries without changing the state of the process.
+
+Every run is started with its working directory given to the child
+process, so any number of runs can go on at once from the same process,
+in different directories. Runs write their stdout and stderr to a log file
+and return a RunResult. The lines a run writes can be followed while it
+goes on, e.g. by a progressMonitor.ProgressMonitor, which can stop it.
+"""
+import io
+import multiprocessing
+import os
+import resource
+import signal
+import subprocess
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+
+class RunResult:
+    """The outcome of a run of an executable.
+
+    Attributes:
+    command: The command line that was run.
+    cwd: The working directory of the run.
+    returncode: The exit status, or minus the number of the signal that
+                ended the run.
+    runtime: The wall clock time of the run in s.
+    peak_rss: The peak resident set size of the run in bytes, as sampled
+              by the Executor.
+    timed_out: True if the run was killed after its timeout.
+    stopped: True if the run was killed because its line callback asked for
+             it.
+    log_file: The file holding the stdout and stderr of the run.
+    cpu_time: The user and system CPU time of the run in s.
+    read_bytes, write_bytes: The bytes the run read from and wrote to disk,
+                             from its block I/O counts.
+    """
+
+    command = None
+    cwd = "."
+    returncode = None
+    runtime = 0.0
+    peak_rss = 0
+    timed_out = False
+    stopped = False
+    log_file = None
+    cpu_time = 0.0
+    read_bytes = 0
+    write_bytes = 0
+
+    def __init__(self, command, cwd, returncode, runtime, peak_rss,
+                 timed_out=False, log_file=None, cpu_time=0.0, read_bytes=0,
+                 write_bytes=0, stopped=False
+                 ):
+        """Initialization method for the RunResult class.
+        """
+        self.command = command
+        self.cwd = cwd
+        self.returncode = returncode
+        self.runtime = runtime
+        self.peak_rss = peak_rss
+        self.timed_out = timed_out
+        self.log_file = log_file
+        self.cpu_time = cpu_time
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+        self.stopped = stopped
+
+    @property
+    def ok(self):
+        """True if the run finished with an exit status of 0.
+        """
+        return (self.returncode == 0 and not self.timed_out and
+                not self.stopped)
+
+    def __repr__(self):
+        return ("RunResult(command={!r}, returncode={}, runtime={:.2f}, "
+                "peak_rss={}, timed_out={}, stopped={})".format(
+                    self.command, self.returncode, self.runtime,
+                    self.peak_rss, self.timed_out, self.stopped))
+
+
+class Executor:
+    """Runs executables with bounded concurrency and resource limits.
+
+    The number of runs going on at once is bounded over all the threads
+    that use the same Executor. run blocks until the run is over, submit
+    returns at once with an AsyncResult (see multiprocessing.pool) whose
+    get method returns the RunResult. The peak memory of a run is sampled
+    from /proc every poll_interval.
+
+    Attributes:
+    max_concurrent: Maximum number of concurrent runs. None for the number
+                    of cores.
+    timeout: Default wall clock limit of a run in s. None for no limit.
+    memory_limit: Default address space limit of a run in bytes. None for
+                  no limit.
+    poll_interval: Interval in s at which running processes are checked.
+    Methods:
+    __init__: Initialization method.
+    run: Run an executable and wait for it.
+    submit: Start a run in the background.
+    run_all: Run several executables concurrently and wait for all of them.
+    close: Stop the background threads.
+    """
+
+    max_concurrent = None
+    timeout = None
+    memory_limit = None
+    poll_interval = 0.05
+
+    def __init__(self, max_concurrent=None, timeout=None, memory_limit=None,
+                 poll_interval=0.05
+                 ):
+        """Initialization method for the Executor class.
+        """
+        if max_concurrent is None:
+            max_concurrent = multiprocessing.cpu_count()
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.poll_interval = poll_interval
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _limits(self, memory_limit):
+        def set_limits():
+            # Runs in the child, between fork and exec.
+            os.setpgrp()
+            if memory_limit is not None:
+                resource.setrlimit(resource.RLIMIT_AS,
+                                   (memory_limit, memory_limit))
+        return set_limits
+
+    @staticmethod
+    def _high_water_mark(pid):
+        """Return the peak resident set size of a process in bytes, or 0.
+        """
+        try:
+            with open("/proc/{}/status".format(pid), "r") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except (IOError, OSError, ValueError):
+            pass
+        return 0
+
+    @staticmethod
+    def _follow(reader, pending, line_callback):
+        """Pass the complete lines written to the log since the last call
+        to line_callback.
+
+        Returns the incomplete last line and True if the callback asked
+        for the run to be stopped.
+        """
+        stop = False
+        data = pending + reader.read()
+        lines = data.split("\n")
+        for line in lines[:-1]:
+            if line_callback(line + "\n"):
+                stop = True
+        return lines[-1], stop
+
+    def run(self, command, cwd=".", log_file=None, timeout=None,
+            memory_limit=None, line_callback=None):
+        """Run an executable and wait for it to finish.
+
+        Arguments:
+        command: The command line, as a list. A relative path to the
+                 executable is taken relative to cwd.
+        cwd: The working directory of the run.
+        log_file: The file the stdout and stderr of the run are written to.
+                  None to discard them.
+        timeout, memory_limit: Override the defaults of the Executor.
+        line_callback: A callable called with every line the run writes,
+                       every poll_interval, while the run goes on. The run
+                       is killed if it returns True. Needs a log_file.
+        Returns a RunResult.
+        """
+        if line_callback is not None and log_file is None:
+            raise ValueError("Following the lines of a run needs a log file")
+        if timeout is None:
+            timeout = self.timeout
+        if memory_limit is None:
+            memory_limit = self.memory_limit
+        command = list(command)
+        if os.sep in command[0] and not os.path.isabs(command[0]):
+            command[0] = os.path.abspath(os.path.join(cwd, command[0]))
+        with self._slots:
+            if log_file is None:
+                log = open(os.devnull, "w")
+            else:
+                log = open(log_file, "w")
+            env = None
+            reader = None
+            if line_callback is not None:
+                # gfortran buffers the stdout of a program that does not
+                # write to a terminal, which would delay the lines.
+                env = dict(os.environ, GFORTRAN_UNBUFFERED_PRECONNECTED="y")
+                reader = io.open(log_file, "rb")
+            try:
+                start = time.time()
+                process = subprocess.Popen(command, cwd=cwd, stdout=log,
+                                           stderr=subprocess.STDOUT,
+                                           close_fds=True, env=env,
+                                           preexec_fn=self._limits(
+                                                          memory_limit))
+                timed_out = False
+                stopped = False
+                pending = ""
+                peak_rss = 0
+                while True:
+                    peak_rss = max(peak_rss,
+                                   self._high_water_mark(process.pid))
+                    pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+                    if pid:
+                        break
+                    if reader is not None:
+                        pending, stop = self._follow(reader, pending,
+                                                     line_callback)
+                        if stop and not stopped and not timed_out:
+                            stopped = True
+                            os.killpg(process.pid, signal.SIGKILL)
+                    if timeout is not None and \
+                       time.time() - start > timeout and not timed_out:
+                        timed_out = True
+                        os.killpg(process.pid, signal.SIGKILL)
+                    time.sleep(self.poll_interval)
+                runtime = time.time() - start
+                if reader is not None:
+                    # The lines written after the last poll, the last one
+                    # possibly without a newline.
+                    pending, _ = self._follow(reader, pending,
+                                              line_callback)
+                    if pending:
+                        line_callback(pending)
+            finally:
+                log.close()
+                if reader is not None:
+                    reader.close()
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        process.returncode = returncode
+        if not peak_rss:
+            # Not sampled before the run was over. ru_maxrss (in kB on
+            # Linux) also counts the memory of the process before exec.
+            peak_rss = usage.ru_maxrss * 1024
+        # Block I/O counts are in units of 512 bytes.
+        return RunResult(command, cwd, returncode, runtime, peak_rss,
+                         timed_out, log_file,
+                         cpu_time=usage.ru_utime + usage.ru_stime,
+                         read_bytes=usage.ru_inblock * 512,
+                         write_bytes=usage.ru_oublock * 512,
+                         stopped=stopped)
+
+    def submit(self, command, cwd=".", log_file=None, timeout=None,
+               memory_limit=None, callback=None, line_callback=None):
+        """Start a run in the background.
+
+        Takes the arguments of run, and a callback called with the
+        RunResult when the run is over. line_callback is called from a
+        background thread. Returns an AsyncResult.
+        """
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.max_concurrent)
+        return self._pool.apply_async(self.run, (command, cwd, log_file,
+                                                 timeout, memory_limit,
+                                                 line_callback),
+                                      callback=callback)
+
+    def run_all(self, runs):
+        """Run several executables concurrently and wait for all of them.
+
+        Arguments:
+        runs: A list of dictionaries with the keyword arguments of run.
+        Returns the list of RunResults, in the order of runs.
+        """
+        pending = [self.submit(**kwargs) for kwargs in runs]
+        return [result.get() for result in pending]
+
+    def close(self):
+        """Stop the background threads, once the runs submitted are over.
+        """
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+
+# The executor used when none is given.
+default_executor = Executor()
@@ -0,0 +1,32 @@
+import numpy as np
+
+EARTH_RADIUS = 6371.0  # km
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance in km between points given in degrees.
+
+    All arguments can be numpy arrays, which are broadcast against each
+    other.
+    """
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dlat = lat2 - lat1
+    dlon = np.radians(np.asarray(lon2) - np.asarray(lon1))
+    a = (np.sin(dlat / 2.0) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2.0) ** 2)
+    return 2.0 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def cartesian(lat, lon, depth):
+    """Earth centered cartesian coordinates in km of hypocenters.
+
+    Euclidean distances between the returned points are the hypocentral
+    separations used by ph2dt and hypoDD.
+    """
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    radius = EARTH_RADIUS - np.asarray(depth, dtype=np.float64)
+    return np.column_stack((radius * np.cos(lat) * np.cos(lon),
+                            radius * np.cos(lat) * np.sin(lon),
+                            radius * np.sin(lat)))
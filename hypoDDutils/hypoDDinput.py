@@ -1,5 +1,12 @@
 from obspy.core.event.origin import OriginUncertainty
-from obspy.core.utcdatetime import UTCDateTime
+from ph2dtControl import Ph2dtControl
+from hypoDDcontrol import HypoDDControl
+from crossCorrelation import CrossCorrelator
+from stationResolver import StationResolver
+from pickWeight import default_weight
+from ph2dt import Ph2dt, read_station_input
+from catalogArrays import (as_catalog_arrays, write_stations,
+                           WRITE_BUFFER_SIZE)
 
 
 def time2hypoDDdate(time):
@@ -34,11 +41,29 @@ class HypoDDInput:
     catalog_tt_input: The name of the catalog travel time input file ('dt.cc')
     catalog_cc_input: The name of the cross correlation differential time input
                       file ('dt.cc')
+    ph2dt_control: A Ph2dtControl object with the parameters used to prepare
+                   the catalog travel time input.
+    hypoDD_control: A HypoDDControl object with the parameters used to
+                    prepare the cross correlation differential time input.
+    waveform_cache: A WaveformCache object to read waveforms from, instead
+                    of requesting them from the client on every run.
+    station_resolver: A StationResolver object used to get the station
+                      coordinates. If None, one with a cache file named
+                      'stations.json' in the input directory is used.
+    arrays: A CatalogArrays object extracted from the catalog. If None, it
+            is extracted the first time it is needed.
+    pick_weight: A function mapping a pick and its arrival to the pick
+                 weight (see pickWeight).
+    processes: Number of worker processes of ph2dt and of the cross
+               correlation. None to use all cores.
     Methods:
     __init__: Initialization method.
+    get_arrays: Returns the CatalogArrays extracted from the catalog.
     prepare_hypocenter_input: Prepares the hypocenter input file.
     prepare_station_input: Prepares the station input file.
     prepare_catalog_tt_input: Prepares the catalog travel time input file.
+    prepare_cc_tt_input: Prepares the cross correlation differential time
+                         input file.
     prepare_all: Prepares all the above files.
     """
 
@@ -49,16 +74,27 @@ class HypoDDInput:
     station_input = "station.dat"
     catalog_tt_input = None
     catalog_cc_input = None
+    ph2dt_control = None
+    hypoDD_control = None
+    waveform_cache = None
+    station_resolver = None
+    arrays = None
+    pick_weight = staticmethod(default_weight)
+    processes = None
 
     def __init__(self, catalog, client, input_directory=".",
                  hypocenter_input="event.dat", station_input="station.dat",
-                 catalog_tt_input = None, catalog_cc_input = None
+                 catalog_tt_input = None, catalog_cc_input = None,
+                 ph2dt_control = None, hypoDD_control = None,
+                 waveform_cache = None, station_resolver = None,
+                 arrays = None, pick_weight = default_weight,
+                 processes = None
                  ):
         """Initialization method for the HypoDDinput class.
 
         Arguments:
         catalog: An obspy Catalog object which contains the events to be
-                 processed
+                 processed, or a CatalogArrays object.
         client : An obspy Client object which is used to provide phase (picks)
                  information
         """
@@ -69,6 +105,27 @@ class HypoDDInput:
         self.station_input = station_input
         self.catalog_tt_input = catalog_tt_input
         self.catalog_cc_input = catalog_cc_input
+        if ph2dt_control is None:
+            ph2dt_control = Ph2dtControl()
+        self.ph2dt_control = ph2dt_control
+        if hypoDD_control is None:
+            hypoDD_control = HypoDDControl()
+        self.hypoDD_control = hypoDD_control
+        self.waveform_cache = waveform_cache
+        self.station_resolver = station_resolver
+        self.arrays = arrays
+        self.pick_weight = pick_weight
+        self.processes = processes
+
+    def get_arrays(self):
+        """Return the CatalogArrays extracted from the catalog.
+
+        The catalog is only walked the first time.
+        """
+        if self.arrays is None:
+            self.arrays = as_catalog_arrays(self.catalog,
+                                            pick_weight=self.pick_weight)
+        return self.arrays
 
     def prepare_hypocenter_input(self):
         """Prepare the hypocenter input file for hypoDD.
@@ -82,92 +139,82 @@ class HypoDDInput:
         print "preparing initial hypocenter input file: {}".format(
                                                         full_filename
                                                         )
-        with open(full_filename, "w") as f:
-            for idx,evt in enumerate(self.catalog):
-                orig = evt.preferred_origin()
-                origin_time = orig.time
-                lat = orig.latitude
-                lon = orig.longitude
-                dep = orig.depth / 1000.0  # Converting m to km.
-                # TODO (@ogalanis) Currently it assumes that there is no
-                # horizontal and vertical uncertainty information in the catalog
-                # which is true for the KNMI catalog, but not for other
-                # catalogs.
-                # It should be fixed to use this information when available.
-                #dh  = orig.origin_uncertainty
-                errh = 0.0
-                errv = 0.0
-                rms=orig.quality.standard_error
-                if rms is None:
-                    rms = 0.0
-                mag = evt.preferred_magnitude()
-                magnitude = mag.mag
-                # hypoDD uses 0.0 to denote no magnitude. However, given that
-                # a) hypoDD does not use magnitudes for anything and
-                # b) it is possible to have a magnitude of 0.0 in the catalog
-                # we use the smallest number that fits in the 4.1f format.
-                if magnitude is None:
-                    magnitude = -9.9
-                hypocenter_input_format = ("{:>8d}  {:>8d} {:>9.4f} {:>10.4f} "
-                                         "{:>10.4f} {:>4.1f} {:>7.2f} {:>7.2f} "
-                                         "{:>6.2f} {:>10d}\n"
-                                         )
-                f.write(hypocenter_input_format.format(
-                                   time2hypoDDdate(origin_time),
-                                   time2hypoDDtime(origin_time),
-                                   lat,
-                                   lon,
-                                   dep,
-                                   magnitude,
-                                   errh,
-                                   errv,
-                                   rms,
-                                   idx+1   # Start from 1, not 0.
-                                   ))
+        with open(full_filename, "w", WRITE_BUFFER_SIZE) as f:
+            self.get_arrays().write_hypocenters(f)
 
     def prepare_station_input(self):
         """Prepare the station input file for hypoDD.
  
         The station input file is the file normally named 'station.dat', which
-        contains the coordinates of the stations used for location
+        contains the coordinates of the stations used for location. Stations
+        are identified by the full waveform ID of the picks and their
+        coordinates are resolved through station_resolver, which only
+        requests the stations missing from its cache.
         """
-        stations = []
-        bulk = []
-        distantPast = UTCDateTime("1900-01-01T00:00:00")
-        distantFuture = UTCDateTime("3000-01-01T00:00:00")
         full_filename = "{}/{}".format(self.input_directory,
                                        self.station_input
                                        )
         print "preparing station input file: {}".format(full_filename)
-        with open(full_filename, "w") as f:
-            for evt in self.catalog:
-                for pick in evt.picks:
-                    sta = pick.waveform_id.station_code
-                    if sta not in stations:
-                        stations.append(sta)
-            for sta in stations:
-                bulk.append(("*", sta, "*", "*", distantPast, distantFuture))
-            inv = self.client.get_stations_bulk(bulk)
-            for net in inv:
-                for sta in net:
-                    station_input_format = "{:<7} {:>12.6f} {:>12.6f}\n"
-                    f.write(station_input_format.format(sta.code,
-                                                        sta.latitude,
-                                                        sta.longitude
-                                                        ))
+        stations = set(self.get_arrays().waveform_ids)
+        resolver = self.station_resolver
+        if resolver is None:
+            resolver = StationResolver(self.client,
+                                       cache_file="{}/{}".format(
+                                                      self.input_directory,
+                                                      "stations.json"))
+        coordinates = {}
+        for nslc, (lat, lon, elevation) in sorted(
+                                             resolver.resolve(stations).items()):
+            coordinates.setdefault(nslc[1], (lat, lon))
+        with open(full_filename, "w", WRITE_BUFFER_SIZE) as f:
+            write_stations(f, coordinates)
 
     def prepare_catalog_tt_input(self):
+        """Prepare the catalog travel time input file for hypoDD.
+
+        The catalog travel time input is the file normally named 'dt.ct'. It
+        is computed from the picks in the catalog by the native ph2dt
+        implementation, using the parameters in ph2dt_control and the
+        coordinates in the station input file.
+        """
         print "preparing catalog travel time input file: {}".format(
                                                        self.catalog_tt_input
                                                        )
-        # TODO(@ogalanis) This one can wait, as there is a hypoDD
-        # utility program that has its functionality.
+        station_filename = "{}/{}".format(self.input_directory,
+                                          self.station_input
+                                          )
+        ph2dt = Ph2dt(self.get_arrays(),
+                      read_station_input(station_filename),
+                      control=self.ph2dt_control,
+                      output_directory=self.input_directory,
+                      catalog_tt_output=self.catalog_tt_input,
+                      processes=self.processes)
+        ph2dt.run()
 
     def prepare_cc_tt_input(self):
+        """Prepare the cross correlation differential time input for hypoDD.
+
+        The cross correlation differential time input is the file normally
+        named 'dt.cc'. Waveforms are fetched from the client. The event pairs
+        are taken from the catalog travel time input when there is one, and
+        are the catalog events within ph2dt_control.maxsep otherwise.
+        """
         print "preparing cross correlation differential time input: {}".format(
                                                     self.catalog_cc_input
                                                     )
-        # TODO(@ogalanis)
+        pairs_input = None
+        if self.catalog_tt_input is not None:
+            pairs_input = "{}/{}".format(self.input_directory,
+                                         self.catalog_tt_input
+                                         )
+        correlator = CrossCorrelator(self.get_arrays(), self.client,
+                                     control=self.hypoDD_control,
+                                     output_directory=self.input_directory,
+                                     catalog_cc_output=self.catalog_cc_input,
+                                     waveform_cache=self.waveform_cache,
+                                     processes=self.processes)
+        correlator.run(pairs_input=pairs_input,
+                       maxsep=self.ph2dt_control.maxsep)
 
     def prepare_all(self):
         """Prepare all input files for hypoDD.
@@ -176,6 +223,7 @@ class HypoDDInput:
         Initial hypocenter input, normally named 'event.dat'
         Station input, normally named 'station.dat'
         Catalog travel time input, normally named 'dt.ct'
+        Cross correlation differential time input, normally named 'dt.cc'
         """
         print "preparing hypoDD input"
         print "working directory is {}".format(self.input_directory)
@@ -184,6 +232,6 @@ class HypoDDInput:
         if self.catalog_tt_input is not None:
             self.prepare_catalog_tt_input()
         if self.catalog_cc_input is not None:
-            self.prepare_catalog_cc_input()
+            self.prepare_cc_tt_input()
     
 
@@ -0,0 +1,149 @@
+"""Parsing of the iteration summaries that hypoDD writes while it runs.
+
+After every iteration hypoDD prints a line with the iteration number, the
+percentage of events and data still used, the RMS residuals, the mean
+shifts of the hypocenters and the condition number of the system, e.g.
+
+   IT   EV  CT  CC    RMSCT      RMSCC   RMSST   DX   DY   DZ   DT   OS  AQ  CND
+         %   %   %   ms     %   ms     %    ms    m    m    m   ms    m
+    1  100 100   0    268  -18.4     0    0.0    0 1211  239  228  411   50   0   43
+
+The columns depend on the data used (IDAT): runs with only cross
+correlation or only catalog data print no CT or no CC columns. Iteration
+lines are therefore parsed against the column names of the last header
+line. Iterations in which outliers were removed carry a letter after the
+iteration number. With LSQR (ISOLV = 2) the condition number is estimated
+by LSQR and depends on the damping.
+"""
+import re
+
+# The columns of an iteration line.
+ITERATION_FIELDS = ("it", "ev", "ct", "cc", "rmsct", "rmsct_change", "rmscc",
+                    "rmscc_change", "rmsst", "dx", "dy", "dz", "dt", "os",
+                    "aq", "cnd")
+
+# The fields of every column name of a header line. The RMS residuals are
+# followed by their change since the last iteration, in %.
+HEADER_FIELDS = {"IT": ("it",), "EV": ("ev",), "CT": ("ct",), "CC": ("cc",),
+                 "RMSCT": ("rmsct", "rmsct_change"),
+                 "RMSCC": ("rmscc", "rmscc_change"), "RMSST": ("rmsst",),
+                 "DX": ("dx",), "DY": ("dy",), "DZ": ("dz",), "DT": ("dt",),
+                 "OS": ("os",), "AQ": ("aq",), "CND": ("cnd",)}
+
+# Line formats of the cluster header, iteration header and iteration lines.
+CLUSTER_FORMAT = "RELOCATION OF CLUSTER: {:d}\n"
+ITERATION_HEADER = ("  IT   EV  CT  CC    RMSCT      RMSCC   RMSST   DX   DY"
+                    "   DZ   DT   OS  AQ  CND\n")
+ITERATION_FORMAT = ("{it:3d} {ev:5.0f} {ct:3.0f} {cc:3.0f} {rmsct:6.0f} "
+                    "{rmsct_change:6.1f} {rmscc:6.0f} {rmscc_change:6.1f} "
+                    "{rmsst:5.0f} {dx:4.0f} {dy:4.0f} {dz:4.0f} {dt:4.0f} "
+                    "{os:4.0f} {aq:3.0f} {cnd:5.0f}\n")
+
+CLUSTER_PATTERN = re.compile(r"RELOCATION OF CLUSTER:?\s*(\d+)")
+ITERATION_PATTERN = re.compile(r"^\s*(\d+)[a-zA-Z*]?\s")
+
+
+def parse_iteration_header(line):
+    """Parse the header line hypoDD prints above its iteration lines.
+
+    Returns the fields of the columns of the iteration lines that follow,
+    or None if the line is not an iteration header.
+    """
+    names = line.split()
+    if names[:2] != ["IT", "EV"] or \
+       not all(name in HEADER_FIELDS for name in names):
+        return None
+    return tuple(field for name in names for field in HEADER_FIELDS[name])
+
+
+def parse_iteration_line(line, fields=ITERATION_FIELDS):
+    """Parse an iteration line of hypoDD.
+
+    Arguments:
+    line: The line.
+    fields: The fields of its columns, from the last header line (see
+            parse_iteration_header). The default is the layout of runs with
+            both cross correlation and catalog data.
+    Returns a dictionary with the fields of ITERATION_FIELDS, those missing
+    from fields set to 0, or None if the line is not an iteration line.
+    """
+    match = ITERATION_PATTERN.match(line)
+    if match is None:
+        return None
+    values = line[match.end():].split()
+    if len(values) != len(fields) - 1:
+        return None
+    try:
+        values = [float(value) for value in values]
+    except ValueError:
+        return None
+    iteration = dict.fromkeys(ITERATION_FIELDS, 0.0)
+    iteration.update(zip(fields[1:], values))
+    iteration["it"] = int(match.group(1))
+    return iteration
+
+
+def parse_cluster_line(line):
+    """Return the cluster number of a cluster header line of hypoDD, or
+    None.
+    """
+    match = CLUSTER_PATTERN.search(line)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def format_iteration(iteration):
+    """Format an iteration, a dictionary with the fields of
+    ITERATION_FIELDS, as hypoDD prints it.
+    """
+    return ITERATION_FORMAT.format(**iteration)
+
+
+def read_iterations(filename):
+    """Read the iteration lines of a hypoDD output or log file.
+
+    Returns a list of dictionaries with the fields of ITERATION_FIELDS and
+    the cluster they belong to (0 if hypoDD did not report clusters).
+    """
+    iterations = []
+    cluster = 0
+    fields = ITERATION_FIELDS
+    with open(filename, "r") as f:
+        for line in f:
+            number = parse_cluster_line(line)
+            if number is not None:
+                cluster = number
+                continue
+            header = parse_iteration_header(line)
+            if header is not None:
+                fields = header
+                continue
+            iteration = parse_iteration_line(line, fields)
+            if iteration is not None:
+                iteration["cluster"] = cluster
+                iterations.append(iteration)
+    return iterations
+
+
+def summarize_iterations(iterations):
+    """Summarize the iterations of a run.
+
+    Returns a dictionary with the number of iterations, the RMS residuals of
+    the last iteration of every cluster (averaged over the clusters, in ms)
+    and the smallest, largest and last condition numbers.
+    """
+    if not iterations:
+        return {"iterations": 0}
+    last = {}
+    for iteration in iterations:
+        last[iteration["cluster"]] = iteration
+    final = list(last.values())
+    cnd = [iteration["cnd"] for iteration in iterations]
+    mean = lambda name: sum(it[name] for it in final) / float(len(final))
+    return {"iterations": len(iterations),
+            "rmsct": mean("rmsct"),
+            "rmscc": mean("rmscc"),
+            "cnd_min": min(cnd),
+            "cnd_max": max(cnd),
+            "cnd_last": final[-1]["cnd"]}
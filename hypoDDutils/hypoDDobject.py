@@ -1,23 +1,35 @@
-from subprocess import call
 import os
-import math
-from obspy.core.event import Event,Origin,Catalog
-from obspy.core.event.base import CreationInfo
-from obspy.core.event.magnitude import Magnitude
 from ph2dtControl import Ph2dtControl
 from ph2dtInput import Ph2dtInput
 from hypoDDcontrol import HypoDDControl
 from hypoDDinput import HypoDDInput
-from cluster import Cluster
-from connectedness import Connectedness
-from obspy.core.utcdatetime import UTCDateTime
-import info
+from connectedness import build_connectedness
+from hypoDDoutput import read_reloc, group_clusters
+from hypoDDlog import read_iterations
+from progressMonitor import convergence_curves
+from catalogArrays import CatalogArrays, as_catalog_arrays
+from ph2dt import Ph2dt, read_station_input
+from pickWeight import default_weight
+from clusterPartition import ClusterPartition
+from tiling import TilePlanner
+from sweep import Sweep
+from bootstrap import Bootstrap
+from ddSolver import DDSolver
+from columnarExport import export_outputs
+from executor import default_executor
+from instrumentation import null_stage
+from resultCache import (arrays_fingerprint, executable_identity,
+                         fingerprint)
 
 class HypoDDObject:
     """ Describes a run of the hypoDD earthquake location program.
 
     Attributes:
-    catalog: A Catalog object containing the earthquakes to be processed.
+    catalog: A Catalog object containing the earthquakes to be processed. Any
+             iterable of events works as well, e.g. the generators of
+             eventStream, in which case the events are streamed into
+             catalog_arrays and never held in memory together. A
+             CatalogArrays object is used as it is.
     client: A Client object used to acquire event/station information.
     directory: The working directory.
     ph2dt_executable: The name of the ph2dt executable.
@@ -26,11 +38,45 @@ class HypoDDObject:
     ph2dt_input: A Ph2dtInput object describing the ph2dt input.
     hypoDD_control: A HypoDDControl object describing the hypoDD parameters.
     hypoDD_input: A HypoDDInput object describing the hypoDD input.
+    native_ph2dt: If True, run_ph2dt uses the native ph2dt implementation
+                  instead of the ph2dt executable.
+    native_hypoDD: If True, run_hypoDD relocates the events with the
+                   in-process double-difference solver (see ddSolver)
+                   instead of the hypoDD executable.
+    catalog_arrays: A CatalogArrays object extracted from the catalog, shared
+                    by all input files.
+    pick_weight: A function mapping a pick and its arrival to the pick
+                 weight used by ph2dt (see pickWeight).
+    executor: The Executor that runs the ph2dt and hypoDD executables. The
+              process-wide default_executor if None.
+    result_cache: A ResultCache to restore the outputs of ph2dt and hypoDD
+                  from when their inputs have not changed. None to always
+                  run them.
+    uncertainties: OriginUncertainty objects of the relocated events, keyed
+                   by hypoDD ID, from run_bootstrap. None if they have not
+                   been estimated.
+    instrumentation: An Instrumentation that measures prepare_all,
+                     run_ph2dt, run_hypoDD and get_results as stages, with
+                     their input and output files. None to not measure them.
+    processes: Number of worker processes of the native ph2dt. None to use
+               all cores.
+    convergence: The convergence curves of the last hypoDD run, keyed by
+                 cluster (see progressMonitor.convergence_curves), read from
+                 its iteration log. None if they have not been read.
     Methods:
     __init__: Initialization method.
+    get_catalog_arrays: Extract the catalog into columnar arrays, once.
+    ph2dt_fingerprint, hypoDD_fingerprint: Fingerprints of the inputs of
+                                           ph2dt and hypoDD.
     prepare_all: Prepare control and input files for ph2dt and hypoDD.
     run_ph2dt: Run ph2dt with the current configuration.
     run_hypODD: Run hypoDD with the current configuration.
+    run_hypoDD_clusters: Run hypoDD separately on every cluster, in parallel.
+    run_tiled: Run ph2dt and hypoDD on overlapping spatial tiles, in parallel.
+    run_sweep: Run ph2dt and hypoDD over many parameter combinations.
+    run_bootstrap: Estimate relocation uncertainties from resampled runs.
+    get_results: Read the hypoDD output into a list of Cluster objects.
+    export_results: Export the hypoDD outputs to npz, Parquet or HDF5.
     """
 
     catalog = None
@@ -42,9 +88,22 @@ class HypoDDObject:
     ph2dt_input = Ph2dtInput(catalog)
     hypoDD_control = HypoDDControl()
     hypoDD_input = HypoDDInput(catalog, client, directory)
+    native_ph2dt = False
+    native_hypoDD = False
+    catalog_arrays = None
+    pick_weight = staticmethod(default_weight)
+    executor = None
+    result_cache = None
+    uncertainties = None
+    instrumentation = None
+    processes = None
+    convergence = None
 
     def __init__(self, catalog=None, client=None, directory=".",
-                 ph2dt_executable="ph2dt", hypoDD_executable="hypoDD"
+                 ph2dt_executable="ph2dt", hypoDD_executable="hypoDD",
+                 native_ph2dt=False, pick_weight=default_weight,
+                 executor=None, result_cache=None, native_hypoDD=False,
+                 instrumentation=None, processes=None
                  ):
         """ Initialization method for HypoDDObject.
         """
@@ -56,132 +115,403 @@ class HypoDDObject:
         self.ph2dt_control = Ph2dtControl(control_directory=directory)
         self.ph2dt_input = Ph2dtInput(catalog, input_directory=directory)
         self.hypoDD_control = HypoDDControl(control_directory=directory)
-        self.hypoDD_input = HypoDDInput(catalog, client, directory)
+        self.hypoDD_input = HypoDDInput(catalog, client, directory,
+                                        ph2dt_control=self.ph2dt_control,
+                                        hypoDD_control=self.hypoDD_control)
+        self.native_ph2dt = native_ph2dt
+        self.native_hypoDD = native_hypoDD
+        self.catalog_arrays = None
+        self.pick_weight = pick_weight
+        self.executor = executor
+        self.result_cache = result_cache
+        self.uncertainties = None
+        self.instrumentation = instrumentation
+        self.processes = processes
+        self.convergence = None
+
+    def get_executor(self):
+        """ Return the Executor that runs the executables.
+        """
+        if self.executor is None:
+            return default_executor
+        return self.executor
+
+    def _stage(self, name, filenames=()):
+        files = [self._path(filename) for filename in filenames if filename]
+        if self.instrumentation is None:
+            return null_stage(name, files)
+        return self.instrumentation.stage(name, files)
+
+    def get_catalog_arrays(self):
+        """ Extract the catalog into columnar arrays.
+
+        The catalog is only walked the first time. The same arrays are used
+        for all the input files of ph2dt and hypoDD.
+        """
+        if self.catalog_arrays is None:
+            self.catalog_arrays = as_catalog_arrays(
+                                               self.catalog,
+                                               pick_weight=self.pick_weight)
+        return self.catalog_arrays
 
     def prepare_all(self):
         """ Prepare control and input files for ph2dt and hypoDD.
+
+        The hypoDD inputs are prepared first, so that the picks and events
+        that cannot contribute to ph2dt are left out of its phase data
+        input, using the coordinates of the station input (see
+        pickFilter).
         """
-        self.ph2dt_control.write_control_file()
-        self.hypoDD_control.write_control_file()
-        self.ph2dt_input.prepare_catalog_abs_tt_input()
-        self.hypoDD_input.prepare_all()
+        hypoDD_input = self.hypoDD_input
+        with self._stage("prepare_all",
+                         (self.ph2dt_input.catalog_abs_tt_input,
+                          hypoDD_input.hypocenter_input,
+                          hypoDD_input.station_input,
+                          hypoDD_input.catalog_tt_input,
+                          hypoDD_input.catalog_cc_input)) as stage:
+            self.ph2dt_control.write_control_file()
+            self.hypoDD_control.write_control_file()
+            arrays = self.get_catalog_arrays()
+            stage.count("events", len(arrays))
+            stage.count("picks", len(arrays.pick_stations))
+            self.ph2dt_input.arrays = arrays
+            hypoDD_input.arrays = arrays
+            hypoDD_input.prepare_all()
+            self.ph2dt_input.station_coordinates = read_station_input(
+                                   self._path(hypoDD_input.station_input))
+            self.ph2dt_input.control = self.ph2dt_control
+            self.ph2dt_input.dist = self.hypoDD_control.dist
+            self.ph2dt_input.prepare_catalog_abs_tt_input()
+            report = self.ph2dt_input.prefilter_report
+            if report is not None:
+                stage.count("prefiltered_picks", report["removed_picks"])
+                stage.count("prefiltered_events", report["removed_events"])
+
+    def _path(self, filename):
+        return "{}/{}".format(self.directory, filename)
+
+    def _ph2dt_outputs(self):
+        catalog_tt_output = "dt.ct"
+        if self.native_ph2dt:
+            catalog_tt_output = self.hypoDD_control.ct_dt_input
+        return [catalog_tt_output, "event.sel", "station.sel",
+                "ph2dt.log.out"]
 
-    def run_ph2dt(self):
+    def _hypoDD_outputs(self):
+        control = self.hypoDD_control
+        return [name for name in (control.initial_hypocenters_output,
+                                  control.relocated_hypocenters_output,
+                                  control.station_residual_output,
+                                  control.data_residual_output,
+                                  control.takeoff_angle_output,
+                                  "hypoDD.log.out") if name]
+
+    def ph2dt_fingerprint(self):
+        """ Return a fingerprint of the inputs of ph2dt.
+
+        It covers the catalog arrays, the station input, the text of the
+        ph2dt control file, the phase data input when the executable is
+        run (it is pre-filtered) and the identity of the executable (or of
+        the native implementation).
+        """
+        if self.native_ph2dt:
+            executable = "native:" + self.hypoDD_control.ct_dt_input
+        else:
+            executable = executable_identity(self._path(
+                                                 self.ph2dt_executable))
+        files = [self.ph2dt_control.control_file,
+                 self.ph2dt_control.station_input]
+        if not self.native_ph2dt:
+            files.append(self.ph2dt_control.phase_data)
+        return fingerprint(["ph2dt", executable,
+                            arrays_fingerprint(self.get_catalog_arrays())],
+                           [self._path(name) for name in files])
+
+    def hypoDD_fingerprint(self):
+        """ Return a fingerprint of the inputs of hypoDD.
+
+        It covers the text of the hypoDD control file, the hypocenter,
+        station and differential time inputs and the identity of the
+        executable (or of the native solver).
+        """
+        control = self.hypoDD_control
+        files = [control.control_file, control.initial_hypocenters,
+                 control.station_input, control.ct_dt_input,
+                 control.cc_dt_input]
+        if self.native_hypoDD:
+            executable = "native"
+        else:
+            executable = executable_identity(self._path(
+                                                 self.hypoDD_executable))
+        return fingerprint(["hypoDD", executable],
+                           [self._path(name) for name in files if name])
+
+    def _restore(self, stage, key):
+        if self.result_cache is None:
+            return False
+        if self.result_cache.restore(key, self.directory) is None:
+            return False
+        print "{} inputs unchanged, outputs restored from cache".format(stage)
+        return True
+
+    def _store(self, key, filenames):
+        if self.result_cache is not None:
+            self.result_cache.store(key, self.directory, filenames)
+
+    def _finish(self, monitor):
+        if monitor is not None and hasattr(monitor, "finish"):
+            monitor.finish()
+
+    def _read_convergence(self):
+        log_file = self._path("hypoDD.log.out")
+        if not os.path.isfile(log_file):
+            return {}
+        return convergence_curves(read_iterations(log_file))
+
+    def run_ph2dt(self, monitor=None):
         """ Run ph2dt with the current configuration.
+
+        The executable is run in the working directory, with its output
+        written to 'ph2dt.log.out' there. If the inputs of ph2dt are found
+        in result_cache, its outputs are restored instead. Returns a
+        RunResult, or None for the native implementation and for restored
+        outputs.
+
+        Arguments:
+        monitor: A callable called with every line the executable prints,
+                 while it runs, which stops the run by returning True (see
+                 Executor.run). Its finish method, if any, is called when
+                 the run is over. Not used by the native implementation.
         """
-        cwd=os.getcwd()
-        os.chdir(self.directory)
-        call(["./"+self.ph2dt_executable, self.ph2dt_control.control_file])
-        os.chdir(cwd)
+        with self._stage("run_ph2dt",
+                         (self.ph2dt_control.phase_data,
+                          self.hypoDD_control.ct_dt_input)) as stage:
+            key = None
+            if self.result_cache is not None:
+                key = self.ph2dt_fingerprint()
+                if self._restore("ph2dt", key):
+                    stage.count("restored", 1)
+                    return None
+            result = None
+            if self.native_ph2dt:
+                station_filename = self._path(self.ph2dt_control.station_input)
+                ph2dt = Ph2dt(self.get_catalog_arrays(),
+                              read_station_input(station_filename),
+                              control=self.ph2dt_control,
+                              output_directory=self.directory,
+                              catalog_tt_output=self.hypoDD_control.ct_dt_input,
+                              processes=self.processes)
+                ph2dt.run()
+            else:
+                try:
+                    result = self._run_executable(
+                                 self.ph2dt_executable,
+                                 self.ph2dt_control.control_file,
+                                 "ph2dt.log.out", monitor)
+                finally:
+                    self._finish(monitor)
+                stage.add_run(result)
+            if key is not None and (result is None or result.ok):
+                self._store(key, self._ph2dt_outputs())
+            return result
+
+    def run_hypoDD(self, monitor=None):
+        """ Run hypoDD with the current configuration.
 
-    def run_hypoDD(self):
-        """ Run hypoDD with the current configuration. 
+        The executable is run in the working directory, with its output
+        written to 'hypoDD.log.out' there. If the inputs of hypoDD are found
+        in result_cache, its outputs are restored instead. The convergence
+        curves of the run are read into convergence. Returns a RunResult,
+        or None for the native solver and for restored outputs.
+
+        Arguments:
+        monitor: A callable called with every line hypoDD prints, while it
+                 runs, e.g. a progressMonitor.ProgressMonitor. If it returns
+                 True, the executable is killed, or the native solver stops
+                 iterating. Its finish method, if any, is called when the
+                 run is over. Runs stopped this way are not stored in
+                 result_cache.
+        """
+        control = self.hypoDD_control
+        with self._stage("run_hypoDD",
+                         (control.ct_dt_input, control.cc_dt_input,
+                          control.relocated_hypocenters_output,
+                          control.data_residual_output)) as stage:
+            key = None
+            if self.result_cache is not None:
+                key = self.hypoDD_fingerprint()
+                if self._restore("hypoDD", key):
+                    stage.count("restored", 1)
+                    return None
+            result = None
+            stopped = False
+            try:
+                if self.native_hypoDD:
+                    solver = DDSolver(control, directory=self.directory,
+                                      monitor=monitor)
+                    solver.run()
+                    stopped = solver.stopped
+                else:
+                    result = self._run_executable(self.hypoDD_executable,
+                                                  control.control_file,
+                                                  "hypoDD.log.out", monitor)
+                    stage.add_run(result)
+            finally:
+                self._finish(monitor)
+            self.convergence = self._read_convergence()
+            stage.count("iterations", sum(len(curve["it"]) for curve in
+                                          self.convergence.values()))
+            if key is not None and not stopped and \
+               (result is None or result.ok):
+                self._store(key, self._hypoDD_outputs())
+            return result
+
+    def _run_executable(self, executable, control_file, log_file,
+                        monitor=None):
+        result = self.get_executor().run(
+                     ["./" + executable, control_file], cwd=self.directory,
+                     log_file=os.path.join(self.directory, log_file),
+                     line_callback=monitor)
+        print "{} finished with exit status {} in {:.1f} s".format(
+                                                         executable,
+                                                         result.returncode,
+                                                         result.runtime)
+        return result
+
+    def run_hypoDD_clusters(self, processes=None):
+        """ Run hypoDD separately on every cluster, in parallel.
+
+        The clusters are found from the differential time input, every one
+        is relocated in its own subdirectory and the outputs are merged, so
+        that get_results works as after run_hypoDD. Returns the RunResult
+        of every cluster run.
+
+        Arguments:
+        processes: Number of concurrent hypoDD runs. None to use the limit of
+                   the executor.
+        """
+        partition = ClusterPartition(self.hypoDD_control,
+                                     directory=self.directory,
+                                     executable=self.hypoDD_executable,
+                                     processes=processes,
+                                     executor=self.executor,
+                                     native_hypoDD=self.native_hypoDD)
+        return partition.run()
+
+    def run_tiled(self, max_events=3000, max_data=1000000, max_stations=300,
+                  margin=0.0, processes=None):
+        """ Run ph2dt and hypoDD on overlapping spatial tiles, in parallel.
+
+        For catalogs that exceed the limits the hypoDD binary was compiled
+        with. The station input must have been prepared (see prepare_all).
+        The relocations of the tiles are stitched into the relocated
+        hypocenter output, so that get_results works as after run_hypoDD.
+        Returns the list of Tile objects, with their statistics.
+
+        Arguments:
+        max_events, max_data, max_stations: The MAXEVE, MAXDATA and MAXSTA
+            limits of the hypoDD binary.
+        margin: Minimum overlap of the tiles in km. At least the MAXSEP of
+                ph2dt_control is used.
+        processes: Number of tiles run concurrently. None to use all cores.
+        """
+        planner = TilePlanner(self, max_events=max_events, max_data=max_data,
+                              max_stations=max_stations, margin=margin,
+                              processes=processes)
+        return planner.run()
+
+    def run_sweep(self, designs, processes=None):
+        """ Run ph2dt and hypoDD over many parameter combinations.
+
+        The input files must have been prepared (see prepare_all). Returns
+        the table of parameters and metrics of every run (see Sweep).
+
+        Arguments:
+        designs: The list of parameter combinations, e.g. from sweep.grid,
+                 sweep.random_design or sweep.latin_hypercube.
+        processes: Number of concurrent runs. None to use the limit of the
+                   executor.
         """
-        cwd=os.getcwd()
-        os.chdir(self.directory)
-        call(["./"+self.hypoDD_executable, self.hypoDD_control.control_file])
-        os.chdir(cwd)
+        return Sweep(self, designs, processes=processes).run()
+
+    def run_bootstrap(self, mode="residuals", realisations=200,
+                      drop_fraction=0.1, seed=None, processes=None):
+        """ Estimate relocation uncertainties from resampled runs of hypoDD.
+
+        hypoDD must have been run (see run_hypoDD). The uncertainties are
+        kept in uncertainties and added to the origins of the clusters of
+        get_results. Returns them.
+
+        Arguments:
+        mode: 'residuals', 'stations' or 'events' (see bootstrap.Bootstrap).
+        realisations: The number of resampled runs.
+        drop_fraction: The fraction of stations or events dropped in every
+                       run of the 'stations' and 'events' modes.
+        seed: The seed of the random number generator.
+        processes: Number of concurrent runs. None to use the limit of the
+                   executor.
+        """
+        bootstrap = Bootstrap(self, mode=mode, realisations=realisations,
+                              drop_fraction=drop_fraction, seed=seed,
+                              processes=processes)
+        self.uncertainties = bootstrap.run()
+        return self.uncertainties
 
     def get_results(self):
-        cids = []
-        clusters = []
-        results_file = "{}/{}".format(self.hypoDD_control.control_directory,
-                              self.hypoDD_control.relocated_hypocenters_output
-                              )
-        residuals_file = "{}/{}".format(self.hypoDD_control.control_directory,
-                                        self.hypoDD_control.data_residual_output
-                                        )
-        with open(results_file, "r") as f:
-            for line in f:
-                num = line.split()
-                evid = num[0]
-                lat = float(num[1])
-                lon = float(num[2])
-                dep = 1000 * float(num[3])  # km to m
-                errx = num[7]
-                erry = num[8]
-                errz = num[9]
-                yr = int(num[10])
-                mo = int(num[11])
-                dy = int(num[12])
-                hr = int(num[13])
-                mi = int(num[14])
-                sc = float(num[15])
-                mag = num[16]
-                nccp = num[17]
-                nccs = num[18]
-                nctp = num[19]
-                ncts = num[20]
-                rcc = num[21]
-                rct = num[22]
-                cid = num[23]
-                if cid not in cids:
-                    cids.append(cid)
-                    clusters.append(Cluster())
-                    clusters[-1].hypoDD_id=cid
-                    clusters[-1].successful_relocation=True
-                    clusters[-1].catalog=Catalog()
-                    clusters[-1].event_ids=[]
-                origin=Origin()
-                isec = int ( math.floor( sc ))
-                micsec = int ( ( sc - isec) * 1000000 )
-                origin.time = UTCDateTime(yr, mo, dy, hr, mi, isec, micsec)
-                origin.longitude = lon
-                origin.latitude = lat
-                origin.depth = dep
-                origin.method_id = "hypoDD"
-                # TODO (@ogalanis): Add time/location errors (when
-                # appropriate. Add quality and origin_uncertainty. Add arrivals.
-                event=Event()
-                event.creation_info=CreationInfo()
-                event.creation_info.author = __package__
-                event.creation_info.version = info.__version__
-                event.origins=[origin]
-                event.magnitude=Magnitude()
-                event.magnitude.mag=mag
-                idx=cids.index(cid)
-                clusters[idx].catalog.events.append(event)
-                clusters[idx].event_ids.append(evid)
-
-        if self.hypoDD_control.cid != 0 :
-            my_list = []
-            clusters[0].connectedness = Connectedness()
-            with open(residuals_file, "r") as f:
-                for line in f:
-                    num = line.split()
-                    evid_1 = num[2]
-                    evid_2 = num[3]
-                    obs_type = num[4]
-                    if obs_type == "1":
-                        my_list = clusters[0].connectedness.cross_corr_P
-                    elif obs_type == "2":
-                        my_list = clusters[0].connectedness.cross_corr_S
-                    elif obs_type == "3":
-                        my_list = clusters[0].connectedness.catalog_P
-                    elif obs_type == "4":
-                        my_list = clusters[0].connectedness.catalog_S
-                    else:
-                        continue
-                    in_list = [x for x in my_list if (( x[0] == evid_1 and
-                                                        x[1] == evid_2
-                                                        ) or
-                                                      ( x[0] == evid_2 and
-                                                        x[1] == evid_1
-                                                        ))]
-                    if in_list:
-                        for x in my_list:
-                            if (( x[0] == evid_1 and
-                                  x[1] == evid_2
-                                  ) or
-                                ( x[0] == evid_2 and
-                                  x[1] == evid_1
-                                  )):
-                                x[2] += 1
-                    else:
-                        my_list.append([evid_1,evid_2,1])
-
-        return clusters
+        """ Read the hypoDD output into a list of Cluster objects.
+
+        The relocated hypocenter output is parsed in a single pass. The obspy
+        Catalog of each cluster is only built when it is first accessed.
+        When the input was prepared from catalog_arrays, every cluster also
+        gets its relocated events with their picks as a CatalogArrays. If
+        a data residual output is available, the connectedness of every
+        cluster is counted from it. Uncertainties from run_bootstrap and the
+        convergence curves of hypoDD are added to the clusters.
+        """
+        control = self.hypoDD_control
+        results_file = "{}/{}".format(control.control_directory,
+                                      control.relocated_hypocenters_output)
+        residuals_file = "{}/{}".format(control.control_directory,
+                                        control.data_residual_output)
+        with self._stage("get_results") as stage:
+            stage.add_file(results_file)
+            records = read_reloc(results_file)
+            clusters = group_clusters(records)
+            stage.count("events", len(records))
+            stage.count("clusters", len(clusters))
+            if self.catalog_arrays is not None:
+                for cluster in clusters:
+                    cluster.arrays = CatalogArrays.from_reloc(
+                                         cluster.relocations,
+                                         self.catalog_arrays)
+            if self.uncertainties is not None:
+                for cluster in clusters:
+                    cluster.uncertainties = dict(
+                        (evid, self.uncertainties[evid])
+                        for evid in cluster.event_ids.tolist()
+                        if evid in self.uncertainties)
+            if self.convergence is None:
+                self.convergence = self._read_convergence()
+            for cluster in clusters:
+                cluster.convergence = self.convergence.get(cluster.hypoDD_id)
 
+            if (control.data_residual_output and
+                    os.path.isfile(residuals_file)):
+                stage.add_file(residuals_file)
+                build_connectedness(residuals_file, clusters)
 
+            return clusters
 
+    def export_results(self, filename, file_format="npz"):
+        """ Export the hypoDD output files as typed columns.
 
+        The relocated hypocenters, initial locations, station and source
+        outputs and the data residuals are written to a single file, with
+        event, cluster and station IDs dictionary encoded (see
+        columnarExport).
+
+        Arguments:
+        filename: The output file, or the output directory for Parquet.
+        file_format: One of 'npz', 'parquet' and 'hdf5'.
+        """
+        export_outputs(self.hypoDD_control, filename, file_format=file_format)
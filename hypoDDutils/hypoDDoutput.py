@@ -0,0 +1,334 @@
+import os
+import numpy as np
+from obspy.core.event import Event, Origin, Catalog
+from obspy.core.event.base import CreationInfo
+from obspy.core.event.magnitude import Magnitude
+from obspy.core.utcdatetime import UTCDateTime
+from cluster import Cluster
+from catalogArrays import format_lines, WRITE_BUFFER_SIZE
+import info
+
+# Column layout of the relocated hypocenter output ('hypoDD.reloc'). Depth is
+# in km, the cartesian coordinates and their errors in m, and the residuals
+# in ms, as written by hypoDD.
+RELOC_DTYPE = np.dtype([("evid", np.int64),
+                        ("lat", np.float64),
+                        ("lon", np.float64),
+                        ("depth", np.float64),
+                        ("x", np.float64),
+                        ("y", np.float64),
+                        ("z", np.float64),
+                        ("ex", np.float64),
+                        ("ey", np.float64),
+                        ("ez", np.float64),
+                        ("year", np.int32),
+                        ("month", np.int32),
+                        ("day", np.int32),
+                        ("hour", np.int32),
+                        ("minute", np.int32),
+                        ("second", np.float64),
+                        ("mag", np.float64),
+                        ("nccp", np.int32),
+                        ("nccs", np.int32),
+                        ("nctp", np.int32),
+                        ("ncts", np.int32),
+                        ("rcc", np.float64),
+                        ("rct", np.float64),
+                        ("cid", np.int32)
+                        ])
+
+# Column layout of the data residual output ('hypoDD.res'). DT is in s, the
+# residual in ms and the offset in m. IDX is the data type: 1 and 2 for
+# cross correlation P and S, 3 and 4 for catalog P and S.
+RES_DTYPE = np.dtype([("sta", "S7"),
+                      ("dt", np.float64),
+                      ("c1", np.int64),
+                      ("c2", np.int64),
+                      ("idx", np.int32),
+                      ("qual", np.float64),
+                      ("res", np.float64),
+                      ("wt", np.float64),
+                      ("offs", np.float64)
+                      ])
+
+# Column layout of the station residual output ('hypoDD.sta'). The distance
+# to the cluster centroid is in m and the residuals in ms.
+STA_DTYPE = np.dtype([("sta", "S7"),
+                      ("lat", np.float64),
+                      ("lon", np.float64),
+                      ("dist", np.float64),
+                      ("az", np.float64),
+                      ("nccp", np.int32),
+                      ("nccs", np.int32),
+                      ("nctp", np.int32),
+                      ("ncts", np.int32),
+                      ("rcc", np.float64),
+                      ("rct", np.float64),
+                      ("cid", np.int32)
+                      ])
+
+# Column layout of the take-off angle output ('hypoDD.src'): the event, the
+# station, the epicentral distance in km, the azimuth and the take-off angle
+# in degrees.
+SRC_DTYPE = np.dtype([("evid", np.int64),
+                      ("sta", "S7"),
+                      ("dist", np.float64),
+                      ("az", np.float64),
+                      ("angle", np.float64)
+                      ])
+
+# Size in bytes of the blocks in which the data residual output is read.
+RES_CHUNK_SIZE = 1 << 24
+
+# Line format of the relocated hypocenter output, as written by hypoDD.
+RELOC_FORMAT = ("%9d %10.6f %11.6f %9.3f %10.1f %10.1f %10.1f %8.1f %8.1f "
+                "%8.1f %4d %2d %2d %2d %2d %6.3f %4.1f %5d %5d %5d %5d "
+                "%6.3f %6.3f %3d\n")
+
+# Header and line format of the data residual output, as written by hypoDD.
+RES_HEADER = "STA DT C1 C2 IDX QUAL RES WT OFFS\n"
+RES_FORMAT = "%-7s %12.7f %9d %9d %1d %9.4f %12.6f %11.6f %8.1f\n"
+
+
+def _read_table(filename, dtype):
+    """Read a whitespace separated, purely numeric hypoDD output file.
+
+    The whole file is parsed in a single call to numpy and every line is
+    expected to hold one value per field of dtype.
+    """
+    with open(filename, "r") as f:
+        text = f.read()
+    ncols = len(dtype.names)
+    nlines = text.count("\n")
+    if text and not text.endswith("\n"):
+        nlines += 1
+    values = np.fromstring(text, sep=" ")
+    if values.size != ncols * nlines:
+        raise ValueError("{}: expected {} values per line on {} lines, "
+                         "parsed {} values".format(filename, ncols, nlines,
+                                                   values.size))
+    values = values.reshape(nlines, ncols)
+    records = np.empty(nlines, dtype=dtype)
+    for col, name in enumerate(dtype.names):
+        records[name] = values[:, col]
+    return records
+
+
+def _parse_lines(text, dtype, start_of_file=False):
+    """Parse complete lines of a whitespace separated hypoDD output.
+
+    At the start of the file, a first line holding the names of the fields
+    of dtype in upper case (e.g. RES_HEADER) is skipped. Other lines that do
+    not hold one value per field of dtype are skipped too. Returns a
+    structured array.
+    """
+    ncols = len(dtype.names)
+    if start_of_file:
+        header = [name.upper() for name in dtype.names]
+        end = text.find("\n") + 1 or len(text)
+        if text[:end].split() == header:
+            text = text[end:]
+    tokens = text.split()
+    lines = text.count("\n") + (1 if text and not text.endswith("\n") else 0)
+    if len(tokens) != ncols * lines:
+        rows = [num for num in (line.split() for line in text.splitlines())
+                if len(num) == ncols]
+        tokens = [token for num in rows for token in num]
+    records = np.empty(len(tokens) // ncols, dtype=dtype)
+    for col, name in enumerate(dtype.names):
+        values = tokens[col::ncols]
+        if dtype[name].kind == "S":
+            records[name] = values
+        else:
+            records[name] = np.fromstring(" ".join(values), sep=" ")
+    return records
+
+
+def iter_table(filename, dtype, chunk_size=RES_CHUNK_SIZE):
+    """Stream a whitespace separated hypoDD output file in blocks.
+
+    Yields structured arrays with the fields of dtype, one per block of
+    about chunk_size bytes of complete lines, so that files of any size can
+    be processed in bounded memory.
+    """
+    with open(filename, "r") as f:
+        rest = ""
+        start_of_file = True
+        while True:
+            block = f.read(chunk_size)
+            if not block:
+                break
+            block = rest + block
+            end = block.rfind("\n") + 1
+            rest = block[end:]
+            if end:
+                yield _parse_lines(block[:end], dtype, start_of_file)
+                start_of_file = False
+        if rest.strip():
+            yield _parse_lines(rest, dtype, start_of_file)
+
+
+def _read_chunks(filename, dtype):
+    chunks = list(iter_table(filename, dtype))
+    if not chunks:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(chunks)
+
+
+def read_reloc(filename):
+    """Read a relocated hypocenter output file ('hypoDD.reloc').
+
+    Returns a numpy structured array with one record per relocated event and
+    the fields of RELOC_DTYPE.
+    """
+    return _read_table(filename, RELOC_DTYPE)
+
+
+def read_loc(filename):
+    """Read an initial hypocenter output file ('hypoDD.loc').
+
+    It has the layout of the relocated hypocenter output. Returns a numpy
+    structured array with the fields of RELOC_DTYPE.
+    """
+    return _read_table(filename, RELOC_DTYPE)
+
+
+def iter_res(filename, chunk_size=RES_CHUNK_SIZE):
+    """Stream a data residual output file ('hypoDD.res') in blocks.
+
+    Yields numpy structured arrays with the fields of RES_DTYPE. The header
+    line is skipped.
+    """
+    return iter_table(filename, RES_DTYPE, chunk_size)
+
+
+def read_res(filename):
+    """Read a data residual output file ('hypoDD.res').
+
+    Returns a numpy structured array with one record per observation and
+    the fields of RES_DTYPE. The header line is skipped.
+    """
+    return _read_chunks(filename, RES_DTYPE)
+
+
+def read_sta(filename):
+    """Read a station residual output file ('hypoDD.sta').
+
+    Returns a numpy structured array with one record per station and
+    cluster and the fields of STA_DTYPE.
+    """
+    return _read_chunks(filename, STA_DTYPE)
+
+
+def read_src(filename):
+    """Read a take-off angle output file ('hypoDD.src').
+
+    Returns a numpy structured array with the fields of SRC_DTYPE.
+    """
+    return _read_chunks(filename, SRC_DTYPE)
+
+
+def iter_outputs(control, directory=None):
+    """Stream all the output files of a hypoDD run that exist.
+
+    Arguments:
+    control: The HypoDDControl object of the run.
+    directory: The directory of the outputs. The control directory of
+               control if None.
+    Yields (name, chunks) tuples, where name is one of 'reloc', 'loc',
+    'sta', 'res' and 'src' and chunks is an iterator of structured arrays.
+    """
+    if directory is None:
+        directory = control.control_directory
+    for name, filename, dtype in (
+            ("reloc", control.relocated_hypocenters_output, RELOC_DTYPE),
+            ("loc", control.initial_hypocenters_output, RELOC_DTYPE),
+            ("sta", control.station_residual_output, STA_DTYPE),
+            ("res", control.data_residual_output, RES_DTYPE),
+            ("src", control.takeoff_angle_output, SRC_DTYPE)):
+        full_filename = "{}/{}".format(directory, filename)
+        if filename and os.path.isfile(full_filename):
+            yield name, iter_table(full_filename, dtype)
+
+
+def write_reloc(filename, records):
+    """Write relocated event records in the format of 'hypoDD.reloc'.
+    """
+    columns = [records[name] for name in RELOC_DTYPE.names]
+    with open(filename, "w", WRITE_BUFFER_SIZE) as f:
+        f.writelines(format_lines(RELOC_FORMAT, columns))
+
+
+def write_res(filename, records):
+    """Write observation records in the format of 'hypoDD.res'.
+    """
+    columns = [records[name] for name in RES_DTYPE.names]
+    columns[0] = columns[0].astype(str).astype(object)
+    with open(filename, "w", WRITE_BUFFER_SIZE) as f:
+        f.write(RES_HEADER)
+        f.writelines(format_lines(RES_FORMAT, columns))
+
+
+def reloc_times(records):
+    """Return the origin times of relocated events as POSIX timestamps.
+    """
+    months = (12 * (records["year"] - 1970) + records["month"] - 1)
+    days = (months.astype("M8[M]").astype("M8[D]") +
+            (records["day"] - 1).astype("m8[D]"))
+    seconds = (days.astype(np.int64) * 86400 + 3600 * records["hour"] +
+               60 * records["minute"])
+    return seconds + records["second"]
+
+
+def reloc_to_catalog(records, uncertainties=None):
+    """Build an obspy Catalog from relocated event records.
+
+    Arguments:
+    records: Relocated event records, as returned by read_reloc.
+    uncertainties: A dictionary of OriginUncertainty objects keyed by event
+                   ID, e.g. from bootstrap.Bootstrap. None for no
+                   uncertainties.
+    """
+    if uncertainties is None:
+        uncertainties = {}
+    catalog = Catalog()
+    times = reloc_times(records)
+    for rec, timestamp in zip(records, times):
+        origin = Origin()
+        origin.time = UTCDateTime(float(timestamp))
+        origin.longitude = float(rec["lon"])
+        origin.latitude = float(rec["lat"])
+        origin.depth = 1000.0 * float(rec["depth"])  # km to m
+        origin.method_id = "hypoDD"
+        origin.origin_uncertainty = uncertainties.get(int(rec["evid"]))
+        # Location errors come from the bootstrap uncertainties above.
+        # TODO (@ogalanis): Add time errors. Add quality. Add arrivals.
+        event = Event()
+        event.creation_info = CreationInfo()
+        event.creation_info.author = __package__
+        event.creation_info.version = info.__version__
+        event.origins = [origin]
+        event.magnitudes = [Magnitude(mag=float(rec["mag"]))]
+        catalog.events.append(event)
+    return catalog
+
+
+def group_clusters(records):
+    """Split relocated event records into Cluster objects.
+
+    Clusters are returned in the order in which they first appear in the
+    records. The catalog of each cluster is only built when it is accessed.
+    """
+    cids, first = np.unique(records["cid"], return_index=True)
+    order = np.argsort(records["cid"], kind="mergesort")
+    bounds = np.searchsorted(records["cid"][order], cids)
+    bounds = np.append(bounds, len(records))
+    clusters = {}
+    for idx, cid in enumerate(cids):
+        cluster = Cluster()
+        cluster.hypoDD_id = int(cid)
+        cluster.successful_relocation = True
+        cluster.relocations = records[order[bounds[idx]:bounds[idx + 1]]]
+        cluster.event_ids = cluster.relocations["evid"]
+        clusters[int(cid)] = cluster
+    return [clusters[int(cids[idx])] for idx in np.argsort(first)]
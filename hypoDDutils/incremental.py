@@ -0,0 +1,371 @@
+import copy
+import os
+import shutil
+import numpy as np
+from scipy.spatial import cKDTree
+from catalogArrays import (CatalogArrays, as_catalog_arrays, write_stations,
+                           WRITE_BUFFER_SIZE)
+from crossCorrelation import CrossCorrelator
+from ddSolver import DDSolver
+from dtFile import index_pairs
+from geodesy import cartesian
+from hypoDDoutput import (read_reloc, write_reloc, reloc_times,
+                          RELOC_DTYPE)
+from ph2dt import Ph2dt, read_station_input
+from stationResolver import StationResolver
+
+# The CatalogArrays attributes stored in the state file.
+ARRAY_FIELDS = ("event_ids", "origin_times", "latitudes", "longitudes",
+                "depths", "magnitudes", "horizontal_errors",
+                "vertical_errors", "rms", "pick_offsets", "pick_stations",
+                "pick_phases", "pick_travel_times", "pick_weights")
+
+
+class IncrementalRelocator:
+    """Relocates new events without rerunning the whole catalog.
+
+    The state of the previous run is kept in a state file: the catalog
+    arrays, the relocated hypocenters and an index of the event pair
+    blocks of the differential time files. When new events arrive, only
+    the pairs involving them are formed, from the new events and their old
+    neighbours within maxsep, and their blocks are appended to 'dt.ct'
+    (and 'dt.cc'). The clusters the new events link to are then relocated
+    together with the new events in a separate workspace, starting from
+    their previous solutions. The solutions of all other events are kept
+    as they are.
+
+    The work done by ph2dt, the cross correlation and hypoDD grows with
+    the number of new events and the size of the clusters they touch.
+    Only the vectorized neighbour search and the rewriting of the state
+    and of the relocated hypocenter output go over the whole catalog.
+
+    Attributes:
+    hypoDD_object: The HypoDDObject of the catalog. Its directory, controls,
+                   executables and file names are used.
+    state_file: The name of the state file, in the directory of
+                hypoDD_object.
+    workspace: The name of the directory where the touched clusters are
+               relocated, in the directory of hypoDD_object.
+    processes: Number of worker processes of ph2dt. None to use all cores.
+    arrays: The CatalogArrays of all events so far.
+    relocations: The relocated hypocenters of all events so far.
+    ct_index, cc_index: (pairs, offsets, lengths) of the blocks of 'dt.ct'
+                        and 'dt.cc', as returned by dtFile.index_pairs.
+    Methods:
+    __init__: Initialization method.
+    initialize: Build the state from a complete run.
+    load_state, save_state: Read and write the state file.
+    add_events: Relocate new events.
+    """
+
+    hypoDD_object = None
+    state_file = "incremental.npz"
+    workspace = "incremental"
+    processes = None
+    arrays = None
+    relocations = None
+    ct_index = None
+    cc_index = None
+
+    def __init__(self, hypoDD_object, state_file="incremental.npz",
+                 workspace="incremental", processes=None
+                 ):
+        """Initialization method for the IncrementalRelocator class.
+        """
+        self.hypoDD_object = hypoDD_object
+        self.state_file = state_file
+        self.workspace = workspace
+        self.processes = processes
+
+    def _path(self, filename):
+        return "{}/{}".format(self.hypoDD_object.directory, filename)
+
+    def _index(self, filename, start=0):
+        if not filename or not os.path.isfile(self._path(filename)):
+            empty = np.zeros(0, dtype=np.int64)
+            return (empty.reshape(0, 2), empty, empty)
+        return index_pairs(self._path(filename), start)
+
+    def initialize(self):
+        """Build the state from a complete run of hypoDD_object.
+
+        The input files must have been prepared and hypoDD run, e.g. with
+        prepare_all, run_ph2dt and run_hypoDD.
+        """
+        control = self.hypoDD_object.hypoDD_control
+        self.arrays = self.hypoDD_object.get_catalog_arrays()
+        self.ct_index = self._index(control.ct_dt_input)
+        self.cc_index = self._index(control.cc_dt_input)
+        results_file = self._path(control.relocated_hypocenters_output)
+        if os.path.isfile(results_file):
+            self.relocations = read_reloc(results_file)
+        else:
+            self.relocations = np.empty(0, dtype=RELOC_DTYPE)
+        self.save_state()
+
+    def save_state(self):
+        """Write the state file.
+        """
+        arrays = self.arrays
+        fields = dict((name, getattr(arrays, name)) for name in ARRAY_FIELDS)
+        fields["stations"] = np.array(arrays.stations, dtype=str)
+        fields["waveform_ids"] = np.array(arrays.waveform_ids,
+                                          dtype=str).reshape(-1, 4)
+        for name in ("ct", "cc"):
+            pairs, offsets, lengths = getattr(self, name + "_index")
+            fields[name + "_pairs"] = pairs
+            fields[name + "_offsets"] = offsets
+            fields[name + "_lengths"] = lengths
+        fields["relocations"] = self.relocations
+        with open(self._path(self.state_file), "wb") as f:
+            np.savez(f, **fields)
+
+    def load_state(self):
+        """Read the state file.
+        """
+        with np.load(self._path(self.state_file)) as state:
+            self.arrays = CatalogArrays(
+                              *([state[name] for name in ARRAY_FIELDS] +
+                                [[str(sta) for sta in state["stations"]],
+                                 [tuple(str(code) for code in nslc)
+                                  for nslc in state["waveform_ids"]]]))
+            for name in ("ct", "cc"):
+                setattr(self, name + "_index",
+                        (state[name + "_pairs"], state[name + "_offsets"],
+                         state[name + "_lengths"]))
+            self.relocations = state["relocations"]
+
+    def _update_stations(self, new):
+        """Add the stations of the new events that are not in the station
+        input, and return the coordinates of all stations.
+        """
+        hypoDD_input = self.hypoDD_object.hypoDD_input
+        station_file = self._path(hypoDD_input.station_input)
+        coordinates = read_station_input(station_file)
+        missing = set(nslc for nslc in new.waveform_ids
+                      if nslc[1] not in coordinates)
+        if not missing:
+            return coordinates
+        resolver = hypoDD_input.station_resolver
+        if resolver is None:
+            resolver = StationResolver(self.hypoDD_object.client,
+                                       cache_file=self._path("stations.json"))
+        added = {}
+        for nslc, (lat, lon, elevation) in sorted(
+                                             resolver.resolve(missing).items()):
+            added.setdefault(nslc[1], (lat, lon))
+        print "adding {} stations to: {}".format(len(added), station_file)
+        with open(station_file, "a") as f:
+            write_stations(f, added)
+        coordinates.update(added)
+        return coordinates
+
+    def _append_new_inputs(self, new):
+        """Append the new events to the hypocenter and phase inputs.
+        """
+        hypoDD_object = self.hypoDD_object
+        for filename, write in ((hypoDD_object.hypoDD_input.hypocenter_input,
+                                 new.write_hypocenters),
+                                (hypoDD_object.ph2dt_input.catalog_abs_tt_input,
+                                 new.write_phase_data)):
+            if os.path.isfile(self._path(filename)):
+                with open(self._path(filename), "a", WRITE_BUFFER_SIZE) as f:
+                    write(f)
+
+    def _new_pairs(self, arrays, first_new, coordinates):
+        """Form the pairs of the new events, append them to the catalog
+        travel time input and return the CatalogArrays of the events
+        involved.
+        """
+        hypoDD_object = self.hypoDD_object
+        control = hypoDD_object.ph2dt_control
+        points = cartesian(arrays.latitudes, arrays.longitudes,
+                           arrays.depths)
+        distances = cKDTree(points[first_new:]).query(
+                        points[:first_new],
+                        distance_upper_bound=control.maxsep)[0]
+        neighbours = np.nonzero(distances <= control.maxsep)[0]
+        print "old events within {} km of the new events: {}".format(
+                                                   control.maxsep,
+                                                   len(neighbours))
+        selection = np.concatenate((neighbours,
+                                    np.arange(first_new, len(arrays))))
+        local = arrays.subset(selection)
+        ph2dt = Ph2dt(local, coordinates, control=control,
+                      processes=self.processes)
+        pairs, separations = ph2dt.candidate_pairs()
+        keep = (selection[pairs] >= first_new).any(axis=1)
+        ct_input = self._path(hypoDD_object.hypoDD_control.ct_dt_input)
+        start = os.path.getsize(ct_input) if os.path.isfile(ct_input) else 0
+        print "appending the pairs of the new events to: {}".format(ct_input)
+        with open(ct_input, "a", WRITE_BUFFER_SIZE) as f:
+            ph2dt.write_pairs(f, pairs[keep], separations[keep])
+        added = index_pairs(ct_input, start)
+        self.ct_index = tuple(np.concatenate(parts) for parts
+                              in zip(self.ct_index, added))
+        return local, added[0]
+
+    def _new_correlations(self, local, pairs):
+        """Cross correlate new event pairs and append them to the cross
+        correlation differential time input.
+        """
+        hypoDD_object = self.hypoDD_object
+        hypoDD_input = hypoDD_object.hypoDD_input
+        cc_input = hypoDD_object.hypoDD_control.cc_dt_input
+        if hypoDD_input.catalog_cc_input is None or not cc_input:
+            return
+        correlator = CrossCorrelator(local, hypoDD_object.client,
+                                     control=hypoDD_object.hypoDD_control,
+                                     output_directory=self._path(
+                                                           self.workspace),
+                                     catalog_cc_output=cc_input,
+                                     waveform_cache=hypoDD_input.waveform_cache)
+        correlator.run(pairs=pairs)
+        full_filename = self._path(cc_input)
+        start = os.path.getsize(full_filename) \
+                if os.path.isfile(full_filename) else 0
+        with open(self._path("{}/{}".format(self.workspace, cc_input)),
+                  "r") as f_new, open(full_filename, "a") as f:
+            shutil.copyfileobj(f_new, f)
+        added = index_pairs(full_filename, start)
+        self.cc_index = tuple(np.concatenate(parts) for parts
+                              in zip(self.cc_index, added))
+
+    def _copy_blocks(self, filename, index, events, output):
+        """Copy the blocks of the pairs between the given events.
+        """
+        pairs, offsets, lengths = index
+        selected = np.nonzero(np.in1d(pairs[:, 0], events) &
+                              np.in1d(pairs[:, 1], events))[0]
+        with open(self._path(filename), "rb") as f, \
+             open(output, "wb", WRITE_BUFFER_SIZE) as f_out:
+            for idx in selected.tolist():
+                f.seek(offsets[idx])
+                f_out.write(f.read(lengths[idx]))
+
+    def _relocate(self, arrays, events):
+        """Relocate the given events in the workspace.
+
+        Events with a previous solution start from it. Returns the relocated
+        hypocenters, none if hypoDD failed.
+        """
+        hypoDD_object = self.hypoDD_object
+        control = copy.copy(hypoDD_object.hypoDD_control)
+        workspace = self._path(self.workspace)
+        control.control_directory = workspace
+        control.cid = 0
+        control.evid = []
+        index = np.nonzero(np.in1d(arrays.event_ids, events))[0]
+        local = arrays.subset(index)
+        relocations = self.relocations
+        order = np.argsort(relocations["evid"])
+        found = np.searchsorted(relocations["evid"][order], local.event_ids)
+        found = np.minimum(found, max(len(order) - 1, 0))
+        previous = np.zeros(len(local), dtype=bool)
+        if len(order):
+            previous = relocations["evid"][order][found] == local.event_ids
+        records = relocations[order[found[previous]]]
+        local.latitudes[previous] = records["lat"]
+        local.longitudes[previous] = records["lon"]
+        local.depths[previous] = records["depth"]
+        local.origin_times[previous] = reloc_times(records)
+        with open("{}/{}".format(workspace, control.initial_hypocenters),
+                  "w", WRITE_BUFFER_SIZE) as f:
+            local.write_hypocenters(f)
+        station_file = "{}/{}".format(workspace, control.station_input)
+        if os.path.exists(station_file):
+            os.remove(station_file)
+        shutil.copyfile(self._path(control.station_input), station_file)
+        for filename, dt_index in ((control.ct_dt_input, self.ct_index),
+                                   (control.cc_dt_input, self.cc_index)):
+            if filename:
+                self._copy_blocks(filename, dt_index, local.event_ids,
+                                  "{}/{}".format(workspace, filename))
+        control.write_control_file()
+        # The outputs of the previous increment must not pass for new ones.
+        for name in (control.initial_hypocenters_output,
+                     control.relocated_hypocenters_output,
+                     control.station_residual_output,
+                     control.data_residual_output,
+                     control.takeoff_angle_output, "hypoDD.log.out"):
+            if name and os.path.exists("{}/{}".format(workspace, name)):
+                os.remove("{}/{}".format(workspace, name))
+        print "relocating {} events in: {}".format(len(local), workspace)
+        if hypoDD_object.native_hypoDD:
+            DDSolver(control, directory=workspace).run()
+        else:
+            executable = os.path.abspath(self._path(
+                                             hypoDD_object.hypoDD_executable))
+            result = hypoDD_object.get_executor().run(
+                [executable, control.control_file], cwd=workspace,
+                log_file="{}/hypoDD.log.out".format(workspace))
+            if not result.ok:
+                print ("hypoDD failed with exit status {}, previous solutions "
+                       "kept").format(result.returncode)
+                return np.empty(0, dtype=RELOC_DTYPE)
+        results_file = "{}/{}".format(workspace,
+                                      control.relocated_hypocenters_output)
+        if not os.path.isfile(results_file):
+            return np.empty(0, dtype=RELOC_DTYPE)
+        return read_reloc(results_file)
+
+    def add_events(self, catalog):
+        """Relocate new events together with the clusters they link to.
+
+        The new events get IDs following the highest ID so far. The station
+        input, the hypocenter and phase inputs, the differential time inputs,
+        the relocated hypocenter output and the state file are updated.
+        Returns the relocated hypocenters of the run.
+
+        Arguments:
+        catalog: The new events, as an obspy Catalog, any iterable of events
+                 or a CatalogArrays object.
+        """
+        hypoDD_object = self.hypoDD_object
+        if self.arrays is None:
+            self.load_state()
+        old = self.arrays
+        new = as_catalog_arrays(catalog,
+                                pick_weight=hypoDD_object.pick_weight)
+        if len(new) == 0:
+            return np.empty(0, dtype=RELOC_DTYPE)
+        first_id = old.event_ids.max() + 1 if len(old) else 1
+        new.event_ids = first_id + np.arange(len(new), dtype=np.int64)
+        print "adding {} new events".format(len(new))
+        workspace = self._path(self.workspace)
+        if not os.path.isdir(workspace):
+            os.makedirs(workspace)
+
+        coordinates = self._update_stations(new)
+        self._append_new_inputs(new)
+        arrays = CatalogArrays.concatenate([old, new])
+        local, pairs = self._new_pairs(arrays, len(old), coordinates)
+        self._new_correlations(local, pairs)
+
+        relocations = self.relocations
+        touched = np.union1d(new.event_ids, pairs.ravel())
+        clusters = np.unique(relocations["cid"][
+                                 np.in1d(relocations["evid"], touched)])
+        events = np.union1d(touched, relocations["evid"][
+                                         np.in1d(relocations["cid"],
+                                                 clusters)])
+        print "relocating {} touched clusters".format(len(clusters))
+        records = self._relocate(arrays, events)
+
+        # Events the run dropped keep their previous solution.
+        replaced = np.in1d(relocations["evid"], records["evid"])
+        kept = relocations[~replaced]
+        if len(records):
+            first_cid = kept["cid"].max() if len(kept) else 0
+            records["cid"] += first_cid
+        merged = np.concatenate((kept, records))
+        merged = merged[np.argsort(merged["evid"], kind="mergesort")]
+        self.arrays = arrays
+        self.relocations = merged
+        results_file = self._path(
+                   hypoDD_object.hypoDD_control.relocated_hypocenters_output)
+        print "writing relocated hypocenters: {}".format(results_file)
+        write_reloc(results_file, merged)
+        self.save_state()
+        hypoDD_object.catalog_arrays = arrays
+        return records
@@ -0,0 +1,353 @@
+"""Timing, memory and I/O measurements of the stages of a run.
+
+A stage is any block of code run inside Instrumentation.stage. When it is
+over, a record with its wall clock and CPU times, peak memory, bytes read
+and written and record counts is passed to every sink of the
+Instrumentation, e.g. to the logging module or to a JSON lines file. The
+measurements of the process itself are taken from /proc and getrusage,
+those of the executables it runs from their RunResults.
+"""
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+# Size in bytes of the blocks in which files are read to count their lines.
+COUNT_CHUNK_SIZE = 1 << 24
+
+
+def _peak_rss():
+    """Return the peak resident set size of the process in bytes.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    # ru_maxrss is in kB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss():
+    """Reset the peak resident set size of the process to its current size.
+
+    Returns False if the kernel does not support it, in which case the peak
+    is the one since the start of the process.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _io_counters():
+    """Return the bytes read and written by the process so far.
+
+    These are the bytes passed to read and write system calls, whether or
+    not they reached the disk. Zero where /proc/self/io is not available.
+    """
+    counters = {}
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                name, value = line.split(":")
+                counters[name] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return counters.get("rchar", 0), counters.get("wchar", 0)
+
+
+def count_records(filename):
+    """Return the size in bytes and the number of lines of a file.
+    """
+    lines = 0
+    with open(filename, "rb") as f:
+        while True:
+            block = f.read(COUNT_CHUNK_SIZE)
+            if not block:
+                break
+            lines += block.count(b"\n")
+    return os.path.getsize(filename), lines
+
+
+class Stage:
+    """A stage being measured, as returned by Instrumentation.stage.
+
+    The code of the stage can add record counts, files and the runs of
+    executables to it.
+
+    Attributes:
+    name: The name of the stage.
+    records: A dict of record counts, keyed by what is counted.
+    files: The files whose size and number of lines are recorded when the
+           stage is over.
+    runs: The RunResults of the executables run by the stage.
+    metrics: The record passed to the sinks, once the stage is over.
+    Methods:
+    __init__: Initialization method.
+    count: Add to a record count.
+    add_file: Record the size and number of lines of a file.
+    add_run: Add the measurements of a run of an executable.
+    """
+
+    name = None
+    records = None
+    files = None
+    runs = None
+    metrics = None
+
+    def __init__(self, name, files=()):
+        """Initialization method for the Stage class.
+        """
+        self.name = name
+        self.records = {}
+        self.files = list(files)
+        self.runs = []
+        self.metrics = None
+        self._peak_rss = 0
+
+    def count(self, name, number):
+        """Add number to the record count name.
+        """
+        self.records[name] = self.records.get(name, 0) + int(number)
+
+    def add_file(self, filename):
+        """Record the size and number of lines of filename at the end of
+        the stage.
+        """
+        self.files.append(filename)
+
+    def add_run(self, result):
+        """Add the measurements of a RunResult. None is ignored.
+        """
+        if result is not None:
+            self.runs.append(result)
+
+
+@contextlib.contextmanager
+def null_stage(name, files=()):
+    """A stage that is not measured, for code run without Instrumentation.
+    """
+    yield Stage(name, files)
+
+
+class LoggingSink:
+    """Sends stage records to a logger, as JSON.
+
+    Attributes:
+    logger: The logging.Logger the records are sent to.
+    level: The logging level of the records.
+    Methods:
+    __init__: Initialization method.
+    __call__: Send a record.
+    """
+
+    logger = None
+    level = logging.INFO
+
+    def __init__(self, logger=None, level=logging.INFO):
+        """Initialization method for the LoggingSink class.
+        """
+        if logger is None:
+            logger = logging.getLogger("hypoDDutils.instrumentation")
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, record):
+        self.logger.log(self.level, "stage %s: %s", record["stage"],
+                        json.dumps(record, sort_keys=True))
+
+
+class JSONLinesSink:
+    """Appends stage records to a file, one JSON object per line.
+
+    Attributes:
+    filename: The file the records are appended to.
+    Methods:
+    __init__: Initialization method.
+    __call__: Append a record.
+    """
+
+    filename = None
+
+    def __init__(self, filename):
+        """Initialization method for the JSONLinesSink class.
+        """
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self._lock:
+            with open(self.filename, "a") as f:
+                f.write(line)
+
+
+class Instrumentation:
+    """Measures stages and passes their records to sinks.
+
+    A record holds:
+    stage: The name of the stage.
+    start: The start of the stage, as a POSIX timestamp.
+    wall_time: The wall clock time of the stage in s.
+    cpu_time: The CPU time of the process in s, all threads included.
+    children_cpu_time: The CPU time in s of the child processes that ended
+                       during the stage (executables, worker processes).
+    peak_rss: The peak resident set size of the process during the stage in
+              bytes, or since the start of the process where the kernel
+              cannot reset it.
+    children_peak_rss: The largest peak resident set size of the runs of
+                       the stage, or of the child processes that ended
+                       during the stage if that grew, in bytes.
+    bytes_read, bytes_written: The bytes read and written by the process,
+                               through system calls.
+    children_bytes_read, children_bytes_written: The bytes read from and
+                                                 written to disk by the
+                                                 runs of the stage.
+    records: The record counts added by the stage.
+    files: The path, size in bytes and number of lines of every file of
+           the stage that exists when it is over.
+    profile: In profiling mode, the file holding the cProfile statistics.
+    python_peak_memory: In profiling mode, the peak memory allocated by
+                        Python during the stage, where tracemalloc is
+                        available.
+
+    Attributes:
+    sinks: Callables each record is passed to. A LoggingSink if None.
+    profile: If True, stages are run under cProfile, and tracemalloc if it
+             is available, with the statistics written to
+             profile_directory.
+    profile_directory: The directory of the profile statistics files,
+                       named after the stages.
+    records: The records of all the stages measured, in order of end.
+    Methods:
+    __init__: Initialization method.
+    stage: Measure a stage.
+    emit: Pass a record to the sinks.
+    """
+
+    sinks = None
+    profile = False
+    profile_directory = "."
+    records = None
+
+    def __init__(self, sinks=None, profile=False, profile_directory="."):
+        """Initialization method for the Instrumentation class.
+        """
+        if sinks is None:
+            sinks = [LoggingSink()]
+        self.sinks = list(sinks)
+        self.profile = profile
+        self.profile_directory = profile_directory
+        self.records = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def stage(self, name, files=()):
+        """Measure the code run inside the with statement as a stage.
+
+        Stages can be nested: the peak memory of an inner stage counts
+        towards the outer one, and only the outermost stage is profiled.
+
+        Arguments:
+        name: The name of the stage.
+        files: Files whose size and number of lines are recorded when the
+               stage is over (see Stage.add_file).
+        Yields a Stage.
+        """
+        stage = Stage(name, files)
+        stack = self._stack()
+        profiler = None
+        tracemalloc = None
+        if self.profile and not stack:
+            profiler = cProfile.Profile()
+            try:
+                import tracemalloc
+                tracemalloc.start()
+            except ImportError:
+                tracemalloc = None
+        if stack:
+            # The peak is reset below: keep the one of the outer stage.
+            stack[-1]._peak_rss = max(stack[-1]._peak_rss, _peak_rss())
+        stack.append(stage)
+        start = time.time()
+        times = os.times()
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        peak_reset = _reset_peak_rss()
+        read, written = _io_counters()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield stage
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            end_times = os.times()
+            end_read, end_written = _io_counters()
+            stage._peak_rss = max(stage._peak_rss, _peak_rss())
+            stack.pop()
+            if stack and peak_reset:
+                stack[-1]._peak_rss = max(stack[-1]._peak_rss,
+                                          stage._peak_rss)
+            record = {"stage": name,
+                      "start": start,
+                      "wall_time": time.time() - start,
+                      "cpu_time": (end_times[0] + end_times[1] -
+                                   times[0] - times[1]),
+                      "children_cpu_time": (end_times[2] + end_times[3] -
+                                            times[2] - times[3]),
+                      "peak_rss": stage._peak_rss,
+                      "bytes_read": end_read - read,
+                      "bytes_written": end_written - written,
+                      "records": stage.records}
+            end_children_rss = resource.getrusage(
+                                   resource.RUSAGE_CHILDREN).ru_maxrss
+            record["children_peak_rss"] = max(
+                [run.peak_rss for run in stage.runs] +
+                [end_children_rss * 1024 if end_children_rss > children_rss
+                 else 0])
+            record["children_bytes_read"] = sum(run.read_bytes
+                                                for run in stage.runs)
+            record["children_bytes_written"] = sum(run.write_bytes
+                                                   for run in stage.runs)
+            if profiler is not None:
+                if not os.path.isdir(self.profile_directory):
+                    os.makedirs(self.profile_directory)
+                record["profile"] = "{}/{}.prof".format(
+                                        self.profile_directory, name)
+                profiler.dump_stats(record["profile"])
+            if tracemalloc is not None:
+                record["python_peak_memory"] = \
+                    tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            record["files"] = []
+            for filename in stage.files:
+                if filename and os.path.isfile(filename):
+                    size, lines = count_records(filename)
+                    record["files"].append({"file": filename,
+                                            "bytes": size,
+                                            "lines": lines})
+            stage.metrics = record
+            self.emit(record)
+
+    def emit(self, record):
+        """Keep a record and pass it to every sink.
+        """
+        with self._lock:
+            self.records.append(record)
+        for sink in self.sinks:
+            sink(record)
@@ -0,0 +1,320 @@
+import multiprocessing
+import numpy as np
+from scipy.spatial import cKDTree
+from ph2dtControl import Ph2dtControl
+from geodesy import haversine, cartesian
+from catalogArrays import (format_lines, ragged_range, write_blocks,
+                           write_stations, WRITE_BUFFER_SIZE)
+
+DT_CT_HEADER_FORMAT = "# %9d %9d\n"
+DT_CT_FORMAT = "%-7s %9.3f %9.3f %7.4f %s\n"
+
+# Number of event pairs matched per work unit.
+PAIR_CHUNK_SIZE = 20000
+
+# State shared with the worker processes, which inherit it when forked.
+_link_state = {}
+
+
+def read_station_input(filename):
+    """Read a station input file ('station.dat').
+
+    Returns a dict mapping station codes to (latitude, longitude) tuples.
+    """
+    coordinates = {}
+    with open(filename, "r") as f:
+        for line in f:
+            num = line.split()
+            if len(num) < 3:
+                continue
+            coordinates[num[0]] = (float(num[1]), float(num[2]))
+    return coordinates
+
+
+def _link_chunk(bounds):
+    """Match the common observations of a range of candidate event pairs.
+
+    For every pair, the observations are the picks of the same phase at the
+    same station, within maxdist of the pair midpoint, ordered by that
+    distance. Returns the number of such links for every pair, together with
+    the picks of the first maxobs links of the pairs with at least minobs
+    links.
+    """
+    state = _link_state
+    first, second = state["pairs"][bounds[0]:bounds[1]].T
+    keys = state["keys"]
+    offsets = state["key_offsets"]
+    npairs = len(first)
+    # Expand the pairs to one row per observation of their first event.
+    starts = offsets[first]
+    counts = offsets[first + 1] - starts
+    rows = np.repeat(np.arange(npairs), counts)
+    positions = ragged_range(starts, counts)
+    # Look the same observation up in the second event of the pair.
+    wanted = (second[rows] * state["nkeys"] +
+              keys[positions] % state["nkeys"])
+    found = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+    matched = keys[found] == wanted
+    rows = rows[matched]
+    picks_1 = state["key_picks"][positions[matched]]
+    picks_2 = state["key_picks"][found[matched]]
+    # Distance between the pair midpoint and the station.
+    sta = state["pick_stations"][picks_1]
+    lat = state["latitudes"]
+    lon = state["longitudes"]
+    distance = haversine(0.5 * (lat[first[rows]] + lat[second[rows]]),
+                         0.5 * (lon[first[rows]] + lon[second[rows]]),
+                         state["station_latitudes"][sta],
+                         state["station_longitudes"][sta])
+    keep = distance <= state["maxdist"]
+    rows = rows[keep]
+    picks_1 = picks_1[keep]
+    picks_2 = picks_2[keep]
+    distance = distance[keep]
+    nlinks = np.bincount(rows, minlength=npairs)
+    # Keep the closest maxobs links of the pairs that will be saved.
+    order = np.lexsort((distance, rows))
+    rows = rows[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = (rank < state["maxobs"]) & (nlinks[rows] >= state["minobs"])
+    return (nlinks, bounds[0] + rows[keep], picks_1[order][keep],
+            picks_2[order][keep])
+
+
+class Ph2dt:
+    """Native implementation of the ph2dt utility of hypoDD.
+
+    Candidate event pairs are found with a KD-tree search and the common
+    observations of all pairs are matched with vectorized lookups, spread
+    over a pool of worker processes. All parameters are taken from a
+    Ph2dtControl object.
+
+    Attributes:
+    arrays: A CatalogArrays object holding the events and picks.
+    station_coordinates: A dict mapping station codes to (lat, lon) tuples.
+    control: A Ph2dtControl object describing the ph2dt parameters.
+    output_directory: The directory where the output files are written.
+    catalog_tt_output: The name of the catalog travel time output ('dt.ct').
+    event_selection_output: The name of the selected events output
+                            ('event.sel').
+    station_selection_output: The name of the selected stations output
+                              ('station.sel').
+    processes: Number of worker processes. None to use all cores.
+    Methods:
+    __init__: Initialization method.
+    candidate_pairs: Find the event pairs within maxsep.
+    link_pairs: Match the observations of event pairs.
+    select_pairs: Select the pairs that are saved.
+    write_pairs: Link, select and write event pairs.
+    run: Run all of the above and write the output files.
+    """
+
+    arrays = None
+    station_coordinates = {}
+    control = None
+    output_directory = "."
+    catalog_tt_output = "dt.ct"
+    event_selection_output = "event.sel"
+    station_selection_output = "station.sel"
+    processes = None
+
+    def __init__(self, arrays, station_coordinates, control=None,
+                 output_directory=".", catalog_tt_output="dt.ct",
+                 event_selection_output="event.sel",
+                 station_selection_output="station.sel", processes=None
+                 ):
+        """Initialization method for the Ph2dt class.
+        """
+        self.arrays = arrays
+        self.station_coordinates = station_coordinates
+        if control is None:
+            control = Ph2dtControl()
+        self.control = control
+        self.output_directory = output_directory
+        self.catalog_tt_output = catalog_tt_output
+        self.event_selection_output = event_selection_output
+        self.station_selection_output = station_selection_output
+        self.processes = processes
+
+    def _observation_keys(self):
+        """Sorted keys of the usable observations of all events.
+
+        A key encodes the event, station and phase of a pick. Picks below
+        minwght, of phases other than P and S, or from stations without
+        coordinates are not usable. Only the first pick of every event,
+        station and phase is kept.
+        """
+        arrays = self.arrays
+        nkeys = 2 * len(arrays.stations)
+        known = np.array([sta in self.station_coordinates
+                          for sta in arrays.stations] + [False], dtype=bool)
+        is_s = arrays.pick_phases == b"S"
+        usable = ((arrays.pick_weights >= self.control.minwght) &
+                  (arrays.pick_weights > 0.0) &
+                  (is_s | (arrays.pick_phases == b"P")) &
+                  known[arrays.pick_stations])
+        picks = np.nonzero(usable)[0]
+        keys = (arrays.pick_events[picks] * nkeys +
+                2 * arrays.pick_stations[picks] + is_s[picks])
+        order = np.argsort(keys, kind="mergesort")
+        keys = keys[order]
+        picks = picks[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        keys = keys[first]
+        picks = picks[first]
+        offsets = np.searchsorted(keys,
+                                  np.arange(len(arrays) + 1) * nkeys)
+        return keys, picks, offsets, nkeys
+
+    def candidate_pairs(self):
+        """Find all event pairs with a hypocentral separation below maxsep.
+
+        Returns an (n, 2) array of event indices, with the first index lower
+        than the second, and the separations in km.
+        """
+        arrays = self.arrays
+        points = cartesian(arrays.latitudes, arrays.longitudes, arrays.depths)
+        pairs = cKDTree(points).query_pairs(self.control.maxsep,
+                                            output_type="ndarray")
+        pairs = pairs.reshape(-1, 2).astype(np.int64)
+        pairs.sort(axis=1)
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+        separations = np.sqrt(((points[pairs[:, 0]] -
+                                points[pairs[:, 1]]) ** 2).sum(axis=1))
+        return pairs, separations
+
+    def link_pairs(self, pairs):
+        """Match the common observations of event pairs.
+
+        Returns the number of links of every pair and, for the pairs with at
+        least minobs links, the pair index and the two picks of each of the
+        first maxobs links, ordered by distance to the station.
+        """
+        arrays = self.arrays
+        keys, key_picks, key_offsets, nkeys = self._observation_keys()
+        if len(keys) == 0 or len(pairs) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return np.zeros(len(pairs), dtype=np.int64), empty, empty, empty
+        coordinates = [self.station_coordinates.get(sta, (0.0, 0.0))
+                       for sta in arrays.stations]
+        coordinates = np.array(coordinates, dtype=np.float64).reshape(-1, 2)
+        _link_state.clear()
+        _link_state.update(pairs=pairs, keys=keys, key_picks=key_picks,
+                           key_offsets=key_offsets, nkeys=nkeys,
+                           pick_stations=arrays.pick_stations,
+                           latitudes=arrays.latitudes,
+                           longitudes=arrays.longitudes,
+                           station_latitudes=coordinates[:, 0],
+                           station_longitudes=coordinates[:, 1],
+                           maxdist=self.control.maxdist,
+                           minobs=self.control.minobs,
+                           maxobs=self.control.maxobs)
+        chunks = [(start, min(start + PAIR_CHUNK_SIZE, len(pairs)))
+                  for start in range(0, len(pairs), PAIR_CHUNK_SIZE)]
+        try:
+            if len(chunks) > 1 and self.processes != 1:
+                pool = multiprocessing.Pool(self.processes)
+                try:
+                    results = pool.map(_link_chunk, chunks)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [_link_chunk(chunk) for chunk in chunks]
+        finally:
+            _link_state.clear()
+        return tuple(np.concatenate(part) for part in zip(*results))
+
+    def select_pairs(self, pairs, separations, nlinks):
+        """Select the event pairs to be saved.
+
+        Every event keeps its neighbours in order of increasing separation
+        until maxngh of them have at least minlink links. A pair is saved if
+        either of its events keeps it and it has at least minobs links.
+        """
+        npairs = len(pairs)
+        events = np.concatenate((pairs[:, 0], pairs[:, 1]))
+        pair_index = np.tile(np.arange(npairs), 2)
+        order = np.lexsort((np.tile(separations, 2), events))
+        events = events[order]
+        pair_index = pair_index[order]
+        strong = (nlinks[pair_index] >= self.control.minlink).astype(np.int64)
+        before = np.cumsum(strong) - strong
+        starts = np.ones(len(events), dtype=bool)
+        starts[1:] = events[1:] != events[:-1]
+        group_start = np.maximum.accumulate(
+                          np.where(starts, np.arange(len(events)), 0))
+        kept = (before - before[group_start]) < self.control.maxngh
+        selected = np.zeros(npairs, dtype=bool)
+        selected[pair_index[kept]] = True
+        return selected & (nlinks >= self.control.minobs)
+
+    def write_pairs(self, f, pairs, separations):
+        """Link and select event pairs and write their differential times.
+
+        Arguments:
+        f: An open file object, written in the 'dt.ct' format.
+        pairs, separations: Candidate event pairs, as returned by
+                            candidate_pairs.
+        Returns a boolean mask of the selected pairs and the first pick of
+        every link written.
+        """
+        arrays = self.arrays
+        nlinks, rows, picks_1, picks_2 = self.link_pairs(pairs)
+        selected = self.select_pairs(pairs, separations, nlinks)
+        keep = selected[rows]
+        rows = rows[keep]
+        picks_1 = picks_1[keep]
+        picks_2 = picks_2[keep]
+        print "selected event pairs: {}".format(selected.sum())
+        ids = arrays.event_ids[pairs[selected]]
+        headers = format_lines(DT_CT_HEADER_FORMAT, (ids[:, 0], ids[:, 1]))
+        stations = np.array(arrays.stations, dtype=object)
+        lines = format_lines(DT_CT_FORMAT,
+                             (stations[arrays.pick_stations[picks_1]],
+                              arrays.pick_travel_times[picks_1],
+                              arrays.pick_travel_times[picks_2],
+                              0.5 * (arrays.pick_weights[picks_1] +
+                                     arrays.pick_weights[picks_2]),
+                              arrays.pick_phases[picks_1].astype(str)
+                              ))
+        offsets = np.searchsorted(rows, np.nonzero(selected)[0])
+        write_blocks(f, headers, lines, offsets)
+        return selected, picks_1
+
+    def run(self):
+        """Compute the differential times and write the output files.
+        """
+        arrays = self.arrays
+        print "running native ph2dt"
+        pairs, separations = self.candidate_pairs()
+        print "candidate event pairs within {} km: {}".format(
+                                                  self.control.maxsep,
+                                                  len(pairs)
+                                                  )
+        full_filename = "{}/{}".format(self.output_directory,
+                                       self.catalog_tt_output
+                                       )
+        print "writing catalog travel time file: {}".format(full_filename)
+        with open(full_filename, "w", WRITE_BUFFER_SIZE) as f:
+            selected, picks_1 = self.write_pairs(f, pairs, separations)
+
+        events = np.unique(pairs[selected])
+        full_filename = "{}/{}".format(self.output_directory,
+                                       self.event_selection_output
+                                       )
+        print "writing selected events file: {}".format(full_filename)
+        with open(full_filename, "w", WRITE_BUFFER_SIZE) as f:
+            arrays.write_hypocenters(f, events)
+
+        full_filename = "{}/{}".format(self.output_directory,
+                                       self.station_selection_output
+                                       )
+        print "writing selected stations file: {}".format(full_filename)
+        with open(full_filename, "w", WRITE_BUFFER_SIZE) as f:
+            write_stations(f, dict((arrays.stations[idx],
+                                    self.station_coordinates[
+                                                     arrays.stations[idx]])
+                                   for idx in np.unique(
+                                              arrays.pick_stations[picks_1])))
@@ -1,9 +1,26 @@
+from catalogArrays import as_catalog_arrays, WRITE_BUFFER_SIZE
+from pickWeight import default_weight
+from pickFilter import prefilter_picks
+
 class Ph2dtInput:
     """Input used by the ph2dt utility of hypoDD.
 
     Attributes:
     input_directory: The directory where the input file is located.
     catalog_abs_tt_input: The name of the input file.
+    arrays: A CatalogArrays object extracted from the catalog. If None, it
+            is extracted when the input is prepared.
+    pick_weight: A function mapping a pick and its arrival to the pick
+                 weight (see pickWeight).
+    station_coordinates: A dict mapping station codes to (latitude,
+                         longitude) tuples. If set, together with control,
+                         the picks and events that cannot contribute to
+                         ph2dt are not written (see pickFilter).
+    control: The Ph2dtControl with the parameters of the pre-filter.
+    dist: The hypoDD maximum distance between cluster centroids and
+          stations (HypoDDControl.dist) used by the pre-filter, or None.
+    prefilter_report: The numbers of picks and events removed by the last
+                      pre-filter.
     Methods:
     __init__(self,catalog)
     prepare_catalog_abs_tt_input(self)
@@ -11,19 +28,33 @@ class Ph2dtInput:
 
     input_directory = "."
     catalog_abs_tt_input = "phase.dat"
+    arrays = None
+    pick_weight = staticmethod(default_weight)
+    station_coordinates = None
+    control = None
+    dist = None
+    prefilter_report = None
 
     def __init__(self, catalog, input_directory=".",
-                 catalog_abs_tt_input="phase.dat"
+                 catalog_abs_tt_input="phase.dat", arrays=None,
+                 pick_weight=default_weight, station_coordinates=None,
+                 control=None, dist=None
                  ):
         """Initialization method for the HypoDDinput class.
 
         Arguments:
         catalog: An obspy Catalog object which contains the events to be
-                 processed
+                 processed, or a CatalogArrays object.
         """
         self.catalog = catalog
         self.input_directory = input_directory
         self.catalog_abs_tt_input = catalog_abs_tt_input
+        self.arrays = arrays
+        self.pick_weight = pick_weight
+        self.station_coordinates = station_coordinates
+        self.control = control
+        self.dist = dist
+        self.prefilter_report = None
 
     def prepare_catalog_abs_tt_input(self):
         """Prepare the catalog absolute travel time input file for hypoDD.
@@ -32,79 +63,22 @@ class Ph2dtInput:
         'phase.dat', which contains hypocenter parameters and absolute arrival
         times from all events to all stations.
         """
-        weights = []
         print "preparing ph2dt input"
         print "working directory is {}".format(self.input_directory)
         full_filename = "{}/{}".format(self.input_directory,
                                        self.catalog_abs_tt_input
                                        )
         print "preparing catalog absolute travel time input file: {}".format(
-                                                     full_filename 
+                                                     full_filename
                                                      )
-        with open(full_filename, "w") as f:
-            for idx, evt in enumerate(self.catalog):
-                orig = evt.preferred_origin()
-                origin_time = orig.time
-                lat = orig.latitude
-                lon = orig.longitude
-                dep = orig.depth / 1000.0  # Converting m to km.
-                # TODO (@ogalanis) Currently it assumes that there is no
-                # horizontal and vertical uncertainty information in the catalog
-                # which is true for the KNMI catalog, but not for other
-                # catalogs.
-                # It should be fixed to use this information when available.
-                #dh  = orig.origin_uncertainty
-                errh = 0.0
-                errv = 0.0
-                rms=orig.quality.standard_error
-                if rms is None:
-                    rms = 0.0
-                mag = evt.preferred_magnitude()
-                magnitude = mag.mag
-                # hypoDD uses 0.0 to denote no magnitude. However, given that
-                # a) hypoDD does not use magnitudes for anything and
-                # b) it is possible to have a magnitude of 0.0 in the catalog
-                # we use the smallest number that fits in the 4.1f format.
-                if magnitude is None:
-                    magnitude = -9.9
-                hypocenter_input_format = ("# {:>4d} {:>2d} {:>2d} {:>2d} "
-                                           "{:>2d} {:>5.2f} {:>9.4f} {:>10.4f} "
-                                           "{:>10.4f} {:>4.1f} {:>7.2f} "
-                                           "{:>7.2f} {:>6.2f} {:>10d}\n"
-                                           )
-                f.write(hypocenter_input_format.format(
-                            origin_time.year,
-                            origin_time.month,
-                            origin_time.day,
-                            origin_time.hour,
-                            origin_time.minute,
-                            origin_time.second + origin_time.microsecond/1.0e6,
-                            lat,
-                            lon,
-                            dep,
-                            magnitude,
-                            errh,
-                            errv,
-                            rms,
-                            idx+1   # Start from 1, not 0.
-                            ))
-                for arr in orig.arrivals:
-                    weights.append( (arr.pick_id, arr.time_weight) )
-                for pick in evt.picks:
-                    pick_weight = 1.0
-                    #for pair in weights:
-                    #    if pair[0] == pick.resource_id:
-                    #        pick_weight=pair[1]
-                    # TODO(@ogalanis) The code above returns the weight
-                    # used for the computation of this origin. It is not
-                    # necessarily a measure of the uncertainty of the pick. See
-                    # if you can use the onset, when available.
-                    pick_format = ("{:<7} {:>12.6f} {:>7.4f} {:<1}\n")
-                    f.write(pick_format.format(pick.waveform_id.station_code,
-                                               pick.time.__sub__(origin_time),
-                                               pick_weight,
-                                               pick.phase_hint
-                                               ))
-
-
-
+        arrays = self.arrays
+        if arrays is None:
+            arrays = as_catalog_arrays(self.catalog,
+                                       pick_weight=self.pick_weight)
+        if self.station_coordinates is not None and self.control is not None:
+            arrays, self.prefilter_report = prefilter_picks(
+                                                arrays,
+                                                self.station_coordinates,
+                                                self.control, dist=self.dist)
+        with open(full_filename, "w", WRITE_BUFFER_SIZE) as f:
+            arrays.write_phase_data(f)
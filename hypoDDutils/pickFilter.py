@@ -0,0 +1,98 @@
+"""Removal of the picks and events that cannot contribute to ph2dt.
+
+ph2dt reads every pick of the phase data input and discards the ones it
+cannot link. The filter below drops them beforehand, with distances
+computed for all picks at once, so that the phase data file and the time
+ph2dt spends reading it shrink accordingly.
+"""
+import numpy as np
+from geodesy import haversine
+
+
+def box_distance(latitudes, longitudes, bounds):
+    """Great circle distance in km from points to a latitude/longitude box.
+
+    Arguments:
+    latitudes, longitudes: The coordinates of the points in degrees.
+    bounds: (min. latitude, max. latitude, min. longitude, max. longitude)
+            of the box, spanning less than 180 degrees of longitude.
+    Points inside the box are at distance 0. Otherwise the closest point is
+    on the nearest edge: along the meridian of the station for the
+    parallels, and at the foot of the perpendicular great circle for the
+    meridians.
+    """
+    min_lat, max_lat, min_lon, max_lon = bounds
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    edge_lon = np.clip(longitudes, min_lon, max_lon)
+    dlon = np.radians(longitudes - edge_lon)
+    foot = np.degrees(np.arctan2(np.tan(np.radians(latitudes)),
+                                 np.cos(dlon)))
+    edge_lat = np.clip(foot, min_lat, max_lat)
+    return haversine(latitudes, longitudes, edge_lat, edge_lon)
+
+
+def prefilter_picks(arrays, station_coordinates, control, dist=None):
+    """Drop the picks and events that cannot contribute to ph2dt.
+
+    A pick is dropped when ph2dt would never use it:
+    - its station has no coordinates, its phase is neither P nor S, or its
+      weight is below control.minwght;
+    - its station is farther than control.maxdist + control.maxsep from
+      the event, so that it is beyond maxdist from the midpoint of every
+      pair of the event;
+    - when dist is given (HypoDDControl.dist), its station is farther than
+      dist from the box spanned by the epicenters, which holds every
+      cluster centroid, so that hypoDD would never use it.
+    Events are then dropped when they are left with fewer than
+    control.minobs distinct station and phase picks, since none of their
+    pairs can have minobs links.
+
+    Arguments:
+    arrays: The CatalogArrays to filter.
+    station_coordinates: A dict mapping station codes to (latitude,
+                         longitude) tuples.
+    control: The Ph2dtControl of the run.
+    dist: The maximum distance in km of stations from cluster centroids,
+          or None.
+    Returns the filtered CatalogArrays and a dict with the number of picks
+    and events before filtering and the numbers removed.
+    """
+    coordinates = np.array([station_coordinates.get(sta, (np.nan, np.nan))[:2]
+                            for sta in arrays.stations] + [(np.nan, np.nan)],
+                           dtype=np.float64).reshape(-1, 2)
+    known = ~np.isnan(coordinates[:, 0])
+    usable = ((arrays.pick_weights >= control.minwght) &
+              ((arrays.pick_phases == b"P") | (arrays.pick_phases == b"S")) &
+              known[arrays.pick_stations])
+    events = arrays.pick_events
+    stations = arrays.pick_stations
+    distance = haversine(arrays.latitudes[events], arrays.longitudes[events],
+                         coordinates[stations, 0], coordinates[stations, 1])
+    with np.errstate(invalid="ignore"):
+        near = distance <= control.maxdist + control.maxsep
+        if dist is not None and len(arrays):
+            bounds = (arrays.latitudes.min(), arrays.latitudes.max(),
+                      arrays.longitudes.min(), arrays.longitudes.max())
+            near &= (box_distance(coordinates[:, 0], coordinates[:, 1],
+                                  bounds) <= dist)[stations]
+    keep = usable & near
+    nkeys = 2 * len(coordinates)
+    keys = np.unique(events[keep] * nkeys + 2 * stations[keep] +
+                     (arrays.pick_phases[keep] == b"S"))
+    links = np.bincount(keys // nkeys, minlength=len(arrays))
+    kept_events = links >= max(control.minobs, 1)
+    report = {"picks": len(keep),
+              "unusable_picks": int(np.sum(~usable)),
+              "distant_picks": int(np.sum(usable & ~near)),
+              "events": len(arrays),
+              "removed_events": int(np.sum(~kept_events))}
+    filtered = arrays.subset_picks(keep).subset(kept_events)
+    report["removed_picks"] = report["picks"] - len(filtered.pick_stations)
+    print ("pre-filter removed {} of {} picks ({} unusable, {} too distant) "
+           "and {} of {} events with fewer than {} usable picks").format(
+               report["removed_picks"], report["picks"],
+               report["unusable_picks"], report["distant_picks"],
+               report["removed_events"], report["events"],
+               max(control.minobs, 1))
+    return filtered, report
@@ -0,0 +1,61 @@
+"""Mappings from picks to the pick weights used by ph2dt and hypoDD.
+
+A mapping is any function taking a Pick and the Arrival that refers to it
+(None if the preferred origin has no such arrival) and returning a weight
+between 0 and 1 (best). Picks with a weight below Ph2dtControl.minwght are
+not used by ph2dt.
+"""
+
+
+def unit_weight(pick, arrival):
+    """Give every pick a weight of 1.
+    """
+    return 1.0
+
+
+def arrival_time_weight(pick, arrival):
+    """Use the time weight of the arrival, or 1 when it is not available.
+
+    Note that this is the weight used for the computation of the origin. It
+    is not necessarily a measure of the uncertainty of the pick.
+    """
+    if arrival is None or arrival.time_weight is None:
+        return 1.0
+    return min(max(arrival.time_weight, 0.0), 1.0)
+
+
+def pick_uncertainty(pick):
+    """Return the time uncertainty of a pick in s, or None.
+
+    The symmetric uncertainty is used when available, otherwise the mean of
+    the lower and upper uncertainties.
+    """
+    errors = pick.time_errors
+    if errors is None:
+        return None
+    if errors.uncertainty is not None:
+        return errors.uncertainty
+    if errors.lower_uncertainty is not None and \
+       errors.upper_uncertainty is not None:
+        return 0.5 * (errors.lower_uncertainty + errors.upper_uncertainty)
+    return None
+
+
+def uncertainty_weight(reference=0.05, fallback=arrival_time_weight):
+    """Make a mapping from the time uncertainty of a pick to a weight.
+
+    Picks with an uncertainty up to reference seconds get a weight of 1,
+    less certain picks get reference / uncertainty. Picks without an
+    uncertainty are weighted by fallback.
+    """
+    def weight(pick, arrival):
+        uncertainty = pick_uncertainty(pick)
+        if uncertainty is None:
+            return fallback(pick, arrival)
+        if uncertainty <= reference:
+            return 1.0
+        return reference / uncertainty
+    return weight
+
+
+default_weight = uncertainty_weight()
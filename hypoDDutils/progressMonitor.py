@@ -0,0 +1,197 @@
+"""Following the progress of hypoDD while it runs.
+
+A ProgressMonitor is fed the lines hypoDD prints, as they are printed (see
+Executor.run and DDSolver), and parses its iteration lines with hypoDDlog.
+Every iteration is passed to callbacks and to an iterator, and stop rules
+can end a run that diverges or stalls, to free its core early.
+"""
+import threading
+import time
+from Queue import Empty, Queue
+from hypoDDlog import (ITERATION_FIELDS, parse_cluster_line,
+                       parse_iteration_header, parse_iteration_line)
+
+
+def diverging(factor=2.0, field="rmsct", min_iterations=2):
+    """Return a stop rule for runs whose residuals grow.
+
+    The rule stops a run when the field of the last iteration of a cluster
+    exceeds factor times its smallest value in the earlier iterations of
+    the cluster.
+    """
+    def rule(iterations):
+        if len(iterations) < min_iterations:
+            return None
+        best = min(iteration[field] for iteration in iterations[:-1])
+        if best > 0 and iterations[-1][field] > factor * best:
+            return "{} rose from {:.0f} to {:.0f}".format(
+                       field, best, iterations[-1][field])
+        return None
+    return rule
+
+
+def stalled(threshold, window=5, tolerance=0.01, field="rmsct"):
+    """Return a stop rule for runs that no longer improve, with residuals
+    that are still too large.
+
+    The rule stops a run when the field of the last window iterations of a
+    cluster changed by less than tolerance (a fraction) of its value while
+    staying above threshold. A run that settles below threshold has
+    converged and is left to finish: stopping hypoDD loses its outputs and
+    stopping DDSolver skips the remaining clusters. A field that stays at 0
+    is not reported by the run (e.g. rmsct of a run with cross correlation
+    data only) and never stops it.
+    """
+    def rule(iterations):
+        if len(iterations) < window:
+            return None
+        values = [iteration[field] for iteration in iterations[-window:]]
+        if max(values) == 0 or min(values) <= threshold:
+            return None
+        if max(values) - min(values) <= tolerance * max(values):
+            return "{} stalled at {:.0f} for {} iterations".format(
+                       field, values[-1], window)
+        return None
+    return rule
+
+
+class ProgressMonitor:
+    """Parses the iteration lines of a running hypoDD.
+
+    The monitor is called with every line hypoDD prints and returns True
+    when the run should be stopped. Each iteration is a dictionary with the
+    fields of hypoDDlog.ITERATION_FIELDS, the cluster it belongs to (0 if
+    hypoDD did not report clusters) and the time since the first line, in
+    s ('elapsed').
+
+    Attributes:
+    callbacks: Callables called with every iteration, as it is parsed.
+    stop_rules: Callables called with the iterations of the current cluster
+                after every iteration. A rule returns the reason to stop the
+                run, or None (see diverging and stalled). A stopped run has
+                no usable outputs, so rules should only stop runs whose
+                results would be discarded anyway.
+    iterations: The iterations so far, in order.
+    stop_reason: The reason the run was stopped, or None.
+    finished: True once the run is over.
+    Methods:
+    __init__: Initialization method.
+    __call__: Parse a line and return True to stop the run.
+    finish: Mark the run as over.
+    stream: Iterate over the iterations as they are parsed.
+    curves: Return the convergence curves of every cluster.
+    """
+
+    callbacks = None
+    stop_rules = None
+    iterations = None
+    stop_reason = None
+    finished = False
+
+    def __init__(self, callbacks=(), stop_rules=()):
+        """Initialization method for the ProgressMonitor class.
+        """
+        self.callbacks = list(callbacks)
+        self.stop_rules = list(stop_rules)
+        self.iterations = []
+        self.stop_reason = None
+        self.finished = False
+        self._cluster = 0
+        self._cluster_iterations = []
+        self._fields = ITERATION_FIELDS
+        self._start = None
+        self._queue = Queue()
+        self._lock = threading.Lock()
+
+    def __call__(self, line):
+        """Parse a line printed by hypoDD.
+
+        Returns True if a stop rule asks for the run to be stopped.
+        """
+        with self._lock:
+            if self._start is None:
+                self._start = time.time()
+            number = parse_cluster_line(line)
+            if number is not None:
+                self._cluster = number
+                self._cluster_iterations = []
+                return False
+            header = parse_iteration_header(line)
+            if header is not None:
+                self._fields = header
+                return False
+            iteration = parse_iteration_line(line, self._fields)
+            if iteration is None:
+                return False
+            iteration["cluster"] = self._cluster
+            iteration["elapsed"] = time.time() - self._start
+            self.iterations.append(iteration)
+            self._cluster_iterations.append(iteration)
+            cluster_iterations = list(self._cluster_iterations)
+        self._queue.put(iteration)
+        for callback in self.callbacks:
+            callback(iteration)
+        if self.stop_reason is None:
+            for rule in self.stop_rules:
+                reason = rule(cluster_iterations)
+                if reason is not None:
+                    self.stop_reason = "cluster {}: {}".format(
+                                           iteration["cluster"], reason)
+                    print "stopping run: {}".format(self.stop_reason)
+                    break
+        return self.stop_reason is not None
+
+    def finish(self):
+        """Mark the run as over, which ends stream.
+        """
+        self.finished = True
+        self._queue.put(None)
+
+    def stream(self, timeout=None):
+        """Iterate over the iterations as they are parsed, until finish is
+        called.
+
+        The run must go on in another thread (e.g. run_hypoDD called with
+        this monitor). Iterations parsed before stream is called are
+        yielded first.
+
+        Arguments:
+        timeout: Stop waiting after this many s without a new iteration.
+                 None to wait for as long as the run goes on.
+        """
+        while True:
+            try:
+                # Queue.get without a timeout cannot be interrupted.
+                iteration = self._queue.get(True, timeout or 1 << 30)
+            except Empty:
+                return
+            if iteration is None:
+                self._queue.put(None)
+                return
+            yield iteration
+
+    def curves(self):
+        """Return the convergence curves of every cluster.
+
+        Returns a dict mapping cluster numbers to dicts mapping the fields
+        of the iterations to lists of their values, in iteration order.
+        """
+        return convergence_curves(self.iterations)
+
+
+def convergence_curves(iterations):
+    """Group iterations into convergence curves, one per cluster.
+
+    Arguments:
+    iterations: Dictionaries with the fields of hypoDDlog.ITERATION_FIELDS
+                and the cluster, e.g. from hypoDDlog.read_iterations.
+    Returns a dict mapping cluster numbers to dicts mapping every field to
+    the list of its values.
+    """
+    curves = {}
+    for iteration in iterations:
+        curve = curves.setdefault(iteration["cluster"], {})
+        for name, value in iteration.items():
+            if name != "cluster":
+                curve.setdefault(name, []).append(value)
+    return curves
@@ -0,0 +1,197 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+
+# Block size used to hash files.
+HASH_BLOCK_SIZE = 1 << 20
+
+# Identities of executables, keyed by (path, size, mtime).
+_executable_digests = {}
+
+
+def file_digest(filename, digest=None):
+    """Feed the contents of a file to a hashlib object.
+
+    Returns the hashlib object. A missing file is hashed as a marker of its
+    absence.
+    """
+    if digest is None:
+        digest = hashlib.sha256()
+    if not os.path.isfile(filename):
+        digest.update(b"missing\0")
+        return digest
+    with open(filename, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest
+
+
+def executable_identity(filename):
+    """Return a fingerprint of the contents of an executable.
+
+    The contents are only hashed again when the size or modification time
+    of the file change.
+    """
+    filename = os.path.abspath(filename)
+    if not os.path.isfile(filename):
+        return "missing:" + filename
+    stat = os.stat(filename)
+    key = (filename, stat.st_size, stat.st_mtime)
+    if key not in _executable_digests:
+        _executable_digests[key] = file_digest(filename).hexdigest()
+    return _executable_digests[key]
+
+
+def arrays_fingerprint(arrays):
+    """Return a fingerprint of the events and picks of a CatalogArrays.
+    """
+    digest = hashlib.sha256()
+    for name in ("event_ids", "origin_times", "latitudes", "longitudes",
+                 "depths", "magnitudes", "horizontal_errors",
+                 "vertical_errors", "rms", "pick_offsets", "pick_stations",
+                 "pick_phases", "pick_travel_times", "pick_weights"):
+        digest.update(getattr(arrays, name).tobytes())
+    digest.update("\0".join(arrays.stations).encode())
+    return digest.hexdigest()
+
+
+def fingerprint(parts, files=()):
+    """Combine strings and the contents of files into a single key.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode() if not isinstance(part, bytes) else part)
+        digest.update(b"\0")
+    for filename in files:
+        file_digest(filename, digest)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Content addressed store of the outputs of pipeline stages.
+
+    Every entry holds the output files of a stage, in a subdirectory named
+    after the fingerprint of the inputs of the stage. An index file records
+    the size and last use of every entry, and the least recently used
+    entries are evicted when the total size exceeds max_size. The index
+    and the entries are only changed while holding a lock on a lock file
+    next to the index, so that several processes can share the cache.
+
+    Attributes:
+    directory: The directory holding the entries and the index file.
+    max_size: Maximum total size of the entries in bytes.
+    index_file: The name of the index file.
+    Methods:
+    __init__: Initialization method.
+    restore: Copy the outputs of a cached stage into a directory.
+    store: Save the outputs of a stage.
+    """
+
+    directory = "."
+    max_size = 1 << 30
+    index_file = "index.json"
+
+    def __init__(self, directory, max_size=1 << 30, index_file="index.json"):
+        """Initialization method for the ResultCache class.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.index_file = index_file
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __contains__(self, key):
+        with self._locked():
+            return key in self._load()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the lock of the index for the duration of the block.
+        """
+        with open("{}/{}.lock".format(self.directory, self.index_file),
+                  "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        full_filename = "{}/{}".format(self.directory, self.index_file)
+        if not os.path.isfile(full_filename):
+            return {}
+        with open(full_filename, "r") as f:
+            return json.load(f)
+
+    def _save(self, index):
+        full_filename = "{}/{}".format(self.directory, self.index_file)
+        temporary = "{}.{}.tmp".format(full_filename, os.getpid())
+        with open(temporary, "w") as f:
+            json.dump(index, f, indent=0, sort_keys=True)
+        os.rename(temporary, full_filename)
+
+    def restore(self, key, output_directory):
+        """Copy the outputs of a cached stage into output_directory.
+
+        Returns the names of the files restored, or None if key is not
+        cached.
+        """
+        with self._locked():
+            index = self._load()
+            entry = index.get(key)
+            if entry is None:
+                return None
+            for filename in entry["files"]:
+                shutil.copyfile("{}/{}/{}".format(self.directory, key,
+                                                  filename),
+                                "{}/{}".format(output_directory, filename))
+            entry["last_used"] = time.time()
+            self._save(index)
+            return entry["files"]
+
+    def store(self, key, output_directory, filenames):
+        """Save the outputs of a stage under key.
+
+        Files of filenames that do not exist in output_directory are
+        skipped. The least recently used entries are evicted if the cache
+        grows beyond max_size.
+        """
+        entry_directory = "{}/{}".format(self.directory, key)
+        staging = "{}.{}.tmp".format(entry_directory, os.getpid())
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+        files = []
+        size = 0
+        for filename in filenames:
+            source = "{}/{}".format(output_directory, filename)
+            if not os.path.isfile(source):
+                continue
+            shutil.copyfile(source, "{}/{}".format(staging, filename))
+            files.append(filename)
+            size += os.path.getsize(source)
+        with self._locked():
+            if os.path.isdir(entry_directory):
+                shutil.rmtree(entry_directory)
+            os.rename(staging, entry_directory)
+            index = self._load()
+            index[key] = {"files": files, "size": size,
+                          "last_used": time.time()}
+            total = sum(entry["size"] for entry in index.values())
+            for old_key in sorted(index,
+                                  key=lambda k: index[k]["last_used"]):
+                if total <= self.max_size or old_key == key:
+                    continue
+                print "evicting cached results: {}".format(old_key)
+                total -= index.pop(old_key)["size"]
+                shutil.rmtree("{}/{}".format(self.directory, old_key),
+                              ignore_errors=True)
+            self._save(index)
@@ -0,0 +1,151 @@
+import json
+import os
+import time
+from multiprocessing.pool import ThreadPool
+from obspy.clients.fdsn.header import FDSNNoDataException
+from obspy.core.utcdatetime import UTCDateTime
+
+DISTANT_PAST = UTCDateTime("1900-01-01T00:00:00")
+DISTANT_FUTURE = UTCDateTime("3000-01-01T00:00:00")
+
+
+class StationResolver:
+    """Resolves station coordinates, with a persistent on-disk cache.
+
+    Stations are identified by their full (network, station, location,
+    channel) codes. Codes that are not known are given as '*'. Coordinates
+    are kept in a JSON cache file and only stations that are missing from it,
+    or whose entry is older than max_age, are requested from the client, in
+    chunks that are sent concurrently. Stations the client does not know are
+    cached as well, so that they are not requested again until they are
+    stale. Only the answers of successful requests are cached: a request
+    that fails is retried, and if it keeps failing its error is raised once
+    the other chunks are cached.
+
+    Attributes:
+    client: An object with a get_stations_bulk method (e.g. an obspy
+            Client).
+    cache_file: The name of the cache file. None to disable the cache.
+    max_age: Age in seconds after which a cached entry is requested again.
+    chunk_size: Maximum number of stations per bulk request.
+    max_workers: Maximum number of concurrent requests.
+    retries: Number of times a failed request is repeated.
+    retry_delay: Delay in seconds before the first repetition, doubled
+                 for every further one.
+    Methods:
+    __init__: Initialization method.
+    resolve: Return the coordinates of a set of stations.
+    """
+
+    client = None
+    cache_file = "stations.json"
+    max_age = 30 * 86400
+    chunk_size = 50
+    max_workers = 4
+    retries = 2
+    retry_delay = 1.0
+
+    def __init__(self, client, cache_file="stations.json", max_age=30 * 86400,
+                 chunk_size=50, max_workers=4, retries=2, retry_delay=1.0
+                 ):
+        """Initialization method for the StationResolver class.
+        """
+        self.client = client
+        self.cache_file = cache_file
+        self.max_age = max_age
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def _load(self):
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return {}
+        with open(self.cache_file, "r") as f:
+            return json.load(f)
+
+    def _save(self, cache):
+        if self.cache_file is None:
+            return
+        with open(self.cache_file + ".tmp", "w") as f:
+            json.dump(cache, f, indent=0, sort_keys=True)
+        os.rename(self.cache_file + ".tmp", self.cache_file)
+
+    def _fetch(self, chunk):
+        """Request the coordinates of a chunk of stations.
+
+        Returns a dict mapping every requested NSLC tuple to a (latitude,
+        longitude, elevation) tuple, or None if the station was not found,
+        or the exception of the last attempt if the request failed.
+        """
+        bulk = [nslc + (DISTANT_PAST, DISTANT_FUTURE) for nslc in chunk]
+        found = {}
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                inv = self.client.get_stations_bulk(bulk)
+                break
+            except FDSNNoDataException:
+                # The request succeeded: none of the stations is known.
+                inv = []
+                break
+            except Exception as error:
+                if attempt == self.retries:
+                    return error
+                print "station request failed ({}), retrying in {} s".format(
+                                                               error, delay)
+                time.sleep(delay)
+                delay *= 2
+        for net in inv:
+            for sta in net:
+                coordinates = (sta.latitude, sta.longitude, sta.elevation)
+                found.setdefault((net.code, sta.code), coordinates)
+                found.setdefault(("*", sta.code), coordinates)
+        return dict((nslc, found.get(nslc[:2])) for nslc in chunk)
+
+    def resolve(self, stations):
+        """Return the coordinates of a set of stations.
+
+        Arguments:
+        stations: An iterable of (network, station, location, channel)
+                  tuples.
+        Returns a dict mapping each of them to a (latitude, longitude,
+        elevation) tuple. Stations the client does not know are left out.
+        Raises the error of a request that failed after all its retries.
+        """
+        stations = set(stations)
+        cache = self._load()
+        now = time.time()
+        missing = []
+        for nslc in sorted(stations):
+            entry = cache.get(".".join(nslc))
+            if entry is None or now - entry[3] > self.max_age:
+                missing.append(nslc)
+        if missing:
+            print "requesting metadata for {} stations".format(len(missing))
+            chunks = [missing[start:start + self.chunk_size]
+                      for start in range(0, len(missing), self.chunk_size)]
+            pool = ThreadPool(min(self.max_workers, len(chunks)))
+            try:
+                results = pool.map(self._fetch, chunks)
+            finally:
+                pool.close()
+                pool.join()
+            errors = [result for result in results
+                      if isinstance(result, Exception)]
+            for result in results:
+                if isinstance(result, Exception):
+                    continue
+                for nslc, coordinates in result.items():
+                    if coordinates is None:
+                        coordinates = (None, None, None)
+                    cache[".".join(nslc)] = list(coordinates) + [now]
+            self._save(cache)
+            if errors:
+                raise errors[0]
+        resolved = {}
+        for nslc in stations:
+            entry = cache[".".join(nslc)]
+            if entry[0] is not None:
+                resolved[nslc] = tuple(entry[:3])
+        return resolved
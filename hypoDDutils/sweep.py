@@ -0,0 +1,394 @@
+import copy
+import itertools
+import os
+import shutil
+import numpy as np
+from ddSolver import run_workspace
+from executor import Executor, default_executor
+from hypoDDlog import read_iterations, summarize_iterations
+from hypoDDoutput import read_reloc
+from ph2dt import Ph2dt, read_station_input
+
+# Weight attributes, in the order of the hypoDD control file.
+WEIGHT_FIELDS = ("niter", "wtccp", "wtccs", "wrcc", "wdcc", "wtctp", "wtcts",
+                 "wrct", "wdct", "damp")
+
+# The columns of the metrics table, after the parameters.
+METRIC_FIELDS = ("returncode", "runtime", "events", "clusters", "rct_mean",
+                 "rcc_mean", "iterations", "rmsct", "rmscc", "cnd_min",
+                 "cnd_max", "cnd_last")
+
+
+def grid(space):
+    """Return every combination of the values of a parameter space.
+
+    Arguments:
+    space: A dict mapping parameter names (see Sweep) to lists of values.
+    """
+    names = sorted(space)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[space[name] for name in names])]
+
+
+def _draw(values, fractions):
+    """Map fractions in [0, 1) to the values of a parameter.
+
+    values is either a list of values or a (low, high) tuple of a
+    continuous range.
+    """
+    if isinstance(values, tuple):
+        low, high = values
+        return [low + fraction * (high - low) for fraction in fractions]
+    return [values[int(fraction * len(values))] for fraction in fractions]
+
+
+def random_design(space, n, seed=None):
+    """Draw n random combinations from a parameter space.
+
+    Arguments:
+    space: A dict mapping parameter names to lists of values, or to
+           (low, high) tuples of continuous ranges.
+    n: The number of combinations.
+    seed: The seed of the random number generator.
+    """
+    rng = np.random.RandomState(seed)
+    names = sorted(space)
+    columns = [_draw(space[name], rng.random_sample(n)) for name in names]
+    return [dict(zip(names, values)) for values in zip(*columns)]
+
+
+def latin_hypercube(space, n, seed=None):
+    """Draw n combinations from a parameter space with Latin hypercube
+    sampling.
+
+    The range of every parameter is split into n strata and every stratum
+    is sampled exactly once. Takes the arguments of random_design.
+    """
+    rng = np.random.RandomState(seed)
+    names = sorted(space)
+    columns = []
+    for name in names:
+        fractions = (rng.permutation(n) + rng.random_sample(n)) / float(n)
+        columns.append(_draw(space[name], fractions))
+    return [dict(zip(names, values)) for values in zip(*columns)]
+
+
+def apply_parameters(ph2dt_control, hypoDD_control, parameters):
+    """Set the parameters of a combination on copies of the controls.
+
+    Returns the new (ph2dt_control, hypoDD_control). See Sweep for the
+    parameter names.
+    """
+    ph2dt_control = copy.copy(ph2dt_control)
+    hypoDD_control = copy.copy(hypoDD_control)
+    hypoDD_control.weights = copy.deepcopy(hypoDD_control.weights)
+    hypoDD_control.velocity_model = copy.deepcopy(
+                                        hypoDD_control.velocity_model)
+    # Whole weight sets and models first, then their attributes.
+    for name, value in sorted(parameters.items(),
+                              key=lambda item: (item[0] not in
+                                                ("weights", "velocity_model"),
+                                                item[0])):
+        if name.startswith("ph2dt."):
+            setattr(ph2dt_control, name[6:], value)
+        elif name.startswith("hypoDD."):
+            setattr(hypoDD_control, name[7:], value)
+        elif name.startswith("weight."):
+            for weight in hypoDD_control.weights:
+                setattr(weight, name[7:], value)
+        elif name == "weights":
+            hypoDD_control.weights = copy.deepcopy(value)
+        elif name == "velocity_model":
+            hypoDD_control.velocity_model = copy.deepcopy(value)
+        elif name == "ratio":
+            hypoDD_control.velocity_model.ratio = value
+        else:
+            raise ValueError("unknown sweep parameter: {}".format(name))
+    return ph2dt_control, hypoDD_control
+
+
+def _label(value):
+    """Format a parameter value for the metrics table.
+    """
+    if isinstance(value, (list, tuple)) and value and \
+       hasattr(value[0], "damp"):
+        return "|".join(" ".join(str(getattr(weight, field))
+                                 for field in WEIGHT_FIELDS)
+                        for weight in value)
+    if hasattr(value, "layers"):
+        return "{}:{}".format(value.ratio,
+                              ",".join("{}/{}".format(layer.top, layer.vel)
+                                       for layer in value.layers))
+    return str(value)
+
+
+def link_or_copy(source, target):
+    """Hard link source to target, or copy it if it cannot be linked.
+    """
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class Sweep:
+    """Runs hypoDD over many combinations of its parameters.
+
+    Every combination is a dictionary of parameter values. The names are:
+    'ph2dt.<attribute>' for attributes of Ph2dtControl (e.g. 'ph2dt.maxsep'),
+    'hypoDD.<attribute>' for attributes of HypoDDControl (e.g. 'hypoDD.dist'),
+    'weight.<attribute>' for an attribute of every Weight set (e.g.
+    'weight.damp'), 'weights' for a whole list of Weight objects,
+    'velocity_model' for a VelocityModel and 'ratio' for its Vp/Vs ratio.
+
+    ph2dt runs once for every distinct set of ph2dt parameters. Every
+    combination gets its own workspace, where the input files prepared in
+    the directory of hypoDD_object, and the output of its ph2dt run, are
+    hard linked, and the hypoDD runs are spread over a pool of workers. If
+    hypoDD_object uses the native solver, DDSolver relocates the
+    combinations instead, one after the other.
+    A table with the parameters and metrics of every run is collected.
+
+    Attributes:
+    hypoDD_object: The HypoDDObject whose input files have been prepared
+                   (see HypoDDObject.prepare_all), and whose controls are
+                   the base of all combinations.
+    designs: The list of parameter combinations, e.g. from grid,
+             random_design or latin_hypercube.
+    directory: The directory of the workspaces. 'sweep' in the directory
+               of hypoDD_object if None.
+    processes: Number of concurrent runs. None to use the limit of the
+               executor of hypoDD_object.
+    results: The rows of the metrics table, one dictionary per combination.
+    Methods:
+    __init__: Initialization method.
+    run_ph2dt: Run ph2dt for every distinct set of ph2dt parameters.
+    run_hypoDD: Run hypoDD for every combination.
+    collect: Collect the metrics of every run.
+    write_table: Write the metrics table.
+    report: Print the metrics table.
+    run: All of the above, except write_table.
+    """
+
+    hypoDD_object = None
+    designs = []
+    directory = None
+    processes = None
+    results = None
+
+    def __init__(self, hypoDD_object, designs, directory=None,
+                 processes=None
+                 ):
+        """Initialization method for the Sweep class.
+        """
+        self.hypoDD_object = hypoDD_object
+        self.designs = list(designs)
+        if directory is None:
+            directory = "{}/sweep".format(hypoDD_object.directory)
+        self.directory = directory
+        self.processes = processes
+        self.results = None
+
+    def _executor(self):
+        executor = self.hypoDD_object.get_executor()
+        if self.processes is None:
+            return executor
+        return Executor(max_concurrent=self.processes,
+                        timeout=executor.timeout,
+                        memory_limit=executor.memory_limit)
+
+    def _source(self, filename):
+        return "{}/{}".format(self.hypoDD_object.directory, filename)
+
+    def _workspace(self, name):
+        workspace = "{}/{}".format(self.directory, name)
+        if not os.path.isdir(workspace):
+            os.makedirs(workspace)
+        return workspace
+
+    def _controls(self):
+        parent = self.hypoDD_object
+        return [apply_parameters(parent.ph2dt_control, parent.hypoDD_control,
+                                 parameters) for parameters in self.designs]
+
+    def run_ph2dt(self, executor=None):
+        """Run ph2dt once for every distinct set of ph2dt parameters.
+
+        Returns the ph2dt workspace of every combination.
+        """
+        parent = self.hypoDD_object
+        controls = self._controls()
+        groups = {}
+        for idx, parameters in enumerate(self.designs):
+            key = tuple(sorted((name, value)
+                               for name, value in parameters.items()
+                               if name.startswith("ph2dt.")))
+            groups.setdefault(key, []).append(idx)
+        print "running ph2dt for {} distinct parameter sets".format(
+                                                               len(groups))
+        workspaces = [None] * len(self.designs)
+        runs = []
+        for number, key in enumerate(sorted(groups)):
+            workspace = self._workspace("ph2dt_{:03d}".format(number + 1))
+            control = copy.copy(controls[groups[key][0]][0])
+            control.control_directory = workspace
+            link_or_copy(self._source(control.station_input),
+                         "{}/{}".format(workspace, control.station_input))
+            if parent.ph2dt_input.station_coordinates is None:
+                link_or_copy(self._source(control.phase_data),
+                             "{}/{}".format(workspace, control.phase_data))
+            else:
+                # The parent phase data is pre-filtered with the parent
+                # parameters, so it is rewritten for these ones.
+                ph2dt_input = copy.copy(parent.ph2dt_input)
+                ph2dt_input.input_directory = workspace
+                ph2dt_input.catalog_abs_tt_input = control.phase_data
+                ph2dt_input.arrays = parent.get_catalog_arrays()
+                ph2dt_input.control = control
+                ph2dt_input.dist = None
+                ph2dt_input.prepare_catalog_abs_tt_input()
+            control.write_control_file()
+            for idx in groups[key]:
+                workspaces[idx] = workspace
+            if parent.native_ph2dt:
+                station_filename = "{}/{}".format(workspace,
+                                                  control.station_input)
+                ph2dt = Ph2dt(parent.get_catalog_arrays(),
+                              read_station_input(station_filename),
+                              control=control, output_directory=workspace,
+                              catalog_tt_output="dt.ct")
+                ph2dt.run()
+            else:
+                runs.append(dict(
+                    command=[os.path.abspath(self._source(
+                                                 parent.ph2dt_executable)),
+                             control.control_file],
+                    cwd=workspace,
+                    log_file="{}/ph2dt.log.out".format(workspace)))
+        if runs:
+            executor = executor or self._executor()
+            executor.run_all(runs)
+        return workspaces
+
+    def run_hypoDD(self, ph2dt_workspaces, executor=None):
+        """Run hypoDD for every combination, on a pool of workers.
+
+        Returns the workspace and RunResult of every combination.
+        """
+        controls = self._controls()
+        native = self.hypoDD_object.native_hypoDD
+        workspaces = []
+        runs = []
+        results = []
+        for idx, (ph2dt_control, control) in enumerate(controls):
+            workspace = self._workspace("run_{:04d}".format(idx + 1))
+            workspaces.append(workspace)
+            control.control_directory = workspace
+            for filename in (control.initial_hypocenters,
+                             control.station_input, control.cc_dt_input):
+                if filename and os.path.isfile(self._source(filename)):
+                    link_or_copy(self._source(filename),
+                                 "{}/{}".format(workspace, filename))
+            if control.ct_dt_input:
+                link_or_copy("{}/dt.ct".format(ph2dt_workspaces[idx]),
+                             "{}/{}".format(workspace, control.ct_dt_input))
+            control.write_control_file()
+            if native:
+                results.append(run_workspace(control, workspace))
+                continue
+            runs.append(dict(
+                command=[os.path.abspath(self._source(
+                                  self.hypoDD_object.hypoDD_executable)),
+                         control.control_file],
+                cwd=workspace,
+                log_file="{}/hypoDD.log.out".format(workspace)))
+        if native:
+            return workspaces, results
+        print "running hypoDD for {} parameter combinations".format(
+                                                                len(runs))
+        executor = executor or self._executor()
+        return workspaces, executor.run_all(runs)
+
+    def collect(self, workspaces, run_results):
+        """Collect the metrics of every run into the results table.
+        """
+        controls = self._controls()
+        results = []
+        for idx, (workspace, result) in enumerate(zip(workspaces,
+                                                      run_results)):
+            control = controls[idx][1]
+            row = dict((name, _label(value))
+                       for name, value in self.designs[idx].items())
+            row.update(run=idx + 1, returncode=result.returncode,
+                       runtime=result.runtime)
+            reloc_file = "{}/{}".format(workspace,
+                                        control.relocated_hypocenters_output)
+            if os.path.isfile(reloc_file) and os.path.getsize(reloc_file):
+                records = read_reloc(reloc_file)
+                row.update(events=len(records),
+                           clusters=len(np.unique(records["cid"])),
+                           rct_mean=float(records["rct"].mean()),
+                           rcc_mean=float(records["rcc"].mean()))
+            else:
+                row.update(events=0, clusters=0)
+            for log_file in (result.log_file,
+                             "{}/hypoDD.log".format(workspace)):
+                if log_file and os.path.isfile(log_file):
+                    iterations = read_iterations(log_file)
+                    if iterations:
+                        row.update(summarize_iterations(iterations))
+                        break
+            results.append(row)
+        self.results = results
+        return results
+
+    def _columns(self):
+        names = set()
+        for parameters in self.designs:
+            names.update(parameters)
+        return ["run"] + sorted(names) + list(METRIC_FIELDS)
+
+    def write_table(self, filename):
+        """Write the metrics table as tab separated values.
+        """
+        columns = self._columns()
+        with open(filename, "w") as f:
+            f.write("\t".join(columns) + "\n")
+            for row in self.results:
+                f.write("\t".join(str(row.get(name, ""))
+                                  for name in columns) + "\n")
+
+    def report(self):
+        """Print the metrics table.
+        """
+        columns = self._columns()
+        print " ".join("{:>12}".format(name[-12:]) for name in columns)
+        for row in self.results:
+            values = []
+            for name in columns:
+                value = row.get(name, "")
+                if isinstance(value, float):
+                    value = "{:.3f}".format(value)
+                values.append("{:>12}".format(str(value)[:12]))
+            print " ".join(values)
+
+    def run(self):
+        """Run ph2dt and hypoDD for every combination and collect the
+        metrics.
+
+        Returns the results table.
+        """
+        executor = self._executor()
+        try:
+            ph2dt_workspaces = self.run_ph2dt(executor)
+            workspaces, run_results = self.run_hypoDD(ph2dt_workspaces,
+                                                      executor)
+        finally:
+            if executor is not self.hypoDD_object.executor and \
+               executor is not default_executor:
+                executor.close()
+        results = self.collect(workspaces, run_results)
+        self.report()
+        return results
@@ -0,0 +1,354 @@
+import copy
+import multiprocessing
+import os
+import time
+import numpy as np
+from geodesy import EARTH_RADIUS
+from catalogArrays import ragged_range, write_stations, WRITE_BUFFER_SIZE
+from hypoDDoutput import read_reloc, write_reloc, RELOC_DTYPE
+from ph2dt import read_station_input
+
+# Kilometres per degree of latitude.
+KM_PER_DEGREE = np.pi * EARTH_RADIUS / 180.0
+
+# State shared with the worker processes that run the tiles.
+_tile_state = {}
+
+
+def _run_tile(index):
+    return _tile_state["planner"].run_tile(_tile_state["tiles"][index])
+
+
+class Tile:
+    """A rectangular part of a catalog, relocated on its own.
+
+    Attributes:
+    index: The index of the tile, starting from 1.
+    bounds: The (x_min, x_max, y_min, y_max) limits, in km, of the core of
+            the tile.
+    margin: The width in km of the overlap around the core.
+    core: The indices of the catalog events in the core of the tile.
+    members: The indices of the catalog events in the core and the margin.
+    directory: The working directory of the tile.
+    stats: A dictionary with the statistics of the tile.
+    """
+
+    index = 0
+    bounds = None
+    margin = 0.0
+    core = None
+    members = None
+    directory = "."
+    stats = None
+
+    def __init__(self, index, bounds, margin, core, members, directory="."):
+        """Initialization method for the Tile class.
+        """
+        self.index = index
+        self.bounds = bounds
+        self.margin = margin
+        self.core = core
+        self.members = members
+        self.directory = directory
+        self.stats = {}
+
+    def centrality(self, x, y):
+        """Return the distance in km from points to the edge of the tile,
+        margin included.
+        """
+        x_min, x_max, y_min, y_max = self.bounds
+        margin = self.margin
+        return np.minimum(np.minimum(x - x_min + margin, x_max + margin - x),
+                          np.minimum(y - y_min + margin, y_max + margin - y))
+
+
+class TilePlanner:
+    """Splits a catalog into overlapping tiles that fit a hypoDD binary.
+
+    hypoDD is compiled with fixed limits on the number of events (MAXEVE),
+    differential times (MAXDATA) and stations (MAXSTA). The epicentral
+    area is bisected recursively, along its longer side at the median
+    event, until every tile, margin included, fits these limits. The margin
+    is at least ph2dt_control.maxsep wide, so that every pair of events
+    that ph2dt may link lies in full inside some tile. Every tile is run
+    through ph2dt and hypoDD in its own directory, the tiles in parallel,
+    and every event keeps its solution from the tile it is most central in.
+
+    The number of differential times of a tile is estimated as MAXNGH
+    neighbours per event, with at most MAXOBS observations each.
+
+    Attributes:
+    hypoDD_object: The HypoDDObject of the whole catalog. Its controls,
+                   executables and station input are used for every tile.
+    max_events: The MAXEVE limit of the hypoDD binary.
+    max_data: The MAXDATA limit of the hypoDD binary.
+    max_stations: The MAXSTA limit of the hypoDD binary.
+    margin: Minimum width in km of the overlap between tiles.
+    processes: Number of tiles run concurrently. None to use all cores.
+    tile_prefix: Prefix of the name of the tile directories.
+    Methods:
+    __init__: Initialization method.
+    plan: Split the catalog into tiles.
+    run_tile: Prepare the input of a tile and run ph2dt and hypoDD on it.
+    stitch: Merge the relocations of the tiles.
+    report: Print the statistics of every tile.
+    run: All of the above.
+    """
+
+    hypoDD_object = None
+    max_events = 3000
+    max_data = 1000000
+    max_stations = 300
+    margin = 0.0
+    processes = None
+    tile_prefix = "tile_"
+
+    def __init__(self, hypoDD_object, max_events=3000, max_data=1000000,
+                 max_stations=300, margin=0.0, processes=None,
+                 tile_prefix="tile_"
+                 ):
+        """Initialization method for the TilePlanner class.
+        """
+        self.hypoDD_object = hypoDD_object
+        self.max_events = max_events
+        self.max_data = max_data
+        self.max_stations = max_stations
+        self.margin = max(margin, hypoDD_object.ph2dt_control.maxsep)
+        self.processes = processes
+        self.tile_prefix = tile_prefix
+
+    def _coordinates(self):
+        """Return the epicenters in km on a local equirectangular plane.
+        """
+        arrays = self.hypoDD_object.get_catalog_arrays()
+        lat0 = np.radians(0.5 * (arrays.latitudes.min() +
+                                 arrays.latitudes.max()))
+        x = arrays.longitudes * KM_PER_DEGREE * np.cos(lat0)
+        y = arrays.latitudes * KM_PER_DEGREE
+        return x, y
+
+    def _size(self, members):
+        """Return the number of events, differential times and stations
+        of a set of events.
+        """
+        arrays = self.hypoDD_object.get_catalog_arrays()
+        control = self.hypoDD_object.ph2dt_control
+        counts = np.diff(arrays.pick_offsets)[members]
+        data = control.maxngh * np.minimum(counts, control.maxobs).sum()
+        picks = arrays.pick_stations[ragged_range(
+                                         arrays.pick_offsets[members], counts)]
+        return len(members), int(data), len(np.unique(picks))
+
+    def _fits(self, size):
+        return (size[0] <= self.max_events and size[1] <= self.max_data and
+                size[2] <= self.max_stations)
+
+    def plan(self):
+        """Split the catalog into tiles.
+
+        Returns a list of Tile objects.
+        """
+        x, y = self._coordinates()
+        margin = self.margin
+        tiles = []
+        regions = [((x.min(), x.max(), y.min(), y.max()),
+                    np.arange(len(x)))]
+        while regions:
+            bounds, core = regions.pop()
+            x_min, x_max, y_min, y_max = bounds
+            members = np.nonzero((x >= x_min - margin) &
+                                 (x <= x_max + margin) &
+                                 (y >= y_min - margin) &
+                                 (y <= y_max + margin))[0]
+            size = self._size(members)
+            if not self._fits(size) and len(core) > 1:
+                along_x = x_max - x_min >= y_max - y_min
+                if along_x:
+                    values, extent = x[core], x_max - x_min
+                else:
+                    values, extent = y[core], y_max - y_min
+                split = np.median(values)
+                first = values < split
+                if not first.any():
+                    first = values <= split
+                if extent > margin and first.any() and not first.all():
+                    if along_x:
+                        regions.append(((split, x_max, y_min, y_max),
+                                        core[~first]))
+                        regions.append(((x_min, split, y_min, y_max),
+                                        core[first]))
+                    else:
+                        regions.append(((x_min, x_max, split, y_max),
+                                        core[~first]))
+                        regions.append(((x_min, x_max, y_min, split),
+                                        core[first]))
+                    continue
+            tile = Tile(len(tiles) + 1, bounds, margin, core, members,
+                        "{}/{}{:04d}".format(self.hypoDD_object.directory,
+                                             self.tile_prefix,
+                                             len(tiles) + 1))
+            tile.stats.update(core_events=len(core), events=size[0],
+                              estimated_data=size[1], stations=size[2],
+                              fits=self._fits(size))
+            if not tile.stats["fits"]:
+                print ("warning: tile {} exceeds the hypoDD limits and "
+                       "cannot be split further").format(tile.index)
+            tiles.append(tile)
+        print "split {} events into {} tiles".format(len(x), len(tiles))
+        return tiles
+
+    def run_tile(self, tile):
+        """Prepare the input of a tile and run ph2dt and hypoDD on it.
+
+        Returns the statistics of the tile.
+        """
+        from hypoDDobject import HypoDDObject
+        parent = self.hypoDD_object
+        start = time.time()
+        if not os.path.isdir(tile.directory):
+            os.makedirs(tile.directory)
+        arrays = parent.get_catalog_arrays().subset(tile.members)
+        relative = lambda executable: os.path.relpath(
+                                  os.path.join(parent.directory, executable),
+                                  tile.directory)
+        tile_object = HypoDDObject(arrays, parent.client, tile.directory,
+                                   relative(parent.ph2dt_executable),
+                                   relative(parent.hypoDD_executable),
+                                   native_ph2dt=parent.native_ph2dt,
+                                   pick_weight=parent.pick_weight,
+                                   executor=parent.executor,
+                                   result_cache=parent.result_cache,
+                                   native_hypoDD=parent.native_hypoDD,
+                                   processes=1)
+        for name in ("ph2dt_control", "hypoDD_control"):
+            control = copy.copy(getattr(parent, name))
+            control.control_directory = tile.directory
+            setattr(tile_object, name, control)
+        tile_object.hypoDD_control.cid = 0
+        tile_object.hypoDD_control.evid = []
+        tile_input = copy.copy(parent.hypoDD_input)
+        tile_input.catalog = arrays
+        tile_input.arrays = arrays
+        tile_input.input_directory = tile.directory
+        tile_input.ph2dt_control = tile_object.ph2dt_control
+        tile_input.hypoDD_control = tile_object.hypoDD_control
+        # Tiles run in daemonic pool workers, which cannot start pools.
+        tile_input.processes = 1
+        tile_object.hypoDD_input = tile_input
+        tile_object.ph2dt_input = copy.copy(parent.ph2dt_input)
+        tile_object.ph2dt_input.catalog = arrays
+        tile_object.ph2dt_input.arrays = arrays
+        tile_object.ph2dt_input.input_directory = tile.directory
+        tile_object.ph2dt_input.control = tile_object.ph2dt_control
+        tile_object.catalog_arrays = arrays
+
+        tile_object.ph2dt_control.write_control_file()
+        tile_object.hypoDD_control.write_control_file()
+        tile_object.ph2dt_input.prepare_catalog_abs_tt_input()
+        tile_input.prepare_hypocenter_input()
+        coordinates = read_station_input("{}/{}".format(
+                                          parent.directory,
+                                          parent.hypoDD_input.station_input))
+        used = set(arrays.stations[idx]
+                   for idx in np.unique(arrays.pick_stations))
+        with open("{}/{}".format(tile.directory, tile_input.station_input),
+                  "w", WRITE_BUFFER_SIZE) as f:
+            write_stations(f, dict((code, coordinates[code])
+                                   for code in used if code in coordinates))
+        if tile_input.catalog_tt_input is not None:
+            tile_input.prepare_catalog_tt_input()
+        else:
+            tile_object.run_ph2dt()
+        if tile_input.catalog_cc_input is not None:
+            tile_input.prepare_cc_tt_input()
+        tile_object.run_hypoDD()
+
+        stats = dict(tile.stats)
+        results_file = "{}/{}".format(
+                           tile.directory,
+                           tile_object.hypoDD_control.relocated_hypocenters_output)
+        stats["relocated"] = len(read_reloc(results_file)) \
+                             if os.path.isfile(results_file) else 0
+        stats["seconds"] = time.time() - start
+        return stats
+
+    def stitch(self, tiles):
+        """Merge the relocations of the tiles.
+
+        Every event keeps its solution from the tile where it lies farthest
+        from the tile edge. Clusters are renumbered over all tiles. Returns
+        the merged records, which are also written to the relocated
+        hypocenter output of the main directory.
+        """
+        parent = self.hypoDD_object
+        output = parent.hypoDD_control.relocated_hypocenters_output
+        x, y = self._coordinates()
+        arrays = parent.get_catalog_arrays()
+        order = np.argsort(arrays.event_ids)
+        records = []
+        centrality = []
+        cluster_keys = []
+        for tile in tiles:
+            filename = "{}/{}".format(tile.directory, output)
+            if not os.path.isfile(filename):
+                continue
+            tile_records = read_reloc(filename)
+            index = order[np.searchsorted(arrays.event_ids[order],
+                                          tile_records["evid"])]
+            records.append(tile_records)
+            centrality.append(tile.centrality(x[index], y[index]))
+            cluster_keys.append(tile.index * (1 << 32) +
+                                tile_records["cid"].astype(np.int64))
+        if records:
+            records = np.concatenate(records)
+            centrality = np.concatenate(centrality)
+            cluster_keys = np.concatenate(cluster_keys)
+        else:
+            records = np.empty(0, dtype=RELOC_DTYPE)
+            centrality = cluster_keys = np.empty(0)
+        best = np.lexsort((-centrality, records["evid"]))
+        first = np.ones(len(best), dtype=bool)
+        first[1:] = np.diff(records["evid"][best]) != 0
+        best = best[first]
+        best.sort()
+        records = records[best]
+        keys, inverse = np.unique(cluster_keys[best], return_inverse=True)
+        records["cid"] = inverse + 1
+        full_filename = "{}/{}".format(parent.directory, output)
+        print "writing stitched relocations: {}".format(full_filename)
+        write_reloc(full_filename, records)
+        return records
+
+    def report(self, tiles):
+        """Print the statistics of every tile.
+        """
+        print ("{:>5} {:>7} {:>7} {:>9} {:>8} {:>9} {:>8}".format(
+                   "TILE", "CORE", "EVENTS", "DATA", "STATIONS", "RELOCATED",
+                   "SECONDS"))
+        for tile in tiles:
+            stats = tile.stats
+            print ("{:>5d} {:>7d} {:>7d} {:>9d} {:>8d} {:>9d} {:>8.1f}".format(
+                       tile.index, stats["core_events"], stats["events"],
+                       stats["estimated_data"], stats["stations"],
+                       stats.get("relocated", 0), stats.get("seconds", 0.0)))
+
+    def run(self):
+        """Split the catalog, run every tile in parallel and stitch them.
+
+        The station input of the main directory must exist. Returns the
+        list of tiles, with their statistics.
+        """
+        tiles = self.plan()
+        _tile_state.update(planner=self, tiles=tiles)
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            results = pool.map(_run_tile, range(len(tiles)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _tile_state.clear()
+        for tile, stats in zip(tiles, results):
+            tile.stats = stats
+        self.stitch(tiles)
+        self.report(tiles)
+        return tiles
@@ -0,0 +1,340 @@
+"""First arrival travel times in a 1D layered velocity model.
+
+The model is the one hypoDD uses: flat layers of constant velocity, given by
+the tops and P velocities of a VelocityModel, with S velocities derived from
+its ratio. Receivers are at the surface. The first arrival is the fastest of
+the direct ray and of the head waves along the tops of the layers below the
+source.
+
+Take-off angles are measured from the downward vertical, so up-going rays
+have angles above 90 degrees, as in the take-off angle output of hypoDD.
+
+TravelTimeTable precomputes the first arrivals on a grid, for fast batch
+queries, and caches the tables on disk.
+"""
+import hashlib
+import os
+import numpy as np
+
+# Number of Newton steps used to find the ray parameter of direct rays.
+RAY_PARAMETER_STEPS = 10
+
+# The tables of every phase, in the order first_arrivals returns them.
+TABLE_FIELDS = ("times", "angles", "horizontal", "vertical")
+
+# Version of the table computation, part of the cache keys.
+TABLE_VERSION = "1"
+
+# Queries closer to the receiver than this many distance steps are traced
+# exactly. The travel times are too curved there to be interpolated.
+NEAR_SOURCE_STEPS = 5
+
+
+def layer_velocities(velocity_model, phase="P"):
+    """Return the tops (km) and velocities (km/s) of the layers of a model.
+
+    Arguments:
+    velocity_model: A VelocityModel object.
+    phase: 'P' or 'S'. S velocities are the P velocities divided by the
+           ratio of the model.
+    """
+    tops = np.array([layer.top for layer in velocity_model.layers],
+                    dtype=np.float64)
+    velocities = np.array([layer.vel for layer in velocity_model.layers],
+                          dtype=np.float64)
+    order = np.argsort(tops, kind="mergesort")
+    tops = tops[order]
+    velocities = velocities[order]
+    tops[0] = min(tops[0], 0.0)
+    if phase == "S":
+        velocities = velocities / velocity_model.ratio
+    return tops, velocities
+
+
+def _direct_rays(tops, velocities, distance, depth, layer):
+    """Travel times and ray parameters of the up-going direct rays.
+    """
+    bottoms = np.append(tops[1:], np.inf)
+    # Thickness of every layer crossed on the way up, (n, layers).
+    thickness = np.clip(np.minimum(bottoms, depth[:, np.newaxis]) - tops,
+                        0.0, None)
+    crossed = thickness > 0
+    fastest = np.maximum(np.where(crossed, velocities, 0.0).max(axis=1),
+                         velocities[layer])
+    ratios = velocities / fastest[:, np.newaxis]
+    flattening = np.where(crossed, 1.0 - ratios ** 2, 1.0)
+    # Sources at the surface, with nothing to cross, leave horizontally.
+    grazing = ~crossed.any(axis=1)
+    # Newton iteration on the tangent of the angle of the ray in the fastest
+    # layer crossed. The epicentral distance of the ray is a concave
+    # increasing function of it, so the iteration converges from below.
+    tangent = np.zeros(len(distance))
+    for step in range(RAY_PARAMETER_STEPS):
+        spread = 1.0 + tangent[:, np.newaxis] ** 2 * flattening
+        reach = (thickness * ratios * tangent[:, np.newaxis] /
+                 np.sqrt(spread)).sum(axis=1)
+        change = (thickness * ratios / spread ** 1.5).sum(axis=1)
+        tangent += (distance - reach) / np.where(grazing, 1.0, change)
+    tangent[grazing] = 0.0
+    spread = 1.0 + tangent[:, np.newaxis] ** 2 * flattening
+    secant = np.sqrt(1.0 + tangent ** 2)
+    reach = (thickness * ratios * tangent[:, np.newaxis] /
+             np.sqrt(spread)).sum(axis=1)
+    times = (secant[:, np.newaxis] * thickness /
+             (velocities * np.sqrt(spread))).sum(axis=1)
+    slowness = np.where(grazing, 1.0, tangent / secant) / fastest
+    # First order correction for the distance the iteration left over.
+    times += (distance - reach) * slowness
+    return times, slowness
+
+
+def first_arrivals(tops, velocities, distance, depth):
+    """Compute the first arrivals at surface receivers.
+
+    Arguments:
+    tops, velocities: The layers of the model, as returned by
+                      layer_velocities.
+    distance: Array of epicentral distances in km.
+    depth: Array of source depths in km. Sources above the surface are
+           taken at the surface.
+    Returns the travel times (s), the take-off angles (degrees), and the
+    horizontal and vertical (positive downwards) slowness of the rays at
+    the source (s/km). The derivatives of a travel time with respect to the
+    source coordinates are the horizontal slowness along the direction away
+    from the receiver and minus the vertical slowness.
+    """
+    distance = np.atleast_1d(np.asarray(distance, dtype=np.float64))
+    depth = np.atleast_1d(np.clip(np.asarray(depth, dtype=np.float64),
+                                  0.0, None))
+    distance, depth = np.broadcast_arrays(distance, depth)
+    distance = distance.ravel()
+    depth = depth.ravel()
+    # Sources on a layer boundary belong to the layer above it.
+    layer = np.clip(np.searchsorted(tops, depth, side="left") - 1, 0, None)
+    source_velocity = velocities[layer]
+
+    times, slowness = _direct_rays(tops, velocities, distance, depth, layer)
+    up_going = np.ones(len(distance), dtype=bool)
+    thickness = np.diff(tops)
+    for refractor in range(1, len(tops)):
+        speed = velocities[refractor]
+        if speed <= velocities[:refractor].max():
+            continue
+        below = depth <= tops[refractor]
+        if not below.any():
+            continue
+        # Legs down from the source and up to the receiver in every layer
+        # above the refractor.
+        legs = (thickness[:refractor] +
+                np.clip(tops[1:refractor + 1] -
+                        np.maximum(tops[:refractor], depth[:, np.newaxis]),
+                        0.0, None))
+        ratios = velocities[:refractor] / speed
+        head_times = (distance / speed +
+                      (legs * np.sqrt(1.0 / velocities[:refractor] ** 2 -
+                                      1.0 / speed ** 2)).sum(axis=1))
+        critical = (legs * ratios / np.sqrt(1.0 - ratios ** 2)).sum(axis=1)
+        faster = below & (distance >= critical) & (head_times < times)
+        times = np.where(faster, head_times, times)
+        slowness = np.where(faster, 1.0 / speed, slowness)
+        up_going &= ~faster
+    sines = np.clip(slowness * source_velocity, 0.0, 1.0)
+    vertical = np.sqrt(1.0 - sines ** 2) / source_velocity
+    vertical = np.where(up_going, -vertical, vertical)
+    angles = np.degrees(np.arcsin(sines))
+    angles = np.where(up_going, 180.0 - angles, angles)
+    return times, angles, slowness, vertical
+
+
+def travel_times(velocity_model, distance, depth, phase="P"):
+    """Compute the first arrival travel times and take-off angles of a phase.
+
+    Arguments:
+    velocity_model: A VelocityModel object.
+    distance: Epicentral distances in km.
+    depth: Source depths in km.
+    phase: 'P' or 'S'.
+    Returns the travel times (s) and take-off angles (degrees).
+    """
+    tops, velocities = layer_velocities(velocity_model, phase)
+    times, angles, _, _ = first_arrivals(tops, velocities, distance, depth)
+    return times, angles
+
+
+class TravelTimeTable:
+    """Precomputed first arrivals of a velocity model on a grid.
+
+    The travel times, take-off angles and slowness of P and S are computed
+    once on a grid of epicentral distances and source depths, whose depths
+    include the layer boundaries, and are then interpolated bilinearly for
+    any number of source-receiver pairs. Queries outside the grid or very
+    close to the receiver are traced exactly. Take-off angles and slowness
+    jump where the first arrival changes from one ray to another, and are
+    averaged within the cells that straddle such a change.
+
+    Attributes:
+    velocity_model: The VelocityModel object the tables are computed for.
+    max_distance: The largest epicentral distance of the grid in km.
+    max_depth: The largest source depth of the grid in km.
+    distance_step, depth_step: The spacing of the grid in km.
+    cache_directory: The directory where the tables are saved, named after
+                     the key of the model and grid. None for no cache.
+    distances, depths: The axes of the grid.
+    tables: The tables of every phase, as a dictionary of arrays of shape
+            (depths, distances), keyed by 'times', 'angles', 'horizontal'
+            and 'vertical'.
+    Methods:
+    __init__: Initialization method.
+    key: Return the key of the model and grid.
+    build: Compute the tables, or load them from the cache.
+    lookup: Interpolate the first arrivals of a phase.
+    travel_times: Interpolate travel times and take-off angles.
+    """
+
+    velocity_model = None
+    max_distance = 200.0
+    max_depth = 40.0
+    distance_step = 0.25
+    depth_step = 0.1
+    cache_directory = None
+    distances = None
+    depths = None
+    tables = None
+
+    def __init__(self, velocity_model, max_distance=200.0, max_depth=40.0,
+                 distance_step=0.25, depth_step=0.1, cache_directory=None
+                 ):
+        """Initialization method for the TravelTimeTable class.
+        """
+        self.velocity_model = velocity_model
+        self.max_distance = max_distance
+        self.max_depth = max_depth
+        self.distance_step = distance_step
+        self.depth_step = depth_step
+        self.cache_directory = cache_directory
+        self.distances = None
+        self.depths = None
+        self.tables = None
+
+    def key(self):
+        """Return a key identifying the velocity model and the grid.
+        """
+        tops, velocities = layer_velocities(self.velocity_model)
+        parts = [TABLE_VERSION, repr(float(self.velocity_model.ratio)),
+                 repr(tops.tolist()), repr(velocities.tolist()),
+                 repr((float(self.max_distance), float(self.max_depth),
+                       float(self.distance_step), float(self.depth_step)))]
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def _cache_file(self):
+        return "{}/traveltimes_{}.npz".format(self.cache_directory,
+                                              self.key()[:16])
+
+    def build(self):
+        """Compute the tables, or load them from the cache.
+
+        Returns the TravelTimeTable itself.
+        """
+        if self.tables is not None:
+            return self
+        if self.cache_directory is not None and \
+           os.path.isfile(self._cache_file()):
+            with np.load(self._cache_file()) as saved:
+                self.distances = saved["distances"]
+                self.depths = saved["depths"]
+                self.tables = dict(
+                    (phase, dict((name, saved[phase + "_" + name])
+                                 for name in TABLE_FIELDS))
+                    for phase in ("P", "S"))
+            return self
+        tops, _ = layer_velocities(self.velocity_model)
+        count = int(np.ceil(self.max_distance / self.distance_step)) + 1
+        self.distances = self.distance_step * np.arange(count)
+        count = int(np.ceil(self.max_depth / self.depth_step)) + 1
+        depths = self.depth_step * np.arange(count)
+        self.depths = np.union1d(depths, tops[(tops >= 0) &
+                                              (tops <= depths[-1])])
+        grid_depths, grid_distances = np.meshgrid(self.depths,
+                                                  self.distances,
+                                                  indexing="ij")
+        self.tables = {}
+        for phase in ("P", "S"):
+            tops, velocities = layer_velocities(self.velocity_model, phase)
+            arrivals = first_arrivals(tops, velocities, grid_distances.ravel(),
+                                      grid_depths.ravel())
+            self.tables[phase] = dict(
+                (name, values.reshape(grid_depths.shape))
+                for name, values in zip(TABLE_FIELDS, arrivals))
+        if self.cache_directory is not None:
+            if not os.path.isdir(self.cache_directory):
+                os.makedirs(self.cache_directory)
+            arrays = {"distances": self.distances, "depths": self.depths}
+            for phase, table in self.tables.items():
+                for name, values in table.items():
+                    arrays[phase + "_" + name] = values
+            # Written under a temporary name, so that concurrent builds never
+            # read a partial file.
+            temporary = "{}.{}.tmp".format(self._cache_file(), os.getpid())
+            with open(temporary, "wb") as f:
+                np.savez(f, **arrays)
+            os.rename(temporary, self._cache_file())
+        return self
+
+    def lookup(self, distance, depth, phase="P"):
+        """Interpolate the first arrivals of a phase.
+
+        Arguments:
+        distance: Array of epicentral distances in km.
+        depth: Array of source depths in km.
+        phase: 'P' or 'S'.
+        Returns the travel times (s), take-off angles (degrees), and
+        horizontal and vertical slowness (s/km), as first_arrivals does.
+        """
+        self.build()
+        table = self.tables[phase]
+        distance = np.atleast_1d(np.asarray(distance, dtype=np.float64))
+        depth = np.atleast_1d(np.clip(np.asarray(depth, dtype=np.float64),
+                                      0.0, None))
+        distance, depth = np.broadcast_arrays(distance, depth)
+        distance = distance.ravel()
+        depth = depth.ravel()
+        column = np.clip((distance / self.distance_step).astype(np.int64), 0,
+                         len(self.distances) - 2)
+        # Sources on a layer boundary belong to the layer above it, as in
+        # first_arrivals, so every cell lies within a single layer.
+        row = np.clip(np.searchsorted(self.depths, depth, side="left") - 1, 0,
+                      len(self.depths) - 2)
+        right = (distance - self.distances[column]) / self.distance_step
+        lower = ((depth - self.depths[row]) /
+                 (self.depths[row + 1] - self.depths[row]))
+        width = len(self.distances)
+        corners = []
+        for down, across in ((0, 0), (0, 1), (1, 0), (1, 1)):
+            weight = ((lower if down else 1.0 - lower) *
+                      (right if across else 1.0 - right))
+            corners.append(((row + down) * width + column + across, weight))
+        results = []
+        for name in TABLE_FIELDS:
+            values = table[name].ravel()
+            result = np.zeros(len(distance))
+            for index, weight in corners:
+                result += weight * values[index]
+            results.append(result)
+        outside = ((distance > self.distances[-1]) |
+                   (depth > self.depths[-1]) |
+                   (np.hypot(distance, depth) <
+                    NEAR_SOURCE_STEPS * self.distance_step))
+        if outside.any():
+            tops, velocities = layer_velocities(self.velocity_model, phase)
+            exact = first_arrivals(tops, velocities, distance[outside],
+                                   depth[outside])
+            for result, values in zip(results, exact):
+                result[outside] = values
+        return tuple(results)
+
+    def travel_times(self, distance, depth, phase="P"):
+        """Interpolate the travel times (s) and take-off angles (degrees) of
+        a phase.
+        """
+        times, angles, _, _ = self.lookup(distance, depth, phase)
+        return times, angles
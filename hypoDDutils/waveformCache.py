@@ -0,0 +1,191 @@
+import json
+import os
+import numpy as np
+from obspy import Stream, Trace
+from obspy.clients.fdsn.header import FDSNNoDataException
+from obspy.core.utcdatetime import UTCDateTime
+
+
+class WaveformCache:
+    """Local store of waveform segments, read through memory maps.
+
+    Segments are keyed by (network, station, location, channel, event). The
+    samples of all segments of a station are appended to one float32 data
+    file, and an index file records where every segment starts. Reading a
+    segment returns a view on the memory mapped data file, so repeated runs
+    and parallel workers share the data without copies or network traffic.
+
+    Attributes:
+    directory: The directory holding the data and index files.
+    client: An object with a get_waveforms_bulk method (e.g. an obspy
+            Client) used to fill the cache. Can be None for a read-only
+            cache.
+    index_file: The name of the index file.
+    bulk_size: Maximum number of segments per bulk request.
+    Methods:
+    __init__: Initialization method.
+    fill: Fetch the segments missing from the cache, and report those that
+          could not be fetched.
+    get: Read a cached segment.
+    get_trace: Read a cached segment as an obspy Trace.
+    """
+
+    directory = "."
+    client = None
+    index_file = "index.json"
+    bulk_size = 100
+
+    def __init__(self, directory, client=None, index_file="index.json",
+                 bulk_size=100
+                 ):
+        """Initialization method for the WaveformCache class.
+        """
+        self.directory = directory
+        self.client = client
+        self.index_file = index_file
+        self.bulk_size = bulk_size
+        self._maps = {}
+        self._index = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        full_filename = "{}/{}".format(directory, index_file)
+        if os.path.isfile(full_filename):
+            with open(full_filename, "r") as f:
+                self._index = json.load(f)
+
+    @staticmethod
+    def _key(network, station, location, channel, event):
+        return "{}.{}.{}.{}|{}".format(network, station, location, channel,
+                                       event)
+
+    def __contains__(self, key):
+        return self._key(*key) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def fill(self, requests):
+        """Fetch the segments that are not cached yet.
+
+        Requests for the same station are grouped, ordered by time and sent
+        in bulk requests of at most bulk_size segments. Segments that could
+        not be fetched are not cached, so they are requested again by the
+        next fill, and the stations they belong to are printed.
+
+        Arguments:
+        requests: An iterable of (network, station, location, channel, event,
+                  starttime, endtime) tuples. event is any string identifying
+                  the event, e.g. its resource ID.
+        Returns the requests the client had no gapless data for, and the
+        requests of the bulk requests that failed, as two lists.
+        """
+        by_station = {}
+        for request in requests:
+            if self._key(*request[:5]) in self._index:
+                continue
+            by_station.setdefault(request[:2], []).append(request)
+        missing = []
+        failed = []
+        if not by_station:
+            return missing, failed
+        print "fetching waveforms for {} stations".format(len(by_station))
+        for (network, station), station_requests in sorted(by_station.items()):
+            station_requests.sort(key=lambda request: request[5])
+            data_file = "{}.{}.f32".format(network, station)
+            full_filename = "{}/{}".format(self.directory, data_file)
+            self._maps.pop(data_file, None)
+            for start in range(0, len(station_requests), self.bulk_size):
+                chunk = station_requests[start:start + self.bulk_size]
+                bulk = [(net, sta, loc, cha, t0, t1)
+                        for net, sta, loc, cha, evt, t0, t1 in chunk]
+                try:
+                    st = self.client.get_waveforms_bulk(bulk)
+                except FDSNNoDataException:
+                    # The request succeeded: there are no data.
+                    st = Stream()
+                except Exception as error:
+                    print "waveform request for {}.{} failed: {}".format(
+                                                     network, station, error)
+                    failed.extend(chunk)
+                    continue
+                with open(full_filename, "ab") as f:
+                    for request in chunk:
+                        net, sta, loc, cha, evt, t0, t1 = request
+                        tr = self._segment(st, net, sta, loc, cha, t0, t1)
+                        if tr is None:
+                            missing.append(request)
+                            continue
+                        offset = f.tell() // 4
+                        f.write(tr.data.astype(np.float32).tobytes())
+                        self._index[self._key(net, sta, loc, cha, evt)] = [
+                            data_file, offset, tr.stats.npts,
+                            tr.stats.starttime.timestamp,
+                            tr.stats.sampling_rate]
+        self._save_index()
+        for reason, unfetched in (("no data", missing),
+                                  ("failed requests", failed)):
+            if unfetched:
+                print "{} segments not cached ({}) at stations: {}".format(
+                          len(unfetched), reason,
+                          ", ".join(sorted(set("{}.{}".format(*request[:2])
+                                               for request in unfetched))))
+        return missing, failed
+
+    @staticmethod
+    def _segment(st, network, station, location, channel, starttime,
+                 endtime):
+        """Cut a single gapless trace for one request from a bulk response.
+        """
+        selected = st.select(network=network, station=station,
+                             location=location, channel=channel)
+        selected = selected.slice(UTCDateTime(starttime),
+                                  UTCDateTime(endtime)).copy()
+        if not len(selected):
+            return None
+        selected.merge()
+        tr = selected[0]
+        if np.ma.is_masked(tr.data) or not tr.stats.npts:
+            return None
+        return tr
+
+    def _save_index(self):
+        full_filename = "{}/{}".format(self.directory, self.index_file)
+        with open(full_filename + ".tmp", "w") as f:
+            json.dump(self._index, f)
+        os.rename(full_filename + ".tmp", full_filename)
+
+    def get(self, network, station, location, channel, event):
+        """Read a cached segment.
+
+        Returns the samples as a read-only view on the memory mapped data
+        file, the start time and the sampling rate, or None if the segment
+        is not cached.
+        """
+        entry = self._index.get(self._key(network, station, location,
+                                          channel, event))
+        if entry is None:
+            return None
+        data_file, offset, npts, starttime, sampling_rate = entry
+        samples = self._maps.get(data_file)
+        if samples is None:
+            full_filename = "{}/{}".format(self.directory, data_file)
+            samples = np.memmap(full_filename, dtype=np.float32, mode="r")
+            self._maps[data_file] = samples
+        return (samples[offset:offset + npts], UTCDateTime(starttime),
+                sampling_rate)
+
+    def get_trace(self, network, station, location, channel, event):
+        """Read a cached segment as an obspy Trace, or None.
+        """
+        segment = self.get(network, station, location, channel, event)
+        if segment is None:
+            return None
+        data, starttime, sampling_rate = segment
+        tr = Trace(data=data)
+        tr.stats.network = network
+        tr.stats.station = station
+        tr.stats.location = location
+        tr.stats.channel = channel
+        tr.stats.starttime = starttime
+        tr.stats.sampling_rate = sampling_rate
+        return tr
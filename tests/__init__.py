@@ -0,0 +1,4 @@
+"""Tests of hypoDDutils, run from the top directory of the repository:
+
+    python -m unittest discover tests
+"""
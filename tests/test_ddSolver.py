@@ -0,0 +1,91 @@
+"""Recovery of synthetic hypocenters by ddSolver.DDSolver."""
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from benchmarks.syntheticCatalog import (KM_PER_DEGREE, synthetic_catalog,
+                                         synthetic_stations)
+from hypoDDutils.ddSolver import DDSolver
+from hypoDDutils.hypoDDcontrol import HypoDDControl
+from hypoDDutils.ph2dt import Ph2dt
+from hypoDDutils.ph2dtControl import Ph2dtControl
+from hypoDDutils.weight import Weight
+
+
+def _offsets(latitudes, longitudes, depths, truth):
+    """Return the offsets east, north and down of hypocenters from the true
+    ones, in m, as an (n, 3) array.
+    """
+    true_latitudes, true_longitudes, true_depths = truth
+    scale = KM_PER_DEGREE * np.cos(np.radians(true_latitudes))
+    return 1000.0 * np.column_stack(((longitudes - true_longitudes) * scale,
+                                     (latitudes - true_latitudes) *
+                                     KM_PER_DEGREE,
+                                     depths - true_depths))
+
+
+class SyntheticRecoveryTest(unittest.TestCase):
+    """Relocates a synthetic cluster of 80 events, recorded by 15 stations
+    with 2 ms pick errors and mislocated by 0.5 km in the catalog, from the
+    catalog differential times of the native ph2dt.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        stations = synthetic_stations(15, radius=30.0, seed=0)
+        cls.arrays, truth = synthetic_catalog(80, stations, nclusters=1,
+                                              cluster_radius=1.0,
+                                              pick_fraction=1.0,
+                                              pick_error=0.002,
+                                              location_error=0.5, seed=0,
+                                              return_truth=True)
+        Ph2dt(cls.arrays, stations,
+              control=Ph2dtControl(maxsep=10, maxngh=30, maxobs=50),
+              output_directory=cls.directory,
+              catalog_tt_output="dt.ct").run()
+        control = HypoDDControl(control_directory=cls.directory,
+                                initial_hypocenters="event.sel",
+                                station_input="station.sel", idat=2,
+                                weights=[Weight(niter=5, wtctp=1, wtcts=0.5,
+                                                wrct=-9, wdct=-9, damp=20),
+                                         Weight(niter=5, wtctp=1, wtcts=0.5,
+                                                wrct=6, wdct=-9, damp=20)])
+        cls.solver = DDSolver(control, directory=cls.directory)
+        cls.relocations = cls.solver.run()
+        index = cls.relocations["evid"] - 1
+        cls.truth = [values[index] for values in truth]
+        cls.catalog_offsets = _offsets(cls.arrays.latitudes[index],
+                                       cls.arrays.longitudes[index],
+                                       cls.arrays.depths[index], cls.truth)
+        cls.offsets = _offsets(cls.relocations["lat"],
+                               cls.relocations["lon"],
+                               cls.relocations["depth"], cls.truth)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_all_events_relocated(self):
+        self.assertEqual(len(self.relocations), 80)
+
+    def test_relative_locations(self):
+        # Double differences cannot recover the centroid of the cluster,
+        # so the locations are compared relative to it.
+        catalog_error = np.sqrt(np.mean(np.sum(
+            (self.catalog_offsets - self.catalog_offsets.mean(axis=0)) ** 2,
+            axis=1)))
+        error = np.sqrt(np.mean(np.sum(
+            (self.offsets - self.offsets.mean(axis=0)) ** 2, axis=1)))
+        self.assertGreater(catalog_error, 500.0)
+        self.assertLess(error, 50.0)
+
+    def test_centroid_kept(self):
+        shift = self.offsets.mean(axis=0) - self.catalog_offsets.mean(axis=0)
+        self.assertLess(np.sqrt(np.sum(shift ** 2)), 2.0)
+        self.assertLess(max(iteration["os"]
+                            for iteration in self.solver.iterations), 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
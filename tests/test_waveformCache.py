@@ -0,0 +1,130 @@
+"""Filling and reading waveformCache.WaveformCache with a fake client."""
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from obspy import Stream, Trace, UTCDateTime
+from obspy.clients.fdsn.header import FDSNNoDataException
+from hypoDDutils.waveformCache import WaveformCache
+
+# Sampling rate of the fake waveforms in Hz.
+SAMPLING_RATE = 100.0
+
+
+def _samples(station, starttime, npts):
+    """The samples the fake client returns, a function of the station and
+    the absolute time, so that any window can be checked.
+    """
+    times = starttime.timestamp + np.arange(npts) / SAMPLING_RATE
+    return np.sin(times + len(station)).astype(np.float32)
+
+
+class FakeClient:
+    """Answers bulk requests with synthetic traces.
+
+    Attributes:
+    failing: Stations whose requests raise an error.
+    no_data: Stations whose requests raise FDSNNoDataException.
+    silent: Channels that are left out of the answers.
+    bulk_requests: The bulk requests received, in order.
+    """
+
+    def __init__(self, failing=(), no_data=(), silent=()):
+        self.failing = set(failing)
+        self.no_data = set(no_data)
+        self.silent = set(silent)
+        self.bulk_requests = []
+
+    def get_waveforms_bulk(self, bulk):
+        self.bulk_requests.append(bulk)
+        st = Stream()
+        for network, station, location, channel, t0, t1 in bulk:
+            if station in self.failing:
+                raise IOError("connection reset")
+            if station in self.no_data:
+                raise FDSNNoDataException("No data available")
+            if channel in self.silent:
+                continue
+            npts = int(round((t1 - t0) * SAMPLING_RATE)) + 1
+            tr = Trace(data=_samples(station, t0, npts))
+            tr.stats.network = network
+            tr.stats.station = station
+            tr.stats.location = location
+            tr.stats.channel = channel
+            tr.stats.starttime = t0
+            tr.stats.sampling_rate = SAMPLING_RATE
+            st.append(tr)
+        return st
+
+
+def _requests(stations, events=3, channel="HHZ"):
+    t0 = UTCDateTime("2015-01-01T00:00:00")
+    return [("NL", station, "", channel, "event{}".format(idx),
+             t0 + 600 * idx, t0 + 600 * idx + 2.0)
+            for station in stations for idx in range(events)]
+
+
+class WaveformCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fill_and_read(self):
+        requests = _requests(["G01", "G002"])
+        cache = WaveformCache(self.directory, FakeClient())
+        self.assertEqual(cache.fill(requests), ([], []))
+        self.assertEqual(len(cache), 6)
+        for request in requests:
+            tr = cache.get_trace(*request[:5])
+            self.assertEqual(tr.stats.starttime, request[5])
+            self.assertEqual(tr.stats.npts, 201)
+            np.testing.assert_array_equal(
+                tr.data, _samples(request[1], request[5], 201))
+
+    def test_cached_segments_not_requested(self):
+        requests = _requests(["G01"])
+        WaveformCache(self.directory, FakeClient()).fill(requests)
+        client = FakeClient()
+        cache = WaveformCache(self.directory, client)
+        self.assertIn(requests[0][:5], cache)
+        cache.fill(requests)
+        self.assertEqual(client.bulk_requests, [])
+
+    def test_bulk_size(self):
+        client = FakeClient()
+        WaveformCache(self.directory, client, bulk_size=2).fill(
+            _requests(["G01"], events=5))
+        self.assertEqual([len(bulk) for bulk in client.bulk_requests],
+                         [2, 2, 1])
+
+    def test_failed_requests_reported(self):
+        requests = _requests(["G01", "G02"])
+        cache = WaveformCache(self.directory,
+                              FakeClient(failing=["G02"]))
+        missing, failed = cache.fill(requests)
+        self.assertEqual(missing, [])
+        self.assertEqual(failed, requests[3:])
+        self.assertEqual(len(cache), 3)
+        # Failed segments are requested again.
+        client = FakeClient()
+        WaveformCache(self.directory, client).fill(requests)
+        self.assertEqual(len(client.bulk_requests), 1)
+        self.assertEqual(client.bulk_requests[0][0][1], "G02")
+
+    def test_missing_segments_reported(self):
+        requests = (_requests(["G01"]) + _requests(["G01"], channel="HHN") +
+                    _requests(["G02"]))
+        cache = WaveformCache(self.directory,
+                              FakeClient(no_data=["G02"], silent=["HHN"]))
+        missing, failed = cache.fill(requests)
+        self.assertEqual(sorted(missing), sorted(requests[3:]))
+        self.assertEqual(failed, [])
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get(*requests[3][:5]))
+
+
+if __name__ == "__main__":
+    unittest.main()